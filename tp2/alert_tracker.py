@@ -0,0 +1,240 @@
+from alertflow_report import AlertFlow_Report
+from utils import Token_Bucket
+
+from typing import Dict, List, Tuple
+from threading import Lock
+from time import monotonic
+
+ALERT_RESOLVE_PERIODS = 2     # quiet periods before an alert counts as resolved, so a metric hovering at its threshold doesn't flap
+ALERT_SUMMARY_INTERVAL = 60   # seconds before the first reminder that a task's alerts are still ongoing, doubling after every one
+ALERT_SUMMARY_MAX = 900       # up to this
+ALERT_RATE = 0.2              # AlertFlow messages per second a device sends in the long run
+ALERT_BURST = 10              # messages it may send at once, when several alerts change together
+
+# (taskID, spike type, interface) - the interface is '' for anything but traffic
+Alert_Key = Tuple[str, str, str]
+
+# A held transition cancels out against the opposite one for the same alert, instead of going out after it
+opposite_states = {'o': 'r', 'r': 'o'}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Alert_Tracker:
+
+    # Turns the spikes every task period may come up with into alert transitions. A (task, spike type, interface) over its
+    # threshold for the first time is opened, stays ongoing while it keeps spiking and is resolved after ALERT_RESOLVE_PERIODS
+    # periods without. Only openings and resolutions are sent, plus summaries of what's still ongoing, further and further apart
+    # the longer it goes on, so a sustained incident costs a handful of messages instead of one per period.
+    # Messages past the device's rate are held and coalesced: the same task and state merge into one message, sent once
+    # there's room again. An alert that resolves while its opening is still held (or reopens while its resolution is)
+    # drops both, and held summaries never list an alert whose opening is still held or that has since resolved, so held
+    # messages can't reach the server in an order that leaves it with the wrong state.
+
+    def __init__(
+            self, deviceID: str, resolve_periods: int = ALERT_RESOLVE_PERIODS, summary_interval: float = ALERT_SUMMARY_INTERVAL,
+            rate: float = ALERT_RATE, burst: float = ALERT_BURST, clock=monotonic
+        ):
+        self.deviceID = deviceID
+        self.clock = clock
+        self.resolve_periods = resolve_periods
+        self.summary_interval = summary_interval
+        self.bucket = Token_Bucket(rate, burst, clock)
+
+        self.lock = Lock()  # every task runner reports through here
+        self.quiet: Dict[Alert_Key, int] = {}                # open alert -> periods in a row it didn't spike
+        self.next_summary: Dict[str, Tuple[float, float]] = {} # taskID -> (when its ongoing alerts are summarized next, interval after that)
+        self.held: Dict[Tuple[str, str], List[Alert_Key]] = {} # (taskID, state) -> alerts waiting for the rate limit
+        self.held_since: Dict[Tuple[str, str], float] = {}    # and since when, which is when their message counts as measured
+
+        self.spikes_seen = 0
+        self.messages_sent = 0
+        self.alerts_coalesced = 0
+        self.transitions_cancelled = 0
+
+    def update(self, taskID: str, report: AlertFlow_Report = None) -> List[AlertFlow_Report]:
+        # Called once per period of every task, report being what the period spiked (None if nothing), returns what to send
+        spiking = set(alert_keys(taskID, report)) if report is not None else set()
+        now = self.clock()
+
+        with self.lock:
+            self.spikes_seen += report is not None
+            opened = [key for key in spiking if key not in self.quiet]
+            resolved = []
+            for key in [key for key in self.quiet if key[0] == taskID]:
+                self.quiet[key] = 0 if key in spiking else self.quiet[key] + 1
+                if self.quiet[key] >= self.resolve_periods:
+                    del self.quiet[key]
+                    resolved.append(key)
+
+            for key in opened:
+                self.quiet[key] = 0
+
+            self.hold(taskID, 'o', opened)
+            self.hold(taskID, 'r', resolved)
+
+            ongoing = [key for key in self.quiet if key[0] == taskID]
+            if not ongoing:
+                self.next_summary.pop(taskID, None) # the next incident starts over at the shortest interval
+            elif taskID not in self.next_summary:
+                self.next_summary[taskID] = (now + self.summary_interval, 2 * self.summary_interval)
+            elif now >= self.next_summary[taskID][0]:
+                interval = self.next_summary[taskID][1]
+                self.next_summary[taskID] = (now + interval, min(2 * interval, ALERT_SUMMARY_MAX))
+                self.hold(taskID, 'g', ongoing)
+
+            return self.release()
+
+    def hold(self, taskID: str, state: str, keys: List[Alert_Key]):
+        if state == 'g':
+            # An alert whose opening is still held is told by it, a summary going out first would have it ongoing before it opened
+            keys = [key for key in keys if key not in self.held.get((taskID, 'o'), [])]
+        if state == 'r':
+            # Resolved (or its opening about to be cancelled), it isn't ongoing: a held summary going out later would revive it
+            self.drop(taskID, 'g', keys)
+        if state in opposite_states:
+            cancelled = self.drop(taskID, opposite_states[state], keys)
+            if cancelled:
+                self.transitions_cancelled += len(cancelled)
+                keys = [key for key in keys if key not in cancelled]
+
+        if not keys:
+            return
+        if (taskID, state) not in self.held:
+            self.held_since[(taskID, state)] = self.clock()
+        held = self.held.setdefault((taskID, state), [])
+        if held:
+            self.alerts_coalesced += 1
+        held += [key for key in keys if key not in held]
+
+    def drop(self, taskID: str, state: str, keys: List[Alert_Key]) -> List[Alert_Key]:
+        # Takes keys out of a held message, and the message with them once nothing's left in it
+        held = self.held.get((taskID, state))
+        if not held:
+            return []
+        dropped = [key for key in keys if key in held]
+        if dropped:
+            held[:] = [key for key in held if key not in dropped]
+            if not held:
+                del self.held[(taskID, state)]
+                del self.held_since[(taskID, state)]
+        return dropped
+
+    def release(self) -> List[AlertFlow_Report]:
+        reports = []
+        while self.held and self.bucket.try_take():
+            (taskID, state), keys = next(iter(self.held.items())) # oldest first, an opening goes before its resolution
+            del self.held[(taskID, state)]
+            report = alert_report(self.deviceID, taskID, state, keys)
+            report.stamp('measured', at=self.held_since.pop((taskID, state)))
+            reports.append(report)
+        self.messages_sent += len(reports)
+        return reports
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'open': len(self.quiet),
+                'spikes': self.spikes_seen,
+                'sent': self.messages_sent,
+                'coalesced': self.alerts_coalesced,
+                'cancelled': self.transitions_cancelled,
+                'held': len(self.held)
+            }
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def alert_keys(taskID: str, report: AlertFlow_Report) -> List[Alert_Key]:
+    keys = []
+    for spike in report.spikes:
+        if spike == 't':
+            keys += [(taskID, 't', interface) for interface in report.interfaces]
+        else:
+            keys.append((taskID, spike, ''))
+    return keys
+
+def alert_report(deviceID: str, taskID: str, state: str, keys: List[Alert_Key]) -> AlertFlow_Report:
+    spikes = []
+    for _, spike, _ in keys:
+        if spike not in spikes:
+            spikes.append(spike)
+    return AlertFlow_Report(deviceID, taskID, spikes, [interface for _, _, interface in keys if interface], state=state)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    # An hour of 5 s periods: cpu over its threshold for 40 minutes, eth0 flapping for a while, compared to one message per spiking period
+    clock = [0.0]
+    tracker = Alert_Tracker('r1', clock=lambda: clock[0]) # the hour passes in no time
+    sent: List[AlertFlow_Report] = []
+
+    for period in range(720):
+        clock[0] = period * 5.0
+        spikes, interfaces = [], []
+        if 60 <= period < 540:
+            spikes.append('c')
+        if 100 <= period < 160 and period % 3:
+            spikes.append('t')
+            interfaces.append('eth0')
+        report = AlertFlow_Report('r1', 't1', spikes, interfaces) if spikes else None
+        sent += tracker.update('t1', report)
+
+    for report in sent:
+        print(report)
+    stats = tracker.stats()
+    print(f"{stats['spikes']} spiking periods -> {stats['sent']} messages ({stats['coalesced']} coalesced, {stats['open']} still open)")
+
+    # Starved of tokens: ram opens and resolves while its opening is held, and a summary is held in between.
+    # Neither its opening, its resolution nor the summary may tell the server about ram
+    clock[0] = 0.0
+    tracker = Alert_Tracker('r1', summary_interval=10, rate=0.01, burst=1, clock=lambda: clock[0])
+    sent = []
+    for period in range(60):
+        clock[0] = period * 5.0
+        spikes = ['c'] if period < 30 else []
+        if period == 1:
+            spikes.append('r')
+        sent += tracker.update('t1', AlertFlow_Report('r1', 't1', spikes) if spikes else None)
+    print()
+    for report in sent:
+        print(report)
+    print(tracker.stats())
@@ -1,8 +1,10 @@
 from enum import Enum
-from msgpack import packb, unpackb
-from zlib import compress, decompress
+from zlib import decompress, decompressobj
+from typing import List, Tuple, Dict
+from time import monotonic
 
-from utils import Colours
+from utils import Colours, stage_trace
+from wire_codec import pack, unpack, stream_unpacker, trimmed, padded
 
 class TypeUtilities(Enum):
     @classmethod
@@ -19,74 +21,155 @@ class Spike_Type(TypeUtilities):
     THROUGHPUT = 'b'
     PACKET_LOSS = 'p'
     JITTER = 'j'
+    LATENCY = 'l'
+
+# Value -> member lookup without walking the enum, for the per-report validation
+spike_types_by_value = {spike.value: spike for spike in Spike_Type}
+
+# Where the spikes of a report stand, when the agent tracks them (see alert_tracker.py). Reports without one are
+# the spikes of a single period, as agents that don't track send every period.
+alert_states = {
+    'o': "Opened",
+    'g': "Ongoing",
+    'r': "Resolved"
+}
+
+# A zlib stream's first byte at the default window size, the positive fixint 120 in msgpack, which no report starts with
+ZLIB_HEADER = b'\x78'
 
 class AlertFlow_Report:
 
-    def __init__(self, deviceID, taskID, spike_types: list, interfaces=[]):
+    # Slotted instead of wrapping a dict: spike types are kept as their one-letter values, which is also what goes on the wire
+
+    __slots__ = ('device_id', 'task_id', 'spikes', 'interfaces', 'state', 'stamps', 'trace')
+
+    def __init__(self, deviceID, taskID, spike_types: list, interfaces=[], state=None):
         
-        spike_enums = []
         for spike_type in spike_types:
-            spike_enum = Spike_Type.corresponds(spike_type)
-            if spike_enum == Spike_Type.IFACE_TRAFFIC and len(interfaces) == 0:
-                raise ValueError(
-                    f"[AlertFlow]\n | Error: {deviceID}-{taskID} attempted traffic spike report without specifying interfaces."
-                )
-            spike_enums.append(spike_enum)
-
-        self.report = {
-            'di': deviceID,
-            'ti': taskID,
-            's': [spike.value for spike in spike_enums]
-        }
-
-        if Spike_Type.IFACE_TRAFFIC in spike_enums:
-            self.report['i'] = interfaces
+            if spike_type not in spike_types_by_value:
+                raise ValueError(f"No corresponding enum for value: {spike_type}")
+
+        has_traffic_spike = 't' in spike_types
+        if has_traffic_spike and len(interfaces) == 0:
+            raise ValueError(
+                f"[AlertFlow]\n | Error: {deviceID}-{taskID} attempted traffic spike report without specifying interfaces."
+            )
+
+        self.device_id = deviceID
+        self.task_id = taskID
+        self.spikes = list(spike_types)
+        self.interfaces = list(interfaces) if has_traffic_spike else None
+        self.state = state
+        self.stamps: Dict[str, float] = {} # same as NetTask_Report's, 'measured' being when the spike was found
+        self.trace: List[int] = None
 
     def __str__(self):
         string = [
-            Colours.alertflow_styling(f"[AlertFlow: Device {self.report['di']} - Task {self.report['ti']}]"),
-            f" | Spiked: {', '.join([Spike_Type.corresponds(spike).name for spike in self.report['s']])}",
+            Colours.alertflow_styling(f"[AlertFlow: Device {self.device_id} - Task {self.task_id}]"),
+            f" | Spiked: {', '.join([Spike_Type.corresponds(spike).name for spike in self.spikes])}",
         ]
 
-        if 'i' in self.report:
-            string.append(f" | Affected Interfaces: {', '.join(self.report['i'])}")
+        if self.interfaces is not None:
+            string.append(f" | Affected Interfaces: {', '.join(self.interfaces)}")
+
+        if self.state is not None:
+            string.append(f" | State: {alert_states[self.state]}")
 
         return "\n".join(string)
 
     def deviceID(self):
-        return self.report['di']
+        return self.device_id
     
     def taskID(self):
-        return self.report['ti']
+        return self.task_id
+
+    def stamp(self, stage: str, at: float = None):
+        self.stamps[stage] = at if at is not None else monotonic()
+
+    def close_trace(self):
+        self.trace = stage_trace(self.stamps)
 
     def serialize(self) -> bytes:
-        return compress(packb(self.report, use_bin_type=True))
+        # A msgpack array and nothing else: a few dozen bytes, which zlib only made longer, and msgpack knows where it ends
+        return pack(trimmed([self.device_id, self.task_id, self.spikes, self.interfaces, self.state, self.trace]))
+
+    @staticmethod
+    def from_fields(fields: List) -> 'AlertFlow_Report':
+        device_id, task_id, spikes, interfaces, state, trace = padded(fields, 6)
+        report = AlertFlow_Report(device_id, task_id, spikes, interfaces or [], state)
+        report.trace = trace
+        return report
 
     @staticmethod
     def deserialize(data: bytes) -> 'AlertFlow_Report':
-        unpacked_data = unpackb(decompress(data), raw=False)
-        return AlertFlow_Report(
-            deviceID=unpacked_data['di'],
-            taskID=unpacked_data['ti'],
-            spike_types=unpacked_data['s'],
-            interfaces=unpacked_data.get('i', [])
-        )
+        if data[:1] == ZLIB_HEADER:
+            return AlertFlow_Report.legacy_deserialize(data)
+        return AlertFlow_Report.from_fields(unpack(data))
+
+    @staticmethod
+    def legacy_deserialize(data: bytes) -> 'AlertFlow_Report':
+        # Reports were zlib compressed maps before they were positional
+        d = unpack(decompress(data))
+        return AlertFlow_Report.from_fields([d['di'], d['ti'], d['s'], d.get('i'), d.get('st'), d.get('tr')])
+
+    @staticmethod
+    def split_stream(data: bytes) -> Tuple[List[bytes], bytes]:
+        # Legacy reports follow each other on the AlertFlow connection as zlib streams, which know where they end. A single
+        # read may hold several of them (a relay forwarding a burst) or stop halfway through one, that part is returned to
+        # be completed by the next read.
+        reports = []
+        while data:
+            stream = decompressobj()
+            stream.decompress(data)
+            if not stream.eof:
+                break
+            end = len(data) - len(stream.unused_data)
+            reports.append(data[:end])
+            data = data[end:]
+        return reports, data
 
     def to_full_dict(self) -> dict:
         full_dict = {
-            'device_id': self.report['di'],
-            'task_id': self.report['ti'],
-            'spikes': [Spike_Type.corresponds(spike).name for spike in self.report['s']],
+            'device_id': self.device_id,
+            'task_id': self.task_id,
+            'spikes': [Spike_Type.corresponds(spike).name for spike in self.spikes],
         }
 
-        if 'i' in self.report:
-            full_dict['interfaces'] = self.report['i']
+        if self.interfaces is not None:
+            full_dict['interfaces'] = self.interfaces
+
+        if self.state is not None:
+            full_dict['state'] = alert_states[self.state]
 
         return full_dict
 
 
 
 
+class AlertFlow_Stream:
+
+    # Decodes what an AlertFlow connection receives, fed every recv as it comes. Reports follow each other as msgpack
+    # arrays, read by one streaming Unpacker that keeps an incomplete one buffered until the rest arrives. Agents from
+    # before that sent zlib streams instead (so do captures of them), the first byte of the connection tells which.
+
+    def __init__(self):
+        self.unpacker = stream_unpacker()
+        self.legacy: bool = None
+        self.pending = b''
+
+    def feed(self, data: bytes) -> List[AlertFlow_Report]:
+        if self.legacy is None:
+            self.legacy = data[:1] == ZLIB_HEADER
+        if self.legacy:
+            serialized, self.pending = AlertFlow_Report.split_stream(self.pending + data)
+            return [AlertFlow_Report.legacy_deserialize(report) for report in serialized]
+
+        self.unpacker.feed(data)
+        return [AlertFlow_Report.from_fields(fields) for fields in self.unpacker]
+
+
+
+
 
 
 if __name__ == "__main__":
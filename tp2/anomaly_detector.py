@@ -0,0 +1,229 @@
+from nettask_report import NetTask_Report
+from alertflow_report import AlertFlow_Report
+
+from typing import Dict, List, Tuple, Callable
+from threading import Thread, Lock, Event
+from time import perf_counter
+
+import numpy as np
+
+DETECTOR_TICK = 1.0         # seconds between fleet-wide passes
+DETECTOR_SMOOTHING = 0.05   # weight of the newest value in each series' moving mean and variance
+DETECTOR_THRESHOLD = 4.0    # z-score past which a value is an outlier
+DETECTOR_WARMUP = 20        # values a series needs before it's judged at all
+DETECTOR_MIN_STD = 1.0      # absolute and relative (to the mean) floor of the deviation, so flat series don't flag
+DETECTOR_MIN_STD_RATIO = 0.05 # on every small wiggle
+
+# Metric -> spike type it's reported as, per interface traffic ('t/eth0') included as 't'
+detected_measurements = ['c', 'r', 'l', 'b', 'j', 'p']
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Anomaly_Detector:
+
+    # Flags values far from what each (device, task, metric) series usually does, instead of one static threshold for
+    # the whole fleet. Every series is a slot in a few NumPy arrays (EWMA mean and variance, values seen); the ingest writer
+    # threads only record the latest value of each series, and once per tick all the series that got one are scored and
+    # updated in a single vectorized pass. Outliers come out as AlertFlow reports, one per (device, task), handed to
+    # report_spike just like the ones agents send.
+    # Outliers update the series clipped to the threshold, so one spike neither drags the mean nor inflates the variance,
+    # while a lasting level shift is still learned within a few dozen values.
+
+    def __init__(self, report_spike: Callable[[AlertFlow_Report], None], tick: float = DETECTOR_TICK, capacity: int = 1024):
+        self.report_spike = report_spike
+        self.tick = tick
+
+        self.lock = Lock()
+        self.slots: Dict[Tuple[str, str], Dict[str, int]] = {}  # (device, task) -> metric -> slot
+        self.series: List[Tuple[str, str, str]] = []             # slot -> (device, task, metric)
+        self.latest: Dict[int, float] = {}                       # slot -> value since the last tick
+
+        self.mean = np.zeros(capacity)
+        self.var = np.zeros(capacity)
+        self.seen = np.zeros(capacity, dtype=np.int64)
+
+        self.ticks = 0
+        self.flagged = 0
+        self.last_tick_ms = 0.0
+
+        self.stopping = Event()
+        self.thread = Thread(target=self.tick_forever, daemon=True, name="anomaly-detector")
+        self.thread.start()
+
+    def observe(self, reports: List[NetTask_Report]):
+        with self.lock:
+            for report in reports:
+                slots = self.slots.get((report.deviceID, report.taskID))
+                if slots is None:
+                    slots = self.slots[(report.deviceID, report.taskID)] = {}
+                for metric, value in detected_values(report):
+                    slot = slots.get(metric)
+                    if slot is None:
+                        slot = slots[metric] = len(self.series)
+                        self.series.append((report.deviceID, report.taskID, metric))
+                    self.latest[slot] = value
+
+    ###########################################################################################################
+
+    def grow(self, size: int):
+        capacity = len(self.mean)
+        while capacity < size:
+            capacity *= 2
+        if capacity != len(self.mean):
+            for name in ('mean', 'var', 'seen'):
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+
+    def score(self, slots: np.ndarray, values: np.ndarray) -> np.ndarray:
+        # Scores the new values against each series so far, then folds them in. Returns the slots that were outliers.
+        mean, var, seen = self.mean[slots], self.var[slots], self.seen[slots]
+
+        std = np.sqrt(var) + DETECTOR_MIN_STD + DETECTOR_MIN_STD_RATIO * np.abs(mean)
+        z = (values - mean) / std
+        outliers = (np.abs(z) > DETECTOR_THRESHOLD) & (seen >= DETECTOR_WARMUP)
+
+        # The first value starts the mean, later ones move it by DETECTOR_SMOOTHING, outliers only as far as the threshold
+        diff = np.where(seen == 0, values - mean, np.clip(values - mean, -DETECTOR_THRESHOLD * std, DETECTOR_THRESHOLD * std))
+        alpha = np.where(seen == 0, 1.0, DETECTOR_SMOOTHING)
+        increment = alpha * diff
+        self.mean[slots] = mean + increment
+        self.var[slots] = np.where(seen == 0, 0.0, (1 - alpha) * (var + diff * increment))
+        self.seen[slots] = seen + 1
+
+        return slots[outliers]
+
+    def run_tick(self) -> int:
+        with self.lock:
+            latest, self.latest = self.latest, {}
+            series = self.series
+            self.grow(len(series))
+        if not latest:
+            return 0
+
+        start = perf_counter()
+        slots = np.fromiter(latest.keys(), dtype=np.int64, count=len(latest))
+        values = np.fromiter(latest.values(), dtype=np.float64, count=len(latest))
+        outliers = self.score(slots, values)
+        self.last_tick_ms = (perf_counter() - start) * 1000
+        self.ticks += 1
+
+        # Few series are ever out of line at once, building the reports is back to plain Python
+        spikes: Dict[Tuple[str, str], Tuple[List[str], List[str]]] = {}
+        for slot in outliers.tolist():
+            deviceID, taskID, metric = series[slot]
+            spike_types, interfaces = spikes.setdefault((deviceID, taskID), ([], []))
+            spike_type, _, interface = metric.partition('/')
+            if spike_type not in spike_types:
+                spike_types.append(spike_type)
+            if interface:
+                interfaces.append(interface)
+
+        for (deviceID, taskID), (spike_types, interfaces) in spikes.items():
+            self.report_spike(AlertFlow_Report(deviceID, taskID, spike_types, interfaces))
+        self.flagged += len(outliers)
+        return len(outliers)
+
+    def tick_forever(self):
+        while not self.stopping.wait(self.tick):
+            try:
+                self.run_tick()
+            except Exception as e:
+                print(f"[Detector] Tick failed: {e}")
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def stats(self) -> Dict:
+        return {'series': len(self.series), 'ticks': self.ticks, 'flagged': self.flagged, 'last_tick_ms': round(self.last_tick_ms, 3)}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def detected_values(report: NetTask_Report):
+    # The measurements there's a spike type for, interface traffic once per interface
+    measurements = report.measurements
+    for key in detected_measurements:
+        value = measurements.get(key)
+        if isinstance(value, (int, float)):
+            yield key, value
+    for interface, traffic in measurements.get('t', {}).items():
+        if isinstance(traffic, (int, float)):
+            yield f"t/{interface}", traffic
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    import random
+
+    # 5000 devices x 2 tasks x (cpu, ram, 2 interfaces) = 40000 series, a few pushed out of line after warming up
+    flagged: List[AlertFlow_Report] = []
+    detector = Anomaly_Detector(flagged.append, tick=3600) # ticks are run by hand below
+
+    def fleet_reports(spiking=()) -> List[NetTask_Report]:
+        reports = []
+        for device in range(5000):
+            for task in ('t1', 't2'):
+                deviceID = f"r{device}"
+                report = NetTask_Report(deviceID, task)
+                report.add_measurement('c', random.gauss(20 + device % 50, 3))
+                report.add_measurement('r', random.gauss(40, 1))
+                traffic = {'eth0': random.gauss(1500, 100), 'eth1': random.gauss(200, 20)}
+                if deviceID in spiking and task == 't1':
+                    traffic['eth1'] = 5000
+                report.add_measurement('t', traffic)
+                reports.append(report)
+        return reports
+
+    tick_ms = []
+    for tick in range(DETECTOR_WARMUP + 10):
+        detector.observe(fleet_reports(spiking={'r7', 'r4242'} if tick == DETECTOR_WARMUP + 5 else ()))
+        detector.run_tick()
+        tick_ms.append(detector.last_tick_ms)
+
+    print(f"{detector.stats()['series']} series, vectorized pass: median {sorted(tick_ms)[len(tick_ms)//2]:.2f} ms, max {max(tick_ms):.2f} ms")
+    print(f"{len(flagged)} flagged (expected r7 and r4242 on eth1):")
+    for report in flagged:
+        print(report)
+    detector.close()
@@ -0,0 +1,141 @@
+from datagram import Datagram, ACK
+from nettask_message import NetTask_Message
+from nettask_report import NetTask_Report
+from alertflow_report import AlertFlow_Report, AlertFlow_Stream
+from nettask_task import NetTask_Task
+from session_symbols import Session_Symbols
+
+from timeit import timeit
+import tracemalloc
+import sys
+
+# Construction, encoding and decoding cost of the protocol objects, plus the memory each instance retains.
+# Run before and after touching any of these classes: python3 codec_benchmark.py [iterations]
+
+ITERATIONS = 20000
+STREAM_BURST = 100 # AlertFlow reports per read when decoding a stream
+INTERFACES = 16    # of the many-interface device, whose reports are interned against its session's symbols
+RETAINED = 1000 # instances kept alive to measure memory per object
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def sample_report() -> NetTask_Report:
+    report = NetTask_Report('r1', 't1')
+    report.add_measurement('c', 12.5)
+    report.add_measurement('r', 40.1)
+    report.add_measurement('t', {'eth0': 1500.0, 'eth1': 20.0})
+    report.add_summary('c', [1.0, 12.5, 30.0, 28.0])
+    return report
+
+def sample_wide_report() -> NetTask_Report:
+    report = NetTask_Report('router-core-01', 'traffic-edge')
+    report.add_measurement('c', 12.5)
+    report.add_measurement('t', {f"eth{i}": 1500.0 + i for i in range(INTERFACES)})
+    report.add_summary('t', {f"eth{i}": [0.0, 1500.0 + i, 3000.0, 2900.0] for i in range(INTERFACES)})
+    return report
+
+def sample_symbols() -> Session_Symbols:
+    tasks = {'traffic-edge': NetTask_Task('traffic-edge', 5, measure_cpu=True, interfaces=[f"eth{i}" for i in range(INTERFACES)])}
+    return Session_Symbols(Session_Symbols.session_table('router-core-01', tasks), tasks)
+
+def sample_alertflow() -> AlertFlow_Report:
+    return AlertFlow_Report('r1', 't1', ['c', 't'], ['eth0'])
+
+def sample_datagram(payload=b'x'*100) -> Datagram:
+    return Datagram('192.168.1.10', 2000, '192.168.1.1', 9000, ACK, 1234, 5678, payload)
+
+def microseconds(func, iterations) -> float:
+    return timeit(func, number=iterations) / iterations * 1e6
+
+def bytes_per_object(factory) -> float:
+    tracemalloc.start()
+    retained = [factory() for _ in range(RETAINED)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return current / RETAINED
+
+def run(iterations=ITERATIONS):
+
+    report_bytes = sample_report().serialize()
+    alertflow_bytes = sample_alertflow().serialize()
+    message_bytes = NetTask_Message('r1', 'r', report_bytes).serialize()
+    datagram_bytes = sample_datagram(message_bytes).serialize()
+    alertflow_burst = alertflow_bytes * STREAM_BURST
+    symbols = sample_symbols()
+    wide_report = sample_wide_report()
+    wide_bytes = wide_report.serialize()
+    interned_bytes = wide_report.serialize(symbols)
+
+    timings = [
+        ("Datagram construct", lambda: sample_datagram()),
+        ("Datagram serialize", sample_datagram(message_bytes).serialize),
+        ("Datagram deserialize", lambda: Datagram.deserialize(datagram_bytes)),
+        ("Datagram flag test", sample_datagram().is_syn),
+        ("NetTask_Message deserialize", lambda: NetTask_Message.deserialize(message_bytes)),
+        ("NetTask_Report construct", sample_report),
+        ("NetTask_Report serialize", sample_report().serialize),
+        ("NetTask_Report deserialize", lambda: NetTask_Report.deserialize(report_bytes)),
+        ("Wide report serialize", wide_report.serialize),
+        ("Wide report serialize, interned", lambda: wide_report.serialize(symbols)),
+        ("Wide report deserialize", lambda: NetTask_Report.deserialize(wide_bytes)),
+        ("Wide report deserialize, interned", lambda: NetTask_Report.deserialize(interned_bytes, symbols)),
+        ("AlertFlow_Report construct", sample_alertflow),
+        ("AlertFlow_Report serialize", sample_alertflow().serialize),
+        ("AlertFlow_Report deserialize", lambda: AlertFlow_Report.deserialize(alertflow_bytes)),
+        (f"AlertFlow stream, {STREAM_BURST} per read", lambda: AlertFlow_Stream().feed(alertflow_burst)),
+        ("Full report decode (3 layers)", lambda: NetTask_Message.deserialize(Datagram.deserialize(datagram_bytes).payload).report()),
+    ]
+
+    print(f"{'Operation':32} {'us/op':>8}")
+    for name, func in timings:
+        print(f"{name:32} {microseconds(func, iterations):8.2f}")
+
+    print(f"\n{'Retained object':32} {'B/obj':>8}")
+    for name, factory in [
+        ("Datagram", lambda: sample_datagram(b'')),
+        ("NetTask_Report", sample_report),
+        ("AlertFlow_Report", sample_alertflow),
+    ]:
+        print(f"{name:32} {bytes_per_object(factory):8.0f}")
+
+    print(f"\n{'Wire size':32} {'B':>8}")
+    for name, size in [
+        ("NetTask_Report", len(report_bytes)),
+        ("AlertFlow_Report", len(alertflow_bytes)),
+        ("Datagram carrying a report", len(datagram_bytes)),
+        (f"Report, {INTERFACES} interfaces", len(wide_bytes)),
+        (f"Report, {INTERFACES} interfaces, interned", len(interned_bytes)),
+    ]:
+        print(f"{name:32} {size:8}")
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) == 2 else ITERATIONS)
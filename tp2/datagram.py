@@ -1,39 +1,74 @@
-from collections import namedtuple
-from random import randint
-from msgpack import packb, unpackb
+from struct import Struct
+from wire_codec import pack, unpack, trimmed
 from zlib_ng.zlib_ng import compress, decompress
 
 
-Flags = namedtuple('Flags', 'syn ack fin')
-Location = namedtuple('Location', 'addr port')
+# Datagram flags, combined into one int
+SYN = 0b001
+ACK = 0b010
+FIN = 0b100
+HBT = 0b1000 # heartbeat, answered by the socket wrapper itself and never seen by the layers above
+PSH = 0b10000 # the sender waits on this one, so it shouldn't sit in the receiver's delayed-ack timer
+
+# Layered messages are sent as [header length][msgpack header][raw payload] instead of a msgpack map holding the payload,
+# so that after decompressing the payload can be handed to the next layer as a memoryview slice instead of a copied bytes object.
+HEADER_LENGTH = Struct('!H')
+
+def frame_payload(header, payload) -> bytes:
+    packed_header = pack(header)
+    return compress(b''.join((HEADER_LENGTH.pack(len(packed_header)), packed_header, payload or b'')))
+
+def unframe_payload(data) -> tuple:
+    view = memoryview(decompress(data))
+    header_end = HEADER_LENGTH.size + HEADER_LENGTH.unpack_from(view)[0]
+    return unpack(view[HEADER_LENGTH.size:header_end]), view[header_end:]
 
 class Datagram:
 
+    # Slotted and flat: no per-instance dict and no namedtuples per packet, flags are a single int bitfield
+
+    __slots__ = ('origin_addr', 'origin_port', 'dest_addr', 'dest_port', 'flags', 'seqnr', 'acknr', 'payload', 'sack', 'window', 'age', 'handed_at')
+
     def __init__(
             self,
             origin_addr, origin_port,
             dest_addr, dest_port,
-            flags: Flags,
+            flags: int,
             seqnr: int,
             acknr: int,
-            payload: bytes = b''
+            payload: bytes = b'',
+            sack: list = None,
+            window: int = None,
+            age: float = None
         ):
 
-        self.origin: Location = Location(addr=origin_addr, port=origin_port)
-        self.dest: Location = Location(addr=dest_addr, port=dest_port)
+        self.origin_addr: str = origin_addr
+        self.origin_port: int = origin_port
+        self.dest_addr: str = dest_addr
+        self.dest_port: int = dest_port
 
-        self.flags: Flags = flags
+        self.flags: int = flags
         self.seqnr: int = seqnr
         self.acknr: int = acknr
-        self.payload: bytes = payload
+        self.payload: bytes = payload # memoryview when deserialized
+        self.sack: list = sack        # [start, end] seqnr ranges received beyond acknr, only on acks sent past a hole
+        self.window: int = window     # datagrams the receiver takes in flight, only on acks of receivers doing flow control
+        self.age: float = age         # seconds the payload had been with the sender when this copy left, on windowed data
+        self.handed_at: float = None  # sender side only, when the payload was handed over, retransmissions age from there
 
     def __str__(self):
         
-        def bin(boolean):
-            return 1 if boolean else 0
-
-        flags_str = f"s{bin(self.flags.syn)}a{bin(self.flags.ack)}f{bin(self.flags.fin)}"
-        finalstr = f"[Dgram {self.origin.port}->{self.dest.port}] {flags_str} - SeqNr{self.seqnr} AckNr{self.acknr} - Payload {self.payload_size()} B"
+        def bin(flag):
+            return 1 if self.flags & flag else 0
+
+        flags_str = f"s{bin(SYN)}a{bin(ACK)}f{bin(FIN)}h{bin(HBT)}p{bin(PSH)}"
+        finalstr = f"[Dgram {self.origin_port}->{self.dest_port}] {flags_str} - SeqNr{self.seqnr} AckNr{self.acknr} - Payload {self.payload_size()} B"
+        if self.sack:
+            finalstr += f" - SACK {self.sack}"
+        if self.window is not None:
+            finalstr += f" - Window {self.window}"
+        if self.age is not None:
+            finalstr += f" - Age {self.age * 1000:.1f} ms"
         return finalstr
 
     #####################################################################################################
@@ -44,67 +79,61 @@ class Datagram:
     #####################################################################################################
     
     def serialize(self):
-            
-        def to_dict(self):
-            
-            flags = [
-                self.flags.syn,
-                self.flags.ack,
-                self.flags.fin
-            ]
-
-            d = {
-                'o': [self.origin.addr, self.origin.port],
-                'd': [self.dest.addr, self.dest.port],
-                'f': flags,
-                's': self.seqnr,
-                'a': self.acknr,
-                'p': self.payload or b''
-            }
-
-            #for k,v in d.items():
-            #    print(type(v), v)
-
-            return d    
-
-        return compress(packb(to_dict(self), use_bin_type=True, strict_types=True))
+        # Header fields in constructor order, then the optional ones: most acks have no SACK ranges to add,
+        # and the age goes in microseconds, an int packs smaller than a float
+        return frame_payload(trimmed([
+            self.origin_addr, self.origin_port,
+            self.dest_addr, self.dest_port,
+            self.flags,
+            self.seqnr,
+            self.acknr,
+            self.sack or None,
+            self.window,
+            round(self.age * 1e6) if self.age is not None else None
+        ]), self.payload)
 
     @classmethod
-    def deserialize(cls, data: bytes):
-        # Decompress and unpack the data
-        unpacked_data = unpackb(decompress(data))
-
-        # Recreate the Flags namedtuple from the unpacked dictionary
-        flags = Flags(
-            unpacked_data['f'][0],
-            unpacked_data['f'][1],
-            unpacked_data['f'][2]
-            )
-
-        # Create a new Datagram object with the unpacked data
-        return cls(
-            unpacked_data['o'][0], unpacked_data['o'][1],
-            unpacked_data['d'][0], unpacked_data['d'][1],
-            flags,
-            unpacked_data['s'],
-            unpacked_data['a'],
-            unpacked_data['p']
-            )
+    def deserialize(cls, data):
+        # Decompress and unpack the header, the payload stays a view over the decompressed buffer
+        header, payload = unframe_payload(data)
+        if type(header) is dict:
+            header = legacy_header(header)
+
+        # The constructor's defaults stand in for optional fields that were left out
+        datagram = cls(*header[:7], payload, *header[7:9])
+        if len(header) > 9:
+            datagram.age = header[9] / 1e6
+        return datagram
 
     #####################################################################################################
 
+    def is_ack(self):
+        return self.flags & ACK != 0
+
     def is_syn(self):
-        return self.flags.syn == True and self.flags.ack == False
+        return self.flags & (SYN | ACK) == SYN
     
     def is_synack(self):
-        return self.flags.syn == True and self.flags.ack == True
+        return self.flags & (SYN | ACK) == SYN | ACK
 
     def is_fin(self):
-        return self.flags.fin == True and self.flags.ack == False
+        return self.flags & (FIN | ACK) == FIN
     
     def is_finack(self):
-        return self.flags.fin == True and self.flags.ack == True
-    
+        return self.flags & (FIN | ACK) == FIN | ACK
+
+    def is_heartbeat(self):
+        return self.flags & HBT != 0
 
+    def is_push(self):
+        return self.flags & PSH != 0
+
+    def seq_end(self):
+        # The seqnr that follows this datagram, what acknowledging it means
+        return self.seqnr + self.payload_size() + 1
+    
 
 
+def legacy_header(d: dict) -> list:
+    # The map headers were sent in before they were positional
+    return trimmed([*d['o'], *d['d'], d['f'], d['s'], d['a'], d.get('k'), d.get('w'), d.get('y')])
@@ -0,0 +1,335 @@
+from datagram import Datagram
+from utils import NETTASK_SERVER_PORT, get_local_addr
+
+from typing import Dict, Tuple, Callable
+from threading import Thread, Condition, Lock
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM, SHUT_WR
+from heapq import heappush, heappop
+from time import perf_counter, sleep
+
+import random
+
+REORDER_HOLD = 0.02        # extra delay for a packet picked to be reordered, long enough for the next ones to overtake it
+TCP_RELAY_CHUNK = 64 * 1024
+UDP_MAX_SIZE = 65535
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Impairment:
+
+    # What a link does to the traffic crossing it in one direction. Probabilities are per packet, times in seconds,
+    # bandwidth in bits per second (0 means unlimited).
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0, reorder=0.0, bandwidth=0):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.bandwidth = bandwidth
+
+    def __str__(self):
+        parts = [
+            f"loss {self.loss:.0%}" if self.loss else "",
+            f"delay {self.delay*1000:g}±{self.jitter*1000:g} ms" if self.delay or self.jitter else "",
+            f"dup {self.duplicate:.0%}" if self.duplicate else "",
+            f"reorder {self.reorder:.0%}" if self.reorder else "",
+            f"{self.bandwidth/1e6:g} Mbit/s" if self.bandwidth else ""
+        ]
+        return ", ".join(p for p in parts if p) or "clean"
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Impaired_Link:
+
+    # Every packet crossing the link is scheduled for release according to the impairment, a single thread sends them
+    # when due. Stream chunks (TCP) are never lost, duplicated or reordered, only delayed and rate limited, like TCP would see it.
+    # The random generator is seeded, so a scenario misbehaves the same way on every run.
+
+    def __init__(self, impairment: Impairment, seed=None):
+        self.impairment = impairment
+        self.random = random.Random(seed)
+        self.condition = Condition()
+        self.queue = []            # heap of (release time, arrival order, send, data)
+        self.order = 0
+        self.busy_until = 0.0      # when the bandwidth limiter is done serializing what's already queued
+        self.last_stream_release = 0.0
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+        self.thread = Thread(target=self.release_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, send: Callable[[bytes], None], data: bytes, stream=False):
+        impairment, rnd = self.impairment, self.random
+
+        if not stream and rnd.random() < impairment.loss:
+            self.dropped += 1
+            return
+
+        copies = 1
+        if not stream and rnd.random() < impairment.duplicate:
+            copies = 2
+            self.duplicated += 1
+
+        now = perf_counter()
+        with self.condition:
+            for _ in range(copies):
+                departure = now
+                if impairment.bandwidth:
+                    self.busy_until = max(now, self.busy_until) + len(data) * 8 / impairment.bandwidth
+                    departure = self.busy_until
+
+                release = departure + max(0.0, impairment.delay + rnd.uniform(-impairment.jitter, impairment.jitter))
+                if stream:
+                    release = self.last_stream_release = max(release, self.last_stream_release)
+                elif rnd.random() < impairment.reorder:
+                    release += REORDER_HOLD
+                    self.reordered += 1
+
+                heappush(self.queue, (release, self.order, send, data))
+                self.order += 1
+            self.condition.notify()
+
+    def release_forever(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    wait = self.queue[0][0] - perf_counter()
+                    if wait <= 0:
+                        _, _, send, data = heappop(self.queue)
+                        break
+                    self.condition.wait(wait)
+
+            try:
+                send(data)
+                self.forwarded += 1
+            except OSError:
+                pass # that end is gone
+
+    def stats(self) -> Dict[str, int]:
+        return {'forwarded': self.forwarded, 'dropped': self.dropped, 'duplicated': self.duplicated, 'reordered': self.reordered}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def sender(sock: socket, dest: Tuple[str, int]) -> Callable[[bytes], None]:
+    return lambda data: sock.sendto(data, dest)
+
+class Impairment_Proxy:
+
+    # Sits between agents and a server. Agents are pointed at the proxy's port instead of the server's. Every datagram is
+    # rewritten so each end believes the proxy is the other one: the addresses live in the Datagram header, and
+    # the server hands out a worker port per session, so each server endpoint gets a mirror socket on the agents' side
+    # and each agent a mirror socket on the server's side. The AlertFlow TCP connection to a worker port is relayed
+    # from the same port number of its mirror. Agent->server and server->agent traffic cross separate impaired links.
+
+    def __init__(
+            self, server_host, server_port=NETTASK_SERVER_PORT, listen_addr='127.0.0.1', listen_port=0,
+            upstream: Impairment = None, downstream: Impairment = None, seed=0
+        ):
+
+        self.server = (server_host, server_port)
+        self.listen_addr = listen_addr
+        self.server_side_addr = get_local_addr(server_host)
+
+        self.up = Impaired_Link(upstream or Impairment(), seed)
+        self.down = Impaired_Link(downstream or Impairment(), seed + 1)
+
+        self.lock = Lock()
+        self.server_mirrors: Dict[Tuple[str, int], socket] = {} # server endpoint -> socket agents talk to
+        self.agent_mirrors: Dict[Tuple[str, int], socket] = {}  # agent endpoint -> socket the server talks to
+        self.sockets = []
+
+        self.port = self.mirror_server(self.server, listen_port).getsockname()[1]
+
+    ###########################################################################################################
+
+    def mirror_server(self, endpoint: Tuple[str, int], port=0) -> socket:
+        with self.lock:
+            if endpoint in self.server_mirrors:
+                return self.server_mirrors[endpoint]
+
+            mirror = socket(AF_INET, SOCK_DGRAM)
+            mirror.bind((self.listen_addr, port))
+            listener = socket(AF_INET, SOCK_STREAM)
+            listener.bind(mirror.getsockname()) # agents connect AlertFlow to the same port number they send reports to
+            listener.listen()
+
+            self.server_mirrors[endpoint] = mirror
+            self.sockets += [mirror, listener]
+
+        Thread(target=self.relay_upstream, args=(mirror, endpoint), daemon=True).start()
+        Thread(target=self.accept_streams, args=(listener, endpoint), daemon=True).start()
+        return mirror
+
+    def mirror_agent(self, endpoint: Tuple[str, int]) -> socket:
+        with self.lock:
+            if endpoint in self.agent_mirrors:
+                return self.agent_mirrors[endpoint]
+
+            mirror = socket(AF_INET, SOCK_DGRAM)
+            mirror.bind((self.server_side_addr, 0))
+            self.agent_mirrors[endpoint] = mirror
+            self.sockets.append(mirror)
+
+        Thread(target=self.relay_downstream, args=(mirror, endpoint), daemon=True).start()
+        return mirror
+
+    def rewrite(self, data: bytes, origin: Tuple[str, int], dest: Tuple[str, int]) -> bytes:
+        datagram = Datagram.deserialize(data)
+        datagram.origin_addr, datagram.origin_port = origin
+        datagram.dest_addr, datagram.dest_port = dest
+        return datagram.serialize()
+
+    ###########################################################################################################
+
+    def relay_upstream(self, mirror: socket, server_endpoint: Tuple[str, int]):
+        while True:
+            try:
+                data, agent = mirror.recvfrom(UDP_MAX_SIZE)
+            except OSError:
+                return
+            agent_mirror = self.mirror_agent(agent)
+            try:
+                data = self.rewrite(data, agent_mirror.getsockname(), server_endpoint)
+            except Exception:
+                continue # not a datagram of ours
+            self.up.submit(sender(agent_mirror, server_endpoint), data)
+
+    def relay_downstream(self, mirror: socket, agent: Tuple[str, int]):
+        while True:
+            try:
+                data, server_endpoint = mirror.recvfrom(UDP_MAX_SIZE)
+            except OSError:
+                return
+            # The first datagram from a new worker port gets that port mirrored before the agent learns about it
+            server_mirror = self.mirror_server(server_endpoint)
+            try:
+                data = self.rewrite(data, server_mirror.getsockname(), agent)
+            except Exception:
+                continue
+            self.down.submit(sender(server_mirror, agent), data)
+
+    def accept_streams(self, listener: socket, server_endpoint: Tuple[str, int]):
+        while True:
+            try:
+                agent_conn, agent = listener.accept()
+            except OSError:
+                return
+
+            # The server only accepts the AlertFlow connection from the address and port the session started from
+            server_conn = socket(AF_INET, SOCK_STREAM)
+            try:
+                server_conn.bind(self.mirror_agent(agent).getsockname())
+                server_conn.connect(server_endpoint)
+            except OSError:
+                agent_conn.close()
+                server_conn.close()
+                continue
+
+            self.sockets += [agent_conn, server_conn]
+            Thread(target=self.pump, args=(agent_conn, server_conn, self.up), daemon=True).start()
+            Thread(target=self.pump, args=(server_conn, agent_conn, self.down), daemon=True).start()
+
+    def pump(self, source: socket, dest: socket, link: Impaired_Link):
+        while True:
+            try:
+                chunk = source.recv(TCP_RELAY_CHUNK)
+            except OSError:
+                chunk = b''
+            if not chunk:
+                link.submit(lambda _: dest.shutdown(SHUT_WR), b'', stream=True)
+                return
+            link.submit(dest.sendall, chunk, stream=True)
+
+    ###########################################################################################################
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {'upstream': self.up.stats(), 'downstream': self.down.stats()}
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    if len(sys.argv) not in {2, 3, 4}:
+        print("Usage: python3 impairment_proxy.py <server_host> [loss] [delay_ms]")
+        sys.exit(1)
+
+    # Standalone proxy with the same impairment both ways, agents then run: testclient.py 127.0.0.1 <deviceID> with the printed port
+    impairment = Impairment(
+        loss=float(sys.argv[2]) if len(sys.argv) >= 3 else 0.0,
+        delay=float(sys.argv[3]) / 1000 if len(sys.argv) == 4 else 0.0
+    )
+    proxy = Impairment_Proxy(sys.argv[1], upstream=impairment, downstream=impairment, listen_port=NETTASK_SERVER_PORT)
+    print(f"Relaying 127.0.0.1:{proxy.port} -> {sys.argv[1]}:{NETTASK_SERVER_PORT} ({impairment})")
+
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        print(proxy.stats())
+        proxy.close()
@@ -0,0 +1,246 @@
+from nettask_report import NetTask_Report
+from alertflow_report import AlertFlow_Report
+
+from typing import Dict, List, Tuple
+from threading import Thread, Lock
+from queue import Queue, Empty
+from time import time, perf_counter
+from zlib import crc32
+
+INGEST_WRITERS = 2
+INGEST_QUEUE_SIZE = 1024    # per writer, once full the receiving thread waits: backpressure instead of unbounded memory
+INGEST_BATCH_MAX = 256      # items handed to the store in one go at most
+INGEST_BATCH_WINDOW = 0.02  # seconds a writer waits for more items before writing what it has
+LATENCY_SMOOTHING = 0.1     # weight of the newest sample in each stage's moving average
+
+ingest_stages = ['receive', 'queue', 'write']
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Stage_Timer:
+
+    # Moving average and last value of one stage's latency, cheap enough to record for every item
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.average = 0.0
+        self.last = 0.0
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.count += 1
+            self.last = seconds
+            self.average = seconds if self.count == 1 else self.average + LATENCY_SMOOTHING * (seconds - self.average)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            return {'count': self.count, 'avg_ms': round(self.average * 1e3, 3), 'last_ms': round(self.last * 1e3, 3)}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Ingest_Pipeline:
+
+    # Sits between the workers' receive threads and the report store. A receive thread decodes and acks,
+    # submits, and goes back to its socket; writer threads pick the items up and store them in batches.
+    # Items are routed to a writer by deviceID, so a device's files are only ever touched by one thread
+    # and its reports keep their order. Stored reports also go into the rollups and the anomaly detector, if there are any,
+    # and how long each item took per device into the latency histograms (see latency_tracing). Stages:
+    #   receive: datagram off the socket -> decoded, acked and submitted
+    #   queue:   submitted -> picked up by a writer
+    #   write:   one batch handed to the store
+
+    def __init__(self, store, writers: int = INGEST_WRITERS, queue_size: int = INGEST_QUEUE_SIZE, verbose: bool = True, rollups = None, detector = None, latency = None):
+        self.store = store
+        self.latency = latency
+        self.rollups = rollups
+        self.detector = detector
+        self.verbose = verbose
+        self.queues: List[Queue] = [Queue(maxsize=queue_size) for _ in range(writers)]
+        self.timers: Dict[str, Stage_Timer] = {stage: Stage_Timer() for stage in ingest_stages}
+
+        self.writer_threads = [
+            Thread(target=self.write_forever, args=(queue,), daemon=True, name=f"ingest-writer-{i}")
+            for i, queue in enumerate(self.queues)
+        ]
+        for thread in self.writer_threads:
+            thread.start()
+
+    def submit_report(self, report: NetTask_Report, received_at: float, timestamp: float = None, age: float = 0.0):
+        self.submit('report', report.deviceID, report, received_at, timestamp, age)
+
+    def submit_spike(self, report: AlertFlow_Report, received_at: float, age: float = 0.0):
+        self.submit('spike', report.deviceID(), report, received_at, age=age)
+
+    def submit(self, kind: str, deviceID: str, report, received_at: float, timestamp: float = None, age: float = 0.0):
+        # received_at is the perf_counter() reading taken when the report came off the socket,
+        # timestamp the wall clock time it's stored with (now, unless it was received somewhere else first),
+        # age the seconds it had spent since its measurement before it was received, as far as they're known
+        submitted_at = perf_counter()
+        self.timers['receive'].record(submitted_at - received_at)
+        entry = (kind, timestamp if timestamp is not None else time(), submitted_at, report, received_at, age)
+        self.queues[crc32(deviceID.encode()) % len(self.queues)].put(entry)
+
+    ###########################################################################################################
+
+    def write_forever(self, queue: Queue):
+        closing = False
+
+        while not closing:
+            first = queue.get()
+            if first is None:
+                queue.task_done()
+                break
+            batch = [first]
+
+            deadline = perf_counter() + INGEST_BATCH_WINDOW
+            while len(batch) < INGEST_BATCH_MAX:
+                try:
+                    item = queue.get(timeout=max(0, deadline - perf_counter()))
+                except Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            picked_up_at = perf_counter()
+            for _, _, submitted_at, _, _, _ in batch:
+                self.timers['queue'].record(picked_up_at - submitted_at)
+
+            self.write_batch(batch)
+            stored_at = perf_counter()
+            self.timers['write'].record(stored_at - picked_up_at)
+            if self.latency is not None:
+                self.record_latency(batch, picked_up_at, stored_at)
+
+            for _ in range(len(batch) + closing):
+                queue.task_done()
+
+    def write_batch(self, batch: List[Tuple]):
+        reports = [(ts, report) for kind, ts, _, report, _, _ in batch if kind == 'report']
+        spikes = [(ts, report) for kind, ts, _, report, _, _ in batch if kind == 'spike']
+
+        if self.verbose:
+            for _, report in reports + spikes:
+                print(report)
+
+        # Rollups and the detector only see what the store kept, or they'd tell of reports no query can find
+        stored = False
+        try:
+            if reports:
+                self.store.add_reports(reports)
+                stored = True
+            if spikes: self.store.add_spikes(spikes)
+        except Exception as e:
+            print(f"Failed to store a batch of {len(batch)} items: {e}")
+
+        if not stored:
+            return
+        if self.rollups is not None:
+            self.rollups.add_reports(reports)
+        if self.detector is not None:
+            self.detector.observe([report for _, report in reports])
+
+    def record_latency(self, batch: List[Tuple], picked_up_at: float, stored_at: float):
+        for kind, _, _, report, received_at, age in batch:
+            kind = 'report' if kind == 'report' else 'alert'
+            deviceID = report.deviceID if kind == 'report' else report.deviceID()
+            self.latency.record(kind, 'server_queue', deviceID, picked_up_at - received_at)
+            self.latency.record(kind, 'persist', deviceID, stored_at - picked_up_at)
+            self.latency.record(kind, 'end_to_end', deviceID, age + stored_at - received_at)
+
+    ###########################################################################################################
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def credit(self, deviceID: str, most: int) -> int:
+        # Scales most by how much room is left in the queue this device's items go to, 0 once it's full
+        queue = self.queues[crc32(deviceID.encode()) % len(self.queues)]
+        return most * max(0, queue.maxsize - queue.qsize()) // queue.maxsize
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.depth(),
+            'stages': {stage: timer.snapshot() for stage, timer in self.timers.items()}
+        }
+
+    def flush(self):
+        # Blocks until everything submitted so far went through the store
+        for queue in self.queues:
+            queue.join()
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.writer_threads:
+            thread.join()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    from report_store import Json_Report_Store
+    import tempfile
+
+    # Many devices' worth of reports submitted from several threads, as concurrent server workers would
+    store = Json_Report_Store(tempfile.mkdtemp())
+    pipeline = Ingest_Pipeline(store, verbose=False)
+
+    def agent(deviceID, count=2000):
+        report = NetTask_Report(deviceID, 't1')
+        report.add_measurement('c', 12.5)
+        for _ in range(count):
+            pipeline.submit_report(report, perf_counter())
+
+    start = perf_counter()
+    agents = [Thread(target=agent, args=(f"r{i}",)) for i in range(8)]
+    for a in agents: a.start()
+    for a in agents: a.join()
+    submitted = perf_counter() - start
+    pipeline.flush()
+    stored = perf_counter() - start
+
+    print(f"8 x 2000 reports submitted in {submitted:.2f} s, all stored after {stored:.2f} s")
+    print(pipeline.stats())
+    pipeline.close()
@@ -0,0 +1,97 @@
+from report_rollups import Rollup_Cell
+
+from typing import Dict, Tuple
+from threading import Lock
+
+FLEET = '*' # the device every latency is also recorded under
+
+# Where a report's time goes, from the end of its measurement to the store. Agent stages come in the report itself
+# (as microseconds, no clock sync needed), transport in the datagram that carried it, the rest is measured on the server.
+# The network's one-way delay is the only part that's in no stage: it can't be told apart from clock skew.
+report_stages = {
+    'measure':      "measurement done -> enqueued on the agent",
+    'agent_queue':  "enqueued -> handed to the transport",
+    'transport':    "handed to the transport -> the transmission that got through left (window waits, retransmissions)",
+    'ack':          "received -> acked by the server",
+    'server_queue': "received -> picked up by an ingest writer",
+    'persist':      "picked up -> in the store",
+    'end_to_end':   "measurement done -> in the store, less the network's one-way delay"
+}
+
+# Alerts skip the stages that are NetTask's: they're sent over the AlertFlow TCP connection as soon as they're dequeued.
+# Their measure stage includes any time the agent's alert tracker held them back for its rate limit.
+alert_stages = {stage: report_stages[stage] for stage in ['measure', 'agent_queue', 'server_queue', 'persist', 'end_to_end']}
+
+latency_stages = {'report': report_stages, 'alert': alert_stages}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Latency_Histograms:
+
+    # Per (kind, stage, device) latency distributions, each a rollup cell: count/sum/min/max and a quantile sketch,
+    # so percentiles come out within 1% however many samples went in. Every sample is also recorded under FLEET.
+
+    def __init__(self):
+        self.lock = Lock()
+        self.cells: Dict[Tuple[str, str, str], Rollup_Cell] = {}
+
+    def record(self, kind: str, stage: str, deviceID: str, seconds: float):
+        with self.lock:
+            for device in (deviceID, FLEET):
+                cell = self.cells.get((kind, stage, device))
+                if cell is None:
+                    cell = self.cells[(kind, stage, device)] = Rollup_Cell()
+                cell.add(max(0.0, seconds))
+
+    def record_trace(self, kind: str, deviceID: str, trace) -> float:
+        # The agent's stages as they came in a report, returns how long they took altogether
+        if not trace:
+            return 0.0
+        measure, agent_queue = trace[0] / 1e6, trace[1] / 1e6
+        self.record(kind, 'measure', deviceID, measure)
+        self.record(kind, 'agent_queue', deviceID, agent_queue)
+        return measure + agent_queue
+
+    def snapshot(self, deviceID: str = FLEET) -> Dict[str, Dict[str, Dict[str, float]]]:
+        # kind -> stage -> count and milliseconds (avg, p50, p95, p99, max), for one device or the whole fleet
+        with self.lock:
+            cells = {(kind, stage): cell for (kind, stage, device), cell in self.cells.items() if device == deviceID}
+            summaries = {key: cell.summary() for key, cell in cells.items()}
+
+        snapshot = {}
+        for kind, stages in latency_stages.items():
+            for stage in stages:
+                summary = summaries.get((kind, stage))
+                if summary is None:
+                    continue
+                snapshot.setdefault(kind, {})[stage] = {'count': summary['count']} | {
+                    f"{name}_ms": round(summary[name] * 1000, 2) for name in ('avg', 'p50', 'p95', 'p99', 'max')
+                }
+        return snapshot
+
+    def devices(self):
+        with self.lock:
+            return sorted({device for _, _, device in self.cells if device != FLEET})
+
+    def format(self, deviceID: str = FLEET) -> str:
+        lines = [f"Latency of {'all devices' if deviceID == FLEET else deviceID} (ms):"]
+        for kind, stages in self.snapshot(deviceID).items():
+            for stage, s in stages.items():
+                lines.append(
+                    f" | {kind:6} {stage:12} n={s['count']:<7} avg {s['avg_ms']:9.2f}  p50 {s['p50_ms']:9.2f}  "
+                    f"p95 {s['p95_ms']:9.2f}  p99 {s['p99_ms']:9.2f}  max {s['max_ms']:9.2f}"
+                )
+        return "\n".join(lines)
@@ -1,27 +1,34 @@
 from utils import Colours
 from nettask_task import NetTask_Task
 from nettask_report import NetTask_Report
+from session_symbols import Session_Symbols
 
-from typing import Dict, List
+from datagram import frame_payload, unframe_payload
 
-from msgpack import packb, unpackb
-from zlib_ng.zlib_ng import compress, decompress
+from wire_codec import pack, unpack
+from typing import Dict, List, Tuple
 
 
 nettask_message_tags = {
     't' : 'NT payload has NetTask_Task',
     'f' : 'NT payload has the final NetTask_Task to be sent',
     'r' : 'NT payload has NetTask_Report',
-    'c' : 'NT payload is empty, message sent for deviceID recon'
+    'c' : 'NT payload is empty, message sent for deviceID recon',
+    'b' : 'NT payload has a batch of NetTask_Reports forwarded by a relay',
+    'p' : 'NT payload asks for a profiling window of that many seconds'
 }
 
 
 class NetTask_Message:
 
-    def __init__(self, author:str, tag:str, payload: bytes=b''):
-        self.author = author
+    __slots__ = ('author', 'tag', 'payload', 'symbols', 'decoded_payload')
+
+    def __init__(self, author:str, tag:str, payload: bytes=b'', symbols: List[str]=None):
+        self.author = author   # the agent's symbol once the session has a table (see session_symbols.py)
         self.tag = tag
         self.payload = payload
+        self.symbols = symbols # the session's symbol table, on the final task
+        self.decoded_payload = None # filled in by contains_task/contains_report so the payload is only decoded once
 
     def __str__(self):
         return "\n".join([
@@ -35,19 +42,50 @@ class NetTask_Message:
     def contains_task(self) -> tuple[bool,bool]:
         if self.tag in {'t', 'f'}:
             try:
-                NetTask_Task.deserialize(self.payload)
+                self.decoded_payload = NetTask_Task.deserialize(self.payload)
                 return (True, self.tag=='f')
             except: pass
-        return False
+        return (False, False)
 
-    def contains_report(self) -> bool:
+    def contains_report(self, symbols: Session_Symbols = None) -> bool:
         if self.tag == 'r':
             try:
-                NetTask_Report.deserialize(self.payload)
+                self.decoded_payload = NetTask_Report.deserialize(self.payload, symbols)
+                return True
+            except: pass
+        return False
+
+    def contains_report_batch(self) -> bool:
+        if self.tag == 'b':
+            try:
+                self.decoded_payload = [
+                    (timestamp, NetTask_Report.from_fields(report)) for timestamp, report in unpack(self.payload)
+                ]
                 return True
             except: pass
         return False
 
+    @staticmethod
+    def report_batch_payload(timestamped: List[Tuple[float, NetTask_Report]]) -> bytes:
+        # Reports go in uncompressed, the datagram compresses the whole batch at once and they have a lot in common
+        return pack([[timestamp, report.as_fields()] for timestamp, report in timestamped])
+
+    @staticmethod
+    def profile_request(seconds: float) -> 'NetTask_Message':
+        return NetTask_Message(author='profiler', tag='p', payload=pack(float(seconds)))
+
+    def profile_seconds(self) -> float:
+        return unpack(self.payload) if self.tag == 'p' else None
+
+    def task(self) -> NetTask_Task:
+        return self.decoded_payload if self.decoded_payload is not None else NetTask_Task.deserialize(self.payload)
+
+    def report(self) -> NetTask_Report:
+        return self.decoded_payload if self.decoded_payload is not None else NetTask_Report.deserialize(self.payload)
+
+    def report_batch(self) -> List[Tuple[float, NetTask_Report]]:
+        return self.decoded_payload
+
     def contains_only_header(self) -> bool:
         return self.tag == 'c'
 
@@ -59,20 +97,17 @@ class NetTask_Message:
     ##############################################################################
 
     def serialize(self):
-        return compress(packb({
-            'a': self.author,
-            't': self.tag,
-            'p': self.payload
-        }, use_bin_type=True, strict_types=True))
+        header = [self.author, self.tag]
+        if self.symbols is not None:
+            header.append(self.symbols)
+        return frame_payload(header, self.payload)
 
     @classmethod
-    def deserialize(cls, data: bytes):
-            unpacked_data = unpackb(decompress(data))
-            return cls(
-                author=unpacked_data['a'],
-                tag=unpacked_data['t'],
-                payload=unpacked_data['p']
-            )
+    def deserialize(cls, data):
+            header, payload = unframe_payload(data)
+            if type(header) is dict: # sent as a map before headers were positional
+                header = [header['a'], header['t']]
+            return cls(header[0], header[1], payload, header[2] if len(header) > 2 else None)
     
 
 
@@ -0,0 +1,257 @@
+from typing import Dict, List, Callable
+from utils import Colours
+
+from threading import Thread
+from shutil import which
+
+import asyncio
+import shlex
+import re
+
+from nettask_task import NetTask_Task
+from udp_prober import UDP_Prober
+from throughput_engine import Throughput_Client, parse_iperf_options
+
+PROBE_CONCURRENCY = 4      # maximum ping/iperf processes running at once on this agent
+PROBE_TIMEOUT_MARGIN = 2   # seconds a probe may overrun its report period before being killed
+
+PING_RTT = re.compile(r'time[=<]([\d.]+) ?ms')
+IPERF_BITRATE = re.compile(r'([\d.]+) ([KMG]?)bits/sec')
+IPERF_JITTER = re.compile(r'([\d.]+) ms')
+IPERF_LOSS = re.compile(r'\(([\d.e+-]+)%\)')
+
+bitrate_units = {'': 1e-6, 'K': 1e-3, 'M': 1, 'G': 1e3} # to Mbits/sec
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class NetTask_Probe_Executor:
+
+    # A single executor is shared by every task runner of an agent. Probes are asyncio subprocesses on one event loop,
+    # so probes from different tasks overlap, while the semaphore keeps the agent from spawning more than it can handle.
+
+    def __init__(self, target_host: str, concurrency: int = PROBE_CONCURRENCY, native_probes: bool = False):
+        self.target_host = target_host # probed by tasks that don't name a probe_target of their own
+        self.concurrency = concurrency
+        self.native_probes = native_probes # UDP_Prober and the throughput engine instead of ping/iperf
+        self.native_probers: Dict[str, UDP_Prober] = {} # taskID -> prober
+        self.missing_binaries = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.semaphore: asyncio.Semaphore = asyncio.run_coroutine_threadsafe(self.create_semaphore(), self.loop).result()
+
+    async def create_semaphore(self):
+        # The semaphore has to be created from inside the loop that will use it
+        return asyncio.Semaphore(self.concurrency)
+
+    ###############################################################################
+
+    @staticmethod
+    def wants_probes(task: NetTask_Task) -> bool:
+        return (
+            task.ping_measure_latency or task.iperf_measure_throughput
+            or task.iperf_measure_jitter or task.iperf_measure_packet_loss
+        )
+
+    def target(self, task: NetTask_Task) -> str:
+        return task.probe_target or self.target_host
+
+    def run_probes(self, task: NetTask_Task, duration: int) -> Dict[str, float]:
+        # Called from a runner's measurement thread, which blocks until its own probes are done
+        return asyncio.run_coroutine_threadsafe(self.probe_task(task, duration), self.loop).result()
+
+    async def probe_task(self, task: NetTask_Task, duration: int) -> Dict[str, float]:
+
+        probes = []
+        if self.native_probes:
+            if task.ping_measure_latency or task.iperf_measure_jitter or task.iperf_measure_packet_loss:
+                probes.append(self.native(task))
+            if task.iperf_measure_throughput:
+                probes.append(self.native_throughput(task, duration))
+        else:
+            if task.ping_measure_latency:
+                probes.append(self.ping(task, duration))
+            if task.iperf_measure_throughput or task.iperf_measure_jitter or task.iperf_measure_packet_loss:
+                probes.append(self.iperf(task, duration))
+
+        results = {}
+        for result in await asyncio.gather(*probes, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(Colours.nettask_styling(f"[Task {task.taskID}] Probe failed: {result}"))
+            else:
+                results.update(result)
+
+        return results
+
+    ###############################################################################
+
+    async def ping(self, task: NetTask_Task, duration: int) -> Dict[str, float]:
+
+        options = shlex.split(task.ping_options or '')
+        if '-c' not in options and '-w' not in options:
+            options += ['-c', str(max(1, duration-1))]
+
+        rtts: List[float] = []
+
+        def parse_line(line: str):
+            match = PING_RTT.search(line)
+            if match:
+                rtts.append(float(match.group(1)))
+
+        await self.run_streaming(['ping', *options, self.target(task)], parse_line, duration + PROBE_TIMEOUT_MARGIN)
+
+        # Replies that made it before a timeout still count
+        return {'l': round(sum(rtts)/len(rtts), 2)} if rtts else {}
+
+    async def iperf(self, task: NetTask_Task, duration: int) -> Dict[str, float]:
+
+        options = shlex.split(task.iperf_options or '')
+
+        # The agent is always iperf's client, against the endpoint on the server or the probed peer. As server it's the side
+        # being sent to, same as native throughput tests: reverse mode (-R) has the far end send
+        if task.iperf_as_server and '-R' not in options:
+            options.append('-R')
+        # Jitter and loss are only reported for UDP streams
+        if (task.iperf_measure_jitter or task.iperf_measure_packet_loss) and '-u' not in options:
+            options.append('-u')
+        if '-t' not in options:
+            options += ['-t', str(max(1, duration-1))]
+        argv = ['iperf3', '-c', self.target(task), *options]
+
+        # Interval lines come first and the summary last, so keeping the latest match of each field ends on the summary
+        latest: Dict[str, float] = {}
+
+        def parse_line(line: str):
+            bitrate = IPERF_BITRATE.search(line)
+            if bitrate is None:
+                return
+            latest['b'] = round(float(bitrate.group(1)) * bitrate_units[bitrate.group(2)], 2)
+
+            after_bitrate = line[bitrate.end():]
+            jitter = IPERF_JITTER.search(after_bitrate)
+            if jitter:
+                latest['j'] = float(jitter.group(1))
+            loss = IPERF_LOSS.search(after_bitrate)
+            if loss:
+                latest['p'] = float(loss.group(1))
+
+        await self.run_streaming(argv, parse_line, duration + PROBE_TIMEOUT_MARGIN)
+
+        wanted = {
+            'b': task.iperf_measure_throughput,
+            'j': task.iperf_measure_jitter,
+            'p': task.iperf_measure_packet_loss
+        }
+        return {k: v for k, v in latest.items() if wanted[k]}
+
+    async def native(self, task: NetTask_Task) -> Dict[str, float]:
+
+        prober = self.native_probers.get(task.taskID)
+        if prober is None:
+            prober = self.native_probers[task.taskID] = UDP_Prober(self.target(task))
+
+        async with self.semaphore:
+            results = await asyncio.to_thread(prober.measure)
+
+        wanted = {
+            'l': task.ping_measure_latency,
+            'j': task.iperf_measure_jitter,
+            'p': task.iperf_measure_packet_loss
+        }
+        return {k: v for k, v in results.items() if wanted[k]}
+
+    async def native_throughput(self, task: NetTask_Task, duration: int) -> Dict[str, float]:
+
+        protocol, bitrate = parse_iperf_options(task.iperf_options)
+        client = Throughput_Client(self.target(task))
+
+        # iperf_as_server keeps its meaning: the agent is the side being sent to
+        async with self.semaphore:
+            results = await asyncio.to_thread(
+                client.run, not task.iperf_as_server, protocol, bitrate, max(1, duration-1)
+            )
+
+        return {'b': results['mbps']}
+
+    ###############################################################################
+
+    async def run_streaming(self, argv: List[str], parse_line: Callable[[str], None], timeout: float):
+
+        if which(argv[0]) is None:
+            if argv[0] not in self.missing_binaries:
+                self.missing_binaries.add(argv[0])
+                print(Colours.nettask_styling(f"[Probes] {argv[0]} isn't installed, its measurements will be skipped."))
+            return
+
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+
+            async def consume():
+                # Parsing line by line as the output arrives, a killed probe still leaves its partial results behind
+                async for line in process.stdout:
+                    parse_line(line.decode(errors='replace'))
+                await process.wait()
+
+            try:
+                await asyncio.wait_for(consume(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    from time import time
+
+    task_data = {
+        "taskID": "t1",
+        "report_frequency": 3,
+        "ping_measure_latency": True,
+        "iperf_measure_throughput": True,
+        "iperf_measure_jitter": True,
+        "ping_options": "-c 2 -i 0.5"
+    }
+
+    executor = NetTask_Probe_Executor("127.0.0.1")
+    tasks = [NetTask_Task.from_json({**task_data, "taskID": f"t{i}"}) for i in range(3)]
+
+    # Three tasks probing in parallel should take about as long as one
+    begin = time()
+    threads = [Thread(target=lambda t=t: print(t.taskID, executor.run_probes(t, t.report_frequency))) for t in tasks]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    print(f"Elapsed: {time()-begin:.2f}s")
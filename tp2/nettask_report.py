@@ -1,11 +1,12 @@
-from utils import Colours
+from utils import Colours, stage_trace
 from typing import Dict, List
-from copy import deepcopy
+from time import monotonic
 
-from msgpack import packb, unpackb
+from wire_codec import pack, unpack, trimmed, padded
 from zlib_ng.zlib_ng import compress, decompress
 
 from alertflow_report import AlertFlow_Report
+from session_symbols import Session_Symbols
 
 
 
@@ -25,28 +26,54 @@ from alertflow_report import AlertFlow_Report
 
 
 
-all_possible_measurements = ['c', 'r', 't']
+all_possible_measurements = ['c', 'ck', 'cs', 'r', 't', 'l', 'b', 'j', 'p']
 
 measure_labels = {
     'c': "CPU",
+    'ck': "CPU Per Core",
+    'cs': "CPU Per State",
     'r': "RAM",
-    't': "Interface Traffic"
+    't': "Interface Traffic",
+    'l': "Latency",
+    'b': "Throughput",
+    'j': "Jitter",
+    'p': "Packet Loss"
 }
 
+measure_units = {
+    'c': "%",
+    'r': "%",
+    'l': " ms",
+    'b': " Mbits/s",
+    'j': " ms",
+    'p': "%"
+}
+
+# Several samples taken within one period are shipped as these statistics, next to the period's value
+summary_fields = ['min', 'avg', 'max', 'p95']
+
+# Measurements that trigger AlertFlow by crossing a single threshold (interface traffic is checked per interface)
+scalar_alert_measurements = {'c', 'r', 'l', 'j', 'p'}
+
 
 class NetTask_Report:
 
+    __slots__ = ('deviceID', 'taskID', 'measurements', 'summaries', 'stamps', 'trace')
+
     def __init__(self, deviceID, taskID):
         self.deviceID = deviceID
         self.taskID = taskID
         self.measurements: Dict = {}
+        self.summaries: Dict = {} # measurement key -> values in summary_fields order ({iface: values} for 't')
+        self.stamps: Dict[str, float] = {} # agent side only, stage -> monotonic() when the report got there
+        self.trace: List[int] = None       # microseconds measured -> enqueued -> handed to the transport, sent along
     
     def __str__(self):
 
         def format(key, value):
 
-            if key in {'c', 'r'}:
-                return f"{measure_labels[key]}: {value}%"
+            if key in measure_units:
+                return f"{measure_labels[key]}: {value}{measure_units[key]}"
             elif key == 't':
                 return (
                     f"Interfaces:\n | | " + "\n | | ".join(
@@ -54,6 +81,21 @@ class NetTask_Report:
                         for iface, traffic in self.measurements['t'].items()
                     )
                 )
+            elif key == 'ck':
+                return f"{measure_labels[key]}: " + ", ".join(f"{load}%" for load in value)
+            elif key == 'cs':
+                return f"{measure_labels[key]}: " + ", ".join(f"{state} {share}%" for state, share in value.items() if share > 0)
+
+        def format_summary(key, values):
+
+            def fields(values):
+                return ", ".join(f"{field} {value}" for field, value in zip(summary_fields, values))
+
+            if key == 't':
+                return f"Interfaces Summary (packets/s):\n | | " + "\n | | ".join(
+                    f"{iface}: {fields(iface_values)}" for iface, iface_values in values.items()
+                )
+            return f"{measure_labels[key]} Summary: {fields(values)}"
 
         title_str = Colours.nettask_styling(f"[NetTask: Device {self.deviceID} - Task {self.taskID}]")
 
@@ -61,44 +103,75 @@ class NetTask_Report:
             format(key, self.measurements[key]) 
             for key in all_possible_measurements 
             if key in self.measurements
+        ] + [
+            format_summary(key, self.summaries[key])
+            for key in all_possible_measurements
+            if key in self.summaries
         ])
 
         return title_str + "\n | " + measurements_str
 
     def to_dict(self):
         
-        return {
+        d = {
             measure_labels[key]: self.measurements[key]
             for key in all_possible_measurements
             if key in self.measurements
         }
 
-    def add_measurement(self, key, value):
-        self.measurements[key] = deepcopy(value) if key == 't' else value
+        for key in all_possible_measurements:
+            if key == 't' and key in self.summaries:
+                d[f"{measure_labels[key]} Summary"] = {
+                    iface: dict(zip(summary_fields, values)) for iface, values in self.summaries[key].items()
+                }
+            elif key in self.summaries:
+                d[f"{measure_labels[key]} Summary"] = dict(zip(summary_fields, self.summaries[key]))
 
-    def serialize(self) -> bytes:
-        data = {
-            'di': self.deviceID,
-            'ti': self.taskID,
-            'm': self.measurements
-        }
+        return d
 
-        return compress(packb(data, use_bin_type=True, strict_types=True))
+    # Runners keep reusing their containers, so we hold on to shallow copies (deepcopy dominated construction time)
+    def add_measurement(self, key, value):
+        self.measurements[key] = value.copy() if isinstance(value, (dict, list)) else value
 
-    @staticmethod
-    def deserialize(data: bytes) -> 'NetTask_Report':
+    def add_summary(self, key, values):
+        self.summaries[key] = {k: list(v) for k, v in values.items()} if isinstance(values, dict) else list(values)
 
-        unpacked_data = unpackb(decompress(data), raw=False)
+    def stamp(self, stage: str):
+        self.stamps[stage] = monotonic()
 
-        nettask_report = NetTask_Report(
-            deviceID=unpacked_data['di'],
-            taskID=unpacked_data['ti']
-        )
+    def close_trace(self):
+        # Called as it's handed to the transport, the agent's stages go along so the server needs no synced clock
+        self.trace = stage_trace(self.stamps)
 
-        nettask_report.measurements = unpacked_data['m']
+    def as_fields(self) -> List:
+        # Positional, what's optional last: summaries, then the trace
+        return trimmed([self.deviceID, self.taskID, self.measurements, self.summaries or None, self.trace])
+
+    @staticmethod
+    def from_fields(fields, symbols: Session_Symbols = None) -> 'NetTask_Report':
+        if type(fields) is dict: # sent as a map before reports were positional
+            fields = [fields['di'], fields['ti'], fields['m'], fields.get('s'), fields.get('tr')]
+        elif symbols is not None:
+            fields = symbols.expand(fields)
+        elif type(fields[0]) is int:
+            raise ValueError("Interned report without its session's symbols")
+        deviceID, taskID, measurements, summaries, trace = padded(fields, 5)
+
+        nettask_report = NetTask_Report(deviceID=deviceID, taskID=taskID)
+        nettask_report.measurements = measurements
+        nettask_report.summaries = summaries or {}
+        nettask_report.trace = trace
 
         return nettask_report
 
+    def serialize(self, symbols: Session_Symbols = None) -> bytes:
+        fields = self.as_fields()
+        return compress(pack(symbols.intern(fields) if symbols is not None else fields))
+
+    @staticmethod
+    def deserialize(data: bytes, symbols: Session_Symbols = None) -> 'NetTask_Report':
+        return NetTask_Report.from_fields(unpack(decompress(data)), symbols)
+
     def attempt_alertflow_report(self, alertflow_thresholds: Dict[str, int]):
 
         def exceeds_threshold(measure, result):
@@ -107,9 +180,9 @@ class NetTask_Report:
             threshold = threshold if threshold is not None else float('inf')
             return result >= threshold
 
-        # Get spike types for CPU and RAM
+        # Get spike types for CPU, RAM and the ping/iperf probes
         spike_types = list(
-            filter(lambda measure: measure in {'c', 'r'} and exceeds_threshold(measure, self.measurements[measure]),
+            filter(lambda measure: measure in scalar_alert_measurements and exceeds_threshold(measure, self.measurements[measure]),
                 self.measurements.keys())
         )
 
@@ -0,0 +1,243 @@
+from typing import Dict, List
+from time import perf_counter, sleep
+from array import array
+
+import psutil
+
+SAMPLE_INTERVAL = 0.1 # seconds between samples inside a report period (10 Hz)
+
+# cpu_times fields that count as not doing anything, and the guest ones that Linux already folds into user/nice
+idle_states = {'idle', 'iowait'}
+guest_states = {'guest', 'guest_nice'}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    # Nearest-rank, exact for the few hundred samples a period holds
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1, max(0, round(fraction * len(ordered)) - 1))]
+
+def summarize(samples: List[float]) -> List[float]:
+    # In the order of nettask_report.summary_fields
+    if not samples:
+        return []
+    return [
+        round(min(samples), 1),
+        round(sum(samples)/len(samples), 1),
+        round(max(samples), 1),
+        round(percentile(samples, 0.95), 1)
+    ]
+
+def cpu_deltas(before, after) -> Dict[str, float]:
+    return {
+        state: getattr(after, state) - getattr(before, state)
+        for state in after._fields
+        if state not in guest_states
+    }
+
+def busy_percent(before, after) -> float:
+    deltas = cpu_deltas(before, after)
+    total = sum(deltas.values())
+    if total <= 0:
+        return 0.0
+    idle = sum(deltas.get(state, 0) for state in idle_states)
+    return 100 * (total - idle) / total
+
+def machine_times(per_core):
+    # Sums the per-core namedtuples into one of the same type, so busy_percent works on the whole machine too
+    return type(per_core[0])(*(sum(states) for states in zip(*per_core)))
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Sample_Buffer:
+
+    # Fixed-size array of doubles refilled every period, so sampling at 10 Hz doesn't grow lists or box floats
+
+    def __init__(self, capacity: int):
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0
+
+    def append(self, value: float):
+        if self.count < len(self.values):
+            self.values[self.count] = value
+            self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def mean(self) -> float:
+        return sum(self.values[:self.count]) / self.count if self.count else 0.0
+
+    def summary(self) -> List[float]:
+        return summarize(self.values[:self.count])
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Load_Sampler:
+
+    # CPU, RAM and interface traffic for a task, sampled at high resolution by the runner's own thread instead of a
+    # sleeping thread per metric. Each period ships one value per metric plus min/avg/max/p95 over its samples.
+    # CPU load comes from cpu_times deltas: the snapshot closing a period opens the next one, so no time goes unaccounted.
+
+    def __init__(self, measure_cpu: bool, measure_ram: bool, interfaces: List[str] = None, interval: float = SAMPLE_INTERVAL):
+        self.measure_cpu = measure_cpu
+        self.measure_ram = measure_ram
+        self.interfaces = interfaces or []
+        self.interval = interval
+
+        self.cpu_boundary = psutil.cpu_times(percpu=True) if measure_cpu else None
+        self.iface_boundary = self.iface_packets() if self.interfaces else None
+
+        self.capacity = 0
+        self.cpu_samples: Sample_Buffer = None
+        self.ram_samples: Sample_Buffer = None
+        self.iface_samples: Dict[str, Sample_Buffer] = {}
+
+    def iface_packets(self) -> Dict[str, int]:
+        counters = psutil.net_io_counters(pernic=True)
+        return {
+            iface: counters[iface].packets_recv + counters[iface].packets_sent
+            for iface in self.interfaces if iface in counters
+        }
+
+    def allocate(self, ticks: int):
+        # Only reallocates if a period ever needs more room than the last one
+        if ticks <= self.capacity:
+            for buffer in [self.cpu_samples, self.ram_samples, *self.iface_samples.values()]:
+                if buffer is not None: buffer.reset()
+            return
+
+        self.capacity = ticks
+        self.cpu_samples = Sample_Buffer(ticks) if self.measure_cpu else None
+        self.ram_samples = Sample_Buffer(ticks) if self.measure_ram else None
+        self.iface_samples = {iface: Sample_Buffer(ticks) for iface in self.iface_boundary or {}}
+
+    def sample_period(self, duration: float) -> Dict:
+
+        ticks = max(1, round(duration / self.interval))
+        self.allocate(ticks)
+
+        start = perf_counter()
+        previous_time = start
+        previous_cpu = self.cpu_boundary
+        previous_machine_cpu = machine_times(previous_cpu) if self.measure_cpu else None
+        previous_ifaces = self.iface_boundary
+
+        for tick in range(1, ticks+1):
+            # Sleeping towards absolute deadlines keeps the period from drifting by the sampling cost
+            remaining = start + tick*self.interval - perf_counter()
+            if remaining > 0:
+                sleep(remaining)
+
+            now = perf_counter()
+
+            if self.measure_cpu:
+                current_cpu = psutil.cpu_times(percpu=True)
+                current_machine_cpu = machine_times(current_cpu)
+                self.cpu_samples.append(busy_percent(previous_machine_cpu, current_machine_cpu))
+                previous_cpu, previous_machine_cpu = current_cpu, current_machine_cpu
+
+            if self.measure_ram:
+                self.ram_samples.append(psutil.virtual_memory().percent)
+
+            if self.interfaces:
+                current_ifaces = self.iface_packets()
+                elapsed = (now - previous_time) or self.interval
+                for iface, buffer in self.iface_samples.items():
+                    # An interface that went away (unplugged, VPN down) skips the tick and keeps its last count.
+                    # One that comes back recreated starts from 0 again, so no negative rates either
+                    if iface not in current_ifaces:
+                        current_ifaces[iface] = previous_ifaces[iface]
+                        continue
+                    buffer.append(max(0, current_ifaces[iface] - previous_ifaces[iface]) / elapsed)
+                previous_ifaces = current_ifaces
+
+            previous_time = now
+
+        results = {'summaries': {}}
+
+        if self.measure_cpu:
+            period_start, self.cpu_boundary = self.cpu_boundary, previous_cpu
+            before, after = machine_times(period_start), previous_machine_cpu
+            period_total = cpu_deltas(before, after)
+            total = sum(period_total.values()) or 1
+
+            results['c'] = round(busy_percent(before, after), 1)
+            results['ck'] = [round(busy_percent(core_before, core_after), 1) for core_before, core_after in zip(period_start, previous_cpu)]
+            results['cs'] = {state: round(100 * value / total, 1) for state, value in period_total.items()}
+            results['summaries']['c'] = self.cpu_samples.summary()
+
+        if self.measure_ram:
+            results['r'] = round(self.ram_samples.mean(), 1)
+            results['summaries']['r'] = self.ram_samples.summary()
+
+        if self.interfaces:
+            period_start, self.iface_boundary = self.iface_boundary, previous_ifaces
+            period_length = (previous_time - start) or duration
+            results['t'] = {
+                iface: round(max(0, previous_ifaces[iface] - period_start[iface]) / period_length, 1)
+                for iface in self.iface_samples
+            } # map {iterface: bidirectional traffic in packets/second}
+            results['summaries']['t'] = {iface: buffer.summary() for iface, buffer in self.iface_samples.items()}
+
+        return results
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    sampler = Load_Sampler(measure_cpu=True, measure_ram=True, interfaces=list(psutil.net_io_counters(pernic=True).keys()))
+    for _ in range(2):
+        print(sampler.sample_period(2))
@@ -1,9 +1,19 @@
 from typing import List, Optional, NamedTuple
 from collections import namedtuple
+from operator import attrgetter
 
-from msgpack import packb, unpackb
+from wire_codec import pack, unpack
 from zlib_ng.zlib_ng import compress, decompress
 
+# A task goes on the wire as its constructor's arguments in order, read off by one precompiled getter
+task_fields = (
+    'taskID', 'report_frequency', 'measure_cpu', 'measure_ram', 'interfaces', 'iperf_measure_throughput',
+    'iperf_measure_jitter', 'iperf_measure_packet_loss', 'ping_measure_latency', 'iperf_as_server', 'iperf_options',
+    'ping_options', 'alertflow_cpu_percent', 'alertflow_ram_percent', 'alertflow_interface_pps',
+    'alertflow_packetloss_percent', 'alertflow_jitter_ms', 'alertflow_latency_ms', 'probe_target'
+)
+task_getter = attrgetter(*task_fields)
+
 
 
 
@@ -42,7 +52,8 @@ class NetTask_Task:
         alertflow_interface_pps: int = 0, 
         alertflow_packetloss_percent: int = 0, 
         alertflow_jitter_ms: int = 0, 
-        alertflow_latency_ms: int = 0
+        alertflow_latency_ms: int = 0,
+        probe_target: Optional[str] = None
     ):
         self.taskID = taskID
         self.report_frequency = report_frequency
@@ -62,6 +73,7 @@ class NetTask_Task:
         self.alertflow_packetloss_percent = alertflow_packetloss_percent
         self.alertflow_jitter_ms = alertflow_jitter_ms
         self.alertflow_latency_ms = alertflow_latency_ms
+        self.probe_target = probe_target # host (or deviceID, resolved by the server) that ping/iperf probe, the server if None
 
     @classmethod
     def from_json(cls, task_data: dict) -> "NetTask_Task":
@@ -84,7 +96,8 @@ class NetTask_Task:
             alertflow_interface_pps=task_data.get("alertflow_interface_pps"),
             alertflow_packetloss_percent=task_data.get("alertflow_packetloss_percent"),
             alertflow_jitter_ms=task_data.get("alertflow_jitter_ms"),
-            alertflow_latency_ms=task_data.get("alertflow_latency_ms")
+            alertflow_latency_ms=task_data.get("alertflow_latency_ms"),
+            probe_target=task_data.get("probe_target")
         )
         
     def __str__(self):
@@ -119,6 +132,8 @@ class NetTask_Task:
             f" |  | Ping:",
             f" |  |  | Latency: {show_threshold(self.ping_measure_latency, self.alertflow_latency_ms, 'ms')}",
             f" |  |  | Options: {self.ping_options if self.ping_options else 'None'}",
+
+            f" |  | Probe Target: {self.probe_target if self.probe_target else 'Server'}",
         ])
 
     def get_alertflow_thresholds(self):
@@ -131,32 +146,31 @@ class NetTask_Task:
             thresholds['r'] = self.alertflow_ram_percent
         if len(self.interfaces) != 0 and self.alertflow_interface_pps is not None:
             thresholds['t'] = self.alertflow_interface_pps
+        if self.ping_measure_latency == True and self.alertflow_latency_ms is not None:
+            thresholds['l'] = self.alertflow_latency_ms
+        if self.iperf_measure_jitter == True and self.alertflow_jitter_ms is not None:
+            thresholds['j'] = self.alertflow_jitter_ms
+        if self.iperf_measure_packet_loss == True and self.alertflow_packetloss_percent is not None:
+            thresholds['p'] = self.alertflow_packetloss_percent
         
         return thresholds
 
     def serialize(self):
-            
-        return compress(packb({
-            'ti': self.taskID,
-            'rf': self.report_frequency,
-            'c' : [self.measure_cpu, self.alertflow_cpu_percent],
-            'r' : [self.measure_ram, self.alertflow_ram_percent],
-            't' : [self.interfaces, self.alertflow_interface_pps],
-            'b' : self.iperf_measure_throughput,
-            'j' : [self.iperf_measure_jitter, self.alertflow_jitter_ms],
-            'p' : [self.iperf_measure_packet_loss, self.alertflow_packetloss_percent],
-            'l' : [self.ping_measure_latency, self.alertflow_latency_ms],
-            's' : self.iperf_as_server,
-            'oi': self.iperf_options,
-            'op': self.ping_options
-        }, use_bin_type=True, strict_types=True))
+        fields = list(task_getter(self))
+        if fields[-1] is None:
+            fields.pop() # no probe_target, same bytes as before there was one
+        return compress(pack(fields))
 
     @classmethod
     def deserialize(cls, serialized_data: bytes) -> "NetTask_Task":
-        # Uncompress and unpack the data
-        data_dict = unpackb(decompress(serialized_data), raw=False)
-        
-        # Extract values from the dictionary and map them back to the NetTask_Task constructor
+        fields = unpack(decompress(serialized_data))
+        if type(fields) is dict:
+            return cls.legacy_deserialize(fields)
+        return cls(*fields)
+
+    @classmethod
+    def legacy_deserialize(cls, data_dict: dict) -> "NetTask_Task":
+        # Tasks were sent as a map before they were positional
         return cls(
             taskID=data_dict['ti'],
             report_frequency=data_dict['rf'],
@@ -232,7 +246,8 @@ if __name__ == "__main__":
         "alertflow_interface_pps": 3000,
         "alertflow_packetloss_percent": 10,
         "alertflow_jitter_ms": 20,
-        "alertflow_latency_ms": 50
+        "alertflow_latency_ms": 50,
+        "probe_target": "r4"  # Probes r4 instead of the server
     }
 
     # Create NetTask_Task object from JSON
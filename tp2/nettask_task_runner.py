@@ -3,12 +3,36 @@ from utils import timewindow, Colours
 
 from threading import Thread
 from copy import deepcopy
+from functools import lru_cache
 
 import psutil
 from time import sleep
 
 from nettask_task import NetTask_Task
 from nettask_report import NetTask_Report
+from nettask_probe_executor import NetTask_Probe_Executor
+from nettask_sampler import Load_Sampler, SAMPLE_INTERVAL
+from profiling import Thread_CPU_Meter
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+@lru_cache(maxsize=1)
+def local_interfaces() -> List[str]:
+    # Enumerated by the first runner that needs it rather than when this module is imported
+    return list(psutil.net_io_counters(pernic=True).keys())
+
 
 
 
@@ -27,13 +51,15 @@ from nettask_report import NetTask_Report
 class NetTask_Task_Runner:
 
     deviceID: str
-    local_ifaces: List[str] = list(psutil.net_io_counters(pernic=True).keys())
 
-    def __init__(self, deviceID, task: NetTask_Task, report_enqueuing_method):
+    def __init__(
+            self, deviceID, task: NetTask_Task, report_enqueuing_method,
+            probe_executor: NetTask_Probe_Executor = None, sample_interval: float = SAMPLE_INTERVAL
+        ):
 
         def check_for_unavailable_ifaces():
             requested_ifaces = task.interfaces
-            unavailable_ifaces = list(set(requested_ifaces) - set(self.local_ifaces))
+            unavailable_ifaces = list(set(requested_ifaces) - set(local_interfaces()))
 
             if len(unavailable_ifaces) != 0:
                 raise ValueError(
@@ -44,16 +70,28 @@ class NetTask_Task_Runner:
 
             l = []
 
-            if self.task.measure_cpu == True:
-                l.append((self.cpu_load, ()))
-            if self.task.measure_ram == True:
-                l.append((self.mem_load, ()))
-            if len(self.task.interfaces) != 0:
-                l.append((self.ifaces_traffic, (self.task.interfaces,)))
+            # With a sampler, CPU, RAM and interfaces share one thread. Without one (sample_interval=None) each gets its own, as before.
+            if self.sampler is not None:
+                l.append((self.sampled_loads, ()))
+            else:
+                if self.task.measure_cpu == True:
+                    l.append((self.cpu_load, ()))
+                if self.task.measure_ram == True:
+                    l.append((self.mem_load, ()))
+                if len(self.task.interfaces) != 0:
+                    l.append((self.ifaces_traffic, (self.task.interfaces,)))
+            if self.probe_executor is not None and NetTask_Probe_Executor.wants_probes(self.task):
+                l.append((self.probes, ()))
 
             return l
 
         self.deviceID = deviceID
+        self.probe_executor = probe_executor
+        self.sampler: Load_Sampler = (
+            Load_Sampler(task.measure_cpu, task.measure_ram, task.interfaces, sample_interval)
+            if sample_interval is not None and (task.measure_cpu or task.measure_ram or task.interfaces)
+            else None
+        )
         check_for_unavailable_ifaces()
         self.task = deepcopy(task)
         self.duration = self.task.report_frequency
@@ -61,7 +99,8 @@ class NetTask_Task_Runner:
         self.latest_report: NetTask_Report = NetTask_Report(self.deviceID, self.task.taskID)        
 
         self.enqueue = report_enqueuing_method
-        self.thread = Thread(target=self.run_continuously, daemon=True)
+        self.cpu = Thread_CPU_Meter() # the runner's thread and every period's measurement threads
+        self.thread = Thread(target=self.cpu.wrap(self.run_continuously), daemon=True, name=f"task-{self.task.taskID}")
         self.thread.start()
 
     ###############################################################################
@@ -77,7 +116,10 @@ class NetTask_Task_Runner:
 
         while True:
             #begin = time()
+            # A report of its own every period: the last one may still be queued, stamps and all
+            self.latest_report = NetTask_Report(self.deviceID, self.task.taskID)
             self.run_measurements_once()
+            self.latest_report.stamp('measured')
             #print(self)
             #print(Colours.nettask_styling(f"[Elapsed: {time()-begin}]"))
             
@@ -93,7 +135,7 @@ class NetTask_Task_Runner:
     def run_measurements_once(self):
         
         threads = [
-                Thread(target=method, args=args)
+                Thread(target=self.cpu.wrap(method), args=args, name=f"task-{self.task.taskID}-{method.__name__}")
                 for method,args in self.relevant_methods
             ]
 
@@ -128,6 +170,13 @@ class NetTask_Task_Runner:
 
         self.latest_report.add_measurement('r', round(load_sum/self.duration,1))
 
+    def sampled_loads(self):
+        results = self.sampler.sample_period(self.duration)
+        for key, values in results.pop('summaries').items():
+            self.latest_report.add_summary(key, values)
+        for key, value in results.items():
+            self.latest_report.add_measurement(key, value)
+
     def ifaces_traffic(self, ifaces):
         
         def get_current_traffic():
@@ -149,6 +198,11 @@ class NetTask_Task_Runner:
             for iface in initial.keys()
         }) # map {iterface: bidirectional traffic in packets/second}
 
+    def probes(self):
+        # ping/iperf run on the agent-wide executor, so they overlap with other tasks' probes instead of queueing behind them
+        for key, value in self.probe_executor.run_probes(self.task, self.duration).items():
+            self.latest_report.add_measurement(key, value)
+
     ###############################################################################
 
     def taskID(self):
@@ -0,0 +1,298 @@
+from typing import Dict, Callable
+from threading import Thread, Lock, Event, get_ident, enumerate as live_threads
+from collections import Counter
+from time import thread_time, clock_gettime, pthread_getcpuclockid, strftime, monotonic
+
+import tracemalloc
+import signal
+import sys
+import os
+
+PROFILES_DIR = "profiles"
+PROFILE_WINDOW = 30             # seconds a profiling window lasts unless asked otherwise
+PROFILE_MAX_WINDOW = 300        # and at most, a forgotten profiler shouldn't slow a server down for good
+PROFILE_SAMPLE_INTERVAL = 0.01  # 100 stacks per second and thread
+PROFILE_STACK_DEPTH = 64
+PROFILE_TOP = 40                # lines in each summary
+MEMORY_FRAMES = 8               # traceback depth tracemalloc keeps per allocation
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def thread_cpu_seconds(ident: int) -> float:
+    # CPU time of a live thread of this process, None once it's gone
+    try:
+        return clock_gettime(pthread_getcpuclockid(ident))
+    except (OSError, OverflowError):
+        return None
+
+class Thread_CPU_Meter:
+
+    # CPU seconds spent by the threads that ran through wrap(): live ones read from their own clock, finished ones as
+    # they left. A task runner spawns new measurement threads every period, they all add up to the same meter.
+
+    def __init__(self):
+        self.lock = Lock()
+        self.finished = 0.0
+        self.running: Dict[int, int] = {} # ident -> threads with that ident in wrap(), idents get reused
+
+    def wrap(self, target: Callable) -> Callable:
+        def measured(*args, **kwargs):
+            ident = get_ident()
+            with self.lock:
+                self.running[ident] = self.running.get(ident, 0) + 1
+            try:
+                return target(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.finished += thread_time()
+                    self.running[ident] -= 1
+                    if not self.running[ident]:
+                        del self.running[ident]
+        return measured
+
+    def seconds(self) -> float:
+        with self.lock:
+            return self.finished + sum(thread_cpu_seconds(ident) or 0.0 for ident in self.running)
+
+def threads_cpu() -> Dict[str, float]:
+    # Every live thread by name (names repeat, so the ident goes along)
+    times = {}
+    for thread in live_threads():
+        seconds = thread_cpu_seconds(thread.ident)
+        if seconds is not None:
+            times[f"{thread.name} ({thread.ident})"] = seconds
+    return times
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def code_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Sampling_Profiler:
+
+    # Takes the stack of every other thread every interval (cProfile only sees the thread that enabled it, and on this
+    # Python there's no setting a profile function on threads that already run). A thread's sample also counts as CPU
+    # if its CPU clock moved since the previous one, so blocking on sockets and queues shows in the wall clock profile only.
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.wall: Counter = Counter()  # (thread name, outermost code, ..., innermost code) -> samples, labelled when written
+        self.cpu: Counter = Counter()
+        self.last_cpu: Dict[int, float] = {}
+        self.samples = 0
+
+    def run(self, stop: Event, until: float):
+        me = get_ident()
+        while not stop.wait(self.interval) and monotonic() < until:
+            names = {thread.ident: thread.name for thread in live_threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(names.get(ident, str(ident)), ident, frame)
+            self.samples += 1
+
+    def sample(self, name: str, ident: int, frame):
+        stack = []
+        while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        key = (name, *reversed(stack))
+        self.wall[key] += 1
+
+        cpu = thread_cpu_seconds(ident)
+        if cpu is not None and cpu > self.last_cpu.get(ident, cpu):
+            self.cpu[key] += 1
+        self.last_cpu[ident] = cpu
+
+    def write_collapsed(self, path: str, stacks: Counter):
+        # One "thread;outer;...;inner count" line per stack, what flamegraph.pl and speedscope read
+        with open(path, "w") as file:
+            for (name, *stack), count in stacks.most_common():
+                file.write(f"{';'.join([name] + [code_label(code) for code in stack])} {count}\n")
+
+    def write_top(self, path: str):
+        # Per function: samples it was running in (self) and on the stack at all (total), CPU and wall clock
+        columns = {'cpu self': Counter(), 'cpu total': Counter(), 'wall self': Counter(), 'wall total': Counter()}
+        for kind, stacks in (('cpu', self.cpu), ('wall', self.wall)):
+            for stack, count in stacks.items():
+                columns[f"{kind} self"][stack[-1]] += count
+                for code in set(stack[1:]):
+                    columns[f"{kind} total"][code] += count
+
+        with open(path, "w") as file:
+            file.write(f"{self.samples} samples every {self.interval * 1000:g} ms\n")
+            for column, counts in columns.items():
+                file.write(f"\n{column}:\n")
+                for code, count in counts.most_common(PROFILE_TOP):
+                    file.write(f"{count:8} {100 * count / max(1, self.samples):6.1f}%  {code_label(code)}\n")
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Profiler:
+
+    # On-demand profiling of a running process: a window of stack sampling across all threads, plus tracemalloc from its
+    # start to its end, written to output_dir once it's over. Thread CPU times can be dumped any time, together with those
+    # of the process' own components (components() -> {name: CPU seconds}, the server's workers or the agent's task runners).
+    # install_signals(): SIGUSR1 starts a window (or ends the one running), SIGUSR2 dumps the CPU times.
+
+    def __init__(self, name: str, output_dir: str = PROFILES_DIR, components: Callable[[], Dict[str, float]] = None):
+        self.name = name
+        self.output_dir = output_dir
+        self.components = components
+        self.lock = Lock()
+        self.stop_event: Event = None
+
+    def running(self) -> bool:
+        return self.stop_event is not None
+
+    def start(self, seconds: float = PROFILE_WINDOW, memory: bool = True) -> bool:
+        with self.lock:
+            if self.running():
+                return False
+            self.stop_event = Event()
+
+        seconds = min(max(seconds, PROFILE_SAMPLE_INTERVAL), PROFILE_MAX_WINDOW)
+        print(f"[Profiler] Profiling for {seconds:g} s.")
+        Thread(target=self.window, args=(self.stop_event, seconds, memory), daemon=True, name="profiler").start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            if self.running():
+                self.stop_event.set()
+
+    def window(self, stop: Event, seconds: float, memory: bool):
+        traced_here = memory and not tracemalloc.is_tracing()
+        try:
+            if traced_here:
+                tracemalloc.start(MEMORY_FRAMES)
+            before = tracemalloc.take_snapshot() if memory else None
+
+            sampler = Sampling_Profiler()
+            sampler.run(stop, monotonic() + seconds)
+
+            prefix = self.output_prefix()
+            sampler.write_collapsed(f"{prefix}-cpu.collapsed", sampler.cpu)
+            sampler.write_collapsed(f"{prefix}-wall.collapsed", sampler.wall)
+            sampler.write_top(f"{prefix}-top.txt")
+            if memory:
+                after = tracemalloc.take_snapshot()
+                after.dump(f"{prefix}.tracemalloc") # load with tracemalloc.Snapshot.load for any other view
+                self.write_memory(f"{prefix}-memory.txt", before, after)
+            self.dump_cpu(f"{prefix}-threads.txt")
+
+            print(f"[Profiler] Done, see {prefix}-*")
+        except OSError as e:
+            print(f"[Profiler] Couldn't write the results: {e}")
+        finally:
+            # Whatever happened, the next request gets a fresh window
+            if traced_here:
+                tracemalloc.stop()
+            with self.lock:
+                self.stop_event = None
+
+    def write_memory(self, path: str, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot):
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, "w") as file:
+            file.write(f"Traced: {current / 1024:.0f} KiB now, {peak / 1024:.0f} KiB at peak\n")
+            file.write("\nGrowth during the window:\n")
+            for stat in after.compare_to(before, 'lineno')[:PROFILE_TOP]:
+                file.write(f"{stat}\n")
+            file.write("\nLargest at the end:\n")
+            for stat in after.statistics('lineno')[:PROFILE_TOP]:
+                file.write(f"{stat}\n")
+
+    def dump_cpu(self, path: str = None) -> str:
+        path = path or f"{self.output_prefix()}-threads.txt"
+        sections = [("Threads", threads_cpu())]
+        if self.components is not None:
+            sections.insert(0, ("Components", self.components()))
+        with open(path, "w") as file:
+            for title, times in sections:
+                file.write(f"{title} (CPU seconds):\n")
+                for name, seconds in sorted(times.items(), key=lambda item: -item[1]):
+                    file.write(f"{seconds:10.3f}  {name}\n")
+                file.write("\n")
+        print(f"[Profiler] Thread CPU times in {path}")
+        return path
+
+    def output_prefix(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{self.name}-{os.getpid()}-{strftime('%Y%m%d-%H%M%S')}")
+
+    def install_signals(self):
+        # Only the main thread may set handlers
+        signal.signal(signal.SIGUSR1, lambda *_: self.stop() if self.running() else self.start())
+        signal.signal(signal.SIGUSR2, lambda *_: self.dump_cpu())
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    from nettask_message import NetTask_Message
+    from socketwrapper import SocketWrapper
+    from utils import NETTASK_SERVER_PORT, get_local_addr
+    from datagram import PSH
+
+    # Asks a server running on this machine for a profiling window (it only listens to requests from its own host)
+    if len(sys.argv) not in {2, 3}:
+        print("Usage: python3 profiling.py <server_host> [seconds]")
+        sys.exit(1)
+
+    server_host = sys.argv[1]
+    seconds = float(sys.argv[2]) if len(sys.argv) == 3 else PROFILE_WINDOW
+    sock = SocketWrapper(local_addr=get_local_addr(server_host), verbose=False)
+    sock.send(server_host, NETTASK_SERVER_PORT, PSH, payload=NetTask_Message.profile_request(seconds).serialize())
+    sock.close()
+    print(f"Asked {server_host} for {seconds:g} s of profiling, the files end up in its {PROFILES_DIR}/")
@@ -0,0 +1,280 @@
+from testserver import Server
+from testclient import Client
+from nettask_message import NetTask_Message
+from nettask_report import NetTask_Report
+from alertflow_report import AlertFlow_Report
+from udp_prober import UDP_Echo_Responder
+from utils import NETTASK_SERVER_PORT, Colours
+
+from typing import Dict, List, Tuple
+from threading import Thread, Lock
+from queue import Queue, Empty, Full
+from time import time, sleep, monotonic
+
+import tempfile
+import sys
+
+# A site relay: a Server towards the site's agents, and a single agent-like session towards the central server.
+# Reports the site's agents send are acked locally and go upstream in bulk, spikes are forwarded as they come.
+# The central server's config.json lists the relay under "relays", or its session is held to a single agent's rate.
+# Usage: python3 relay.py <central_host> <relayID> [entry_port]
+
+RELAY_BATCH_WINDOW = 0.5        # seconds reports wait at the relay to go upstream together
+RELAY_BATCH_MAX = 4096          # reports per upstream send at most
+RELAY_PAYLOAD_MAX = 48 * 1024   # uncompressed batch bytes per datagram, compressed it's a fraction of a UDP datagram
+RELAY_QUEUE_MAX = 64 * 1024     # reports waiting to go upstream at most, a few seconds' worth at the rate the central server allows
+RELAY_QUEUE_WAIT = 1            # seconds an ingest writer waits for room (and its agents' windows close meanwhile) before dropping
+RELAY_RECONNECT_DELAY = 2       # seconds between attempts at reaching the central server again
+RELAY_STATS_INTERVAL = 5
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Relay_Uplink:
+
+    # The relay's session with the central server. It's a Client without tasks: handshake, control message, AlertFlow
+    # connection, and from then on report batches and spikes. If the central server goes away, the session is redone
+    # and whatever wasn't acked is sent again, so the central server may get a few reports twice but loses none.
+
+    def __init__(self, central_host: str, relayID: str, central_port: int = NETTASK_SERVER_PORT, verbose=False):
+        self.central_host = central_host
+        self.central_port = central_port
+        self.relayID = relayID
+        self.verbose = verbose
+
+        self.reports: Queue[Tuple[float, NetTask_Report]] = Queue(maxsize=RELAY_QUEUE_MAX)
+        self.client: Client = None
+        self.lock = Lock()  # guards client against the spike forwarding of the ingest writer threads
+        self.unsent_spikes: List[bytes] = []
+
+        self.reports_forwarded = 0
+        self.reports_dropped = 0
+        self.spikes_forwarded = 0
+        self.datagrams_sent = 0
+        self.sessions = 0
+
+        self.forward_thread = Thread(target=self.forward_forever, daemon=True, name="relay-uplink")
+        self.forward_thread.start()
+
+    ###########################################################################################################
+
+    def connect(self):
+        client = Client(self.central_host, self.relayID, port=0, verbose=self.verbose, server_port=self.central_port)
+        client.handshake()
+        client.send_nettask_control_message()
+        client.connect_alertflow()
+        client.nettask_socket.keep_alive(self.central_host, client.server_port, client.lose_server)
+
+        with self.lock:
+            self.client = client
+            self.sessions += 1
+            spikes, self.unsent_spikes = self.unsent_spikes, []
+        for serialized in spikes:
+            self.send_spike(serialized)
+
+    def disconnect(self):
+        with self.lock:
+            client, self.client = self.client, None
+        if client is not None:
+            client.lose_server()
+
+    def is_connected(self) -> bool:
+        return self.client is not None and self.client.server_alive
+
+    ###########################################################################################################
+
+    def forward_reports(self, timestamped: List[Tuple[float, NetTask_Report]]):
+        # A full queue blocks the ingest writer, whose queue fills and closes the agents' windows. If the site keeps
+        # producing more than the central server takes (or it's down) for longer than that, reports are dropped here
+        wait = RELAY_QUEUE_WAIT
+        for item in timestamped:
+            try:
+                self.reports.put(item, timeout=wait)
+            except Full:
+                self.reports_dropped += 1
+                wait = 0 # the rest of the batch doesn't wait all over again
+
+    def forward_spike(self, report: AlertFlow_Report):
+        self.send_spike(report.serialize())
+
+    def send_spike(self, serialized: bytes):
+        with self.lock:
+            if self.client is not None and self.client.server_alive:
+                try:
+                    self.client.alertflow_socket.sendall(serialized)
+                    self.spikes_forwarded += 1
+                    return
+                except OSError:
+                    pass
+            self.unsent_spikes.append(serialized) # goes out as soon as the next session is up
+
+    ###########################################################################################################
+
+    def next_batch(self) -> List[Tuple[float, NetTask_Report]]:
+        batch = [self.reports.get()]
+        deadline = monotonic() + RELAY_BATCH_WINDOW
+        while len(batch) < RELAY_BATCH_MAX:
+            try:
+                batch.append(self.reports.get(timeout=max(0, deadline - monotonic())))
+            except Empty:
+                break
+        return batch
+
+    def pack(self, batch: List[Tuple[float, NetTask_Report]]) -> List[bytes]:
+        # As few datagrams as possible, halving a batch until each part fits one
+        batch_payload = NetTask_Message.report_batch_payload(batch)
+        if len(batch) == 1 or len(batch_payload) <= RELAY_PAYLOAD_MAX:
+            return [NetTask_Message(author=self.relayID, tag='b', payload=batch_payload).serialize()]
+        middle = len(batch) // 2
+        return self.pack(batch[:middle]) + self.pack(batch[middle:])
+
+    def forward_forever(self):
+        while True:
+            batch = self.next_batch()
+            payloads = self.pack(batch)
+
+            while True:
+                try:
+                    if not self.is_connected():
+                        self.connect()
+                    self.client.nettask_socket.send_window(self.central_host, self.client.server_port, payloads)
+                    break
+                except OSError as e: # timeouts and a lost central server included
+                    print(f"[Relay] Central server unreachable ({e}), {self.reports.qsize() + len(batch)} reports waiting.")
+                    self.disconnect()
+                    sleep(RELAY_RECONNECT_DELAY)
+
+            self.reports_forwarded += len(batch)
+            self.datagrams_sent += len(payloads)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'forwarded': self.reports_forwarded,
+            'datagrams': self.datagrams_sent,
+            'spikes': self.spikes_forwarded,
+            'waiting': self.reports.qsize(),
+            'dropped': self.reports_dropped,
+            'sessions': self.sessions
+        }
+
+    def close(self):
+        self.disconnect()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Relay_Store:
+
+    # What the relay's Server stores into (see report_store.py for the real ones): nothing stays here.
+    # The ingest writer threads hand over batches of reports, which queue up for the uplink, and spikes, which don't wait.
+
+    def __init__(self, uplink: Relay_Uplink):
+        self.uplink = uplink
+
+    def prepare(self, device_to_tasks: Dict[str, List[str]]):
+        pass
+
+    def add_report(self, report: NetTask_Report):
+        self.uplink.forward_reports([(time(), report)])
+
+    def add_spike(self, report: AlertFlow_Report):
+        self.uplink.forward_spike(report)
+
+    def add_reports(self, timestamped: List[Tuple[float, NetTask_Report]]):
+        self.uplink.forward_reports(timestamped)
+
+    def add_spikes(self, timestamped: List[Tuple[float, AlertFlow_Report]]):
+        for _, report in timestamped:
+            self.uplink.forward_spike(report)
+
+    def close(self):
+        self.uplink.close()
+
+class Relay:
+
+    def __init__(self, config_filepath, central_host: str, relayID: str, entry_port: int = NETTASK_SERVER_PORT, central_port: int = NETTASK_SERVER_PORT):
+        self.uplink = Relay_Uplink(central_host, relayID, central_port)
+        # Agents get their tasks from the relay's own copy of the configuration
+        self.server = Server(config_filepath, logs_dir=tempfile.mkdtemp(), entry_port=entry_port, store=Relay_Store(self.uplink))
+        self.host = self.server.host
+
+    def entry_listen(self):
+        self.server.entry_listen()
+
+    def stats(self) -> Dict[str, Dict]:
+        return {'agents': self.server.stats(), 'uplink': self.uplink.stats()}
+
+    def print_stats_periodically(self, interval=RELAY_STATS_INTERVAL):
+        def printer():
+            while True:
+                sleep(interval)
+                agents, uplink = self.server.stats(), self.uplink.stats()
+                print(Colours.nettask_styling(
+                    f"[Relay] {agents['sessions']} agent sessions, {agents['reports']} reports in | "
+                    f"{uplink['forwarded']} forwarded in {uplink['datagrams']} datagrams, {uplink['spikes']} spikes, "
+                    f"{uplink['waiting']} waiting, {uplink['dropped']} dropped"
+                ))
+        Thread(target=printer, daemon=True, name="relay-stats").start()
+
+    def close(self):
+        self.server.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in {3, 4}:
+        print("Usage: python3 relay.py <central_host> <relayID> [entry_port]")
+        sys.exit(1)
+
+    entry_port = int(sys.argv[3]) if len(sys.argv) == 4 else NETTASK_SERVER_PORT
+
+    relay = Relay("config.json", sys.argv[1], sys.argv[2], entry_port=entry_port)
+    relay.print_stats_periodically()
+    try:
+        probe_responder = UDP_Echo_Responder(local_addr=relay.host) # the site's agents probe their relay
+    except OSError:
+        print("Probe port already taken here (central server on this same host?), won't answer agent probes.")
+    try:
+        relay.entry_listen()
+    except KeyboardInterrupt:
+        print("\nShutting down relay...")
+    finally:
+        relay.close()
@@ -0,0 +1,399 @@
+from nettask_report import NetTask_Report
+
+from typing import Dict, List, Tuple, Iterator
+from threading import Thread, Lock, Event
+from time import time
+from math import ceil, log
+
+from msgpack import packb, unpackb
+
+import sqlite3
+import os
+
+ROLLUPS_FILENAME = "rollups.db"
+ROLLUP_TIERS = {'1m': 60, '5m': 300, '1h': 3600}                      # tier -> bucket length in seconds
+ROLLUP_RETENTION = {'1m': 2 * 86400, '5m': 14 * 86400, '1h': 400 * 86400} # tier -> seconds a bucket is kept
+ROLLUP_FLUSH_INTERVAL = 5     # seconds between merges of the in-memory deltas into the database
+SKETCH_ACCURACY = 0.01        # relative error of the quantiles
+SKETCH_MAX_BUCKETS = 2048     # past this the lowest buckets are folded together, only the low quantiles get coarser
+SKETCH_ZERO = 1e-9            # values up to this (and negative ones) are counted as zero
+SQLITE_BUSY_TIMEOUT = 30
+
+summary_quantiles = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Quantile_Sketch:
+
+    # Log-bucketed histogram: a value v goes to bucket ceil(log_gamma(v)), so every bucket spans the same relative width
+    # and any quantile read back is within SKETCH_ACCURACY of a true one. Two sketches merge by adding their counts,
+    # which is what lets 1m buckets roll into 5m and 1h ones, and shards or late reports into what's already stored.
+
+    __slots__ = ('zeros', 'counts')
+
+    gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+    log_gamma = log(gamma)
+
+    def __init__(self):
+        self.zeros = 0
+        self.counts: Dict[int, int] = {}
+
+    def add(self, value: float):
+        if value <= SKETCH_ZERO:
+            self.zeros += 1
+            return
+        index = ceil(log(value) / self.log_gamma)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        if len(self.counts) > SKETCH_MAX_BUCKETS:
+            self.collapse()
+
+    def merge(self, other: 'Quantile_Sketch'):
+        self.zeros += other.zeros
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        if len(self.counts) > SKETCH_MAX_BUCKETS:
+            self.collapse()
+
+    def collapse(self):
+        indices = sorted(self.counts)
+        excess = indices[:len(indices) - SKETCH_MAX_BUCKETS + 1]
+        self.counts[excess[-1]] += sum(self.counts.pop(index) for index in excess[:-1])
+
+    def quantile(self, fraction: float) -> float:
+        total = self.zeros + sum(self.counts.values())
+        if total == 0:
+            return None
+        rank = fraction * (total - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1) # middle of the bucket, relative to its width
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def serialize(self) -> bytes:
+        # Indices sorted and delta-coded, so nearby buckets pack into single-byte integers
+        indices = sorted(self.counts)
+        deltas = [b - a for a, b in zip([0] + indices, indices)]
+        return packb([self.zeros, deltas, [self.counts[index] for index in indices]])
+
+    @staticmethod
+    def deserialize(data: bytes) -> 'Quantile_Sketch':
+        zeros, deltas, counts = unpackb(data)
+        sketch = Quantile_Sketch()
+        sketch.zeros = zeros
+        index = 0
+        for delta, count in zip(deltas, counts):
+            index += delta
+            sketch.counts[index] = count
+        return sketch
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Rollup_Cell:
+
+    # count/sum/min/max and a quantile sketch of one metric over one bucket
+
+    __slots__ = ('count', 'sum', 'min', 'max', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.sketch = Quantile_Sketch()
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+
+    def merge(self, other: 'Rollup_Cell'):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def summary(self) -> Dict[str, float]:
+        summary = {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max, 'avg': self.sum / self.count}
+        for name, fraction in summary_quantiles.items():
+            # The sketch's estimate never goes past what was actually seen
+            summary[name] = min(self.max, max(self.min, self.sketch.quantile(fraction)))
+        return summary
+
+    def row(self) -> Tuple:
+        return (self.count, self.sum, self.min, self.max, self.sketch.serialize())
+
+    @staticmethod
+    def from_row(count, total, least, most, sketch) -> 'Rollup_Cell':
+        cell = Rollup_Cell()
+        cell.count, cell.sum, cell.min, cell.max = count, total, least, most
+        cell.sketch = Quantile_Sketch.deserialize(sketch)
+        return cell
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def report_metrics(report: NetTask_Report) -> Iterator[Tuple[str, float]]:
+    # Each number in a report as a metric name: 'c', 'r', ... as they are, 't/eth0' per interface, 'ck/0' per core, 'cs/user' per state
+    for key, value in report.measurements.items():
+        if isinstance(value, dict):
+            for name, item in value.items():
+                if isinstance(item, (int, float)):
+                    yield f"{key}/{name}", item
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                if isinstance(item, (int, float)):
+                    yield f"{key}/{i}", item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield key, value
+
+def connect(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT)
+
+class Report_Rollups:
+
+    # Per (device, task, metric) summaries for every tier, kept up to date as reports are stored, so dashboards never
+    # rescan raw reports. The ingest writer threads add reports into in-memory deltas; every ROLLUP_FLUSH_INTERVAL a
+    # thread merges them into the rows already in rollups.db (late reports and restarts just merge into the same
+    # bucket) and drops buckets past their tier's retention.
+
+    def __init__(self, logs_dir: str, tiers: Dict[str, int] = ROLLUP_TIERS, retention: Dict[str, float] = ROLLUP_RETENTION, flush_interval: float = ROLLUP_FLUSH_INTERVAL):
+        os.makedirs(logs_dir, exist_ok=True)
+        self.db_path = os.path.join(logs_dir, ROLLUPS_FILENAME)
+        self.tiers = tiers
+        self.retention = {tier: retention.get(tier) for tier in tiers} # None keeps a tier forever
+        self.flush_interval = flush_interval
+
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pending: Dict[Tuple[str, str, str, str, float], Rollup_Cell] = {} # (tier, device, task, metric, start) -> delta
+        self.reports_rolled = 0
+
+        connection = connect(self.db_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            "tier TEXT NOT NULL, device_id TEXT NOT NULL, task_id TEXT NOT NULL, metric TEXT NOT NULL, start REAL NOT NULL, "
+            "count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL, sketch BLOB NOT NULL, "
+            "PRIMARY KEY (tier, device_id, task_id, metric, start)) WITHOUT ROWID"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS rollups_by_tier_start ON rollups (tier, start)")
+        connection.commit()
+        connection.close()
+
+        self.stopping = Event()
+        self.flush_thread = Thread(target=self.flush_forever, daemon=True, name="rollup-flusher")
+        self.flush_thread.start()
+
+    def add_reports(self, timestamped: List[Tuple[float, NetTask_Report]]):
+        # Metrics are pulled out before taking the lock, the writer threads only contend on the dict updates
+        values = [
+            (report.deviceID, report.taskID, metric, value, ts)
+            for ts, report in timestamped
+            for metric, value in report_metrics(report)
+        ]
+        with self.lock:
+            for deviceID, taskID, metric, value, ts in values:
+                for tier, length in self.tiers.items():
+                    key = (tier, deviceID, taskID, metric, ts - ts % length)
+                    cell = self.pending.get(key)
+                    if cell is None:
+                        cell = self.pending[key] = Rollup_Cell()
+                    cell.add(value)
+            self.reports_rolled += len(timestamped)
+
+    ###########################################################################################################
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        with self.flush_lock:
+            connection = connect(self.db_path)
+            try:
+                with connection:
+                    for key, delta in pending.items():
+                        row = connection.execute(
+                            "SELECT count, sum, min, max, sketch FROM rollups "
+                            "WHERE tier = ? AND device_id = ? AND task_id = ? AND metric = ? AND start = ?", key
+                        ).fetchone()
+                        if row is not None:
+                            delta.merge(Rollup_Cell.from_row(*row))
+                        connection.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", key + delta.row())
+
+                    now = time()
+                    for tier, kept in self.retention.items():
+                        if kept is not None:
+                            connection.execute("DELETE FROM rollups WHERE tier = ? AND start < ?", (tier, now - kept))
+            except sqlite3.Error as e:
+                print(f"Dropped {len(pending)} rollup updates: {e}")
+            finally:
+                connection.close()
+
+    def flush_forever(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopping.set()
+        self.flush_thread.join()
+        self.flush()
+
+    ###########################################################################################################
+
+    def query(self, deviceID: str, taskID: str, metric: str, tier: str = '1m', since: float = None, until: float = None) -> List[Tuple[float, Dict[str, float]]]:
+        self.flush() # what's still in memory counts too
+        return query_rollups([self.db_path], deviceID, taskID, metric, tier, since, until)
+
+    def summary(self, deviceID: str, taskID: str, metric: str, tier: str = '1m', since: float = None, until: float = None) -> Dict[str, float]:
+        self.flush()
+        return summarize_rollups([self.db_path], deviceID, taskID, metric, tier, since, until)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'reports': self.reports_rolled, 'pending': len(self.pending)}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def read_cells(db_paths: List[str], deviceID: str, taskID: str, metric: str, tier: str, since: float, until: float) -> Dict[float, Rollup_Cell]:
+    # Buckets from every database given merged by start, shards or relays may each hold part of one
+    conditions, params = ["tier = ?", "device_id = ?", "task_id = ?", "metric = ?"], [tier, deviceID, taskID, metric]
+    if since is not None:
+        conditions.append("start >= ?"); params.append(since)
+    if until is not None:
+        conditions.append("start < ?"); params.append(until)
+
+    cells: Dict[float, Rollup_Cell] = {}
+    for db_path in db_paths:
+        connection = connect(db_path)
+        try:
+            rows = connection.execute(
+                f"SELECT start, count, sum, min, max, sketch FROM rollups WHERE {' AND '.join(conditions)}", params
+            ).fetchall()
+        finally:
+            connection.close()
+        for start, *row in rows:
+            cell = Rollup_Cell.from_row(*row)
+            if start in cells:
+                cells[start].merge(cell)
+            else:
+                cells[start] = cell
+    return cells
+
+def query_rollups(db_paths: List[str], deviceID: str, taskID: str, metric: str, tier: str = '1m', since: float = None, until: float = None) -> List[Tuple[float, Dict[str, float]]]:
+    cells = read_cells(db_paths, deviceID, taskID, metric, tier, since, until)
+    return [(start, cells[start].summary()) for start in sorted(cells)]
+
+def summarize_rollups(db_paths: List[str], deviceID: str, taskID: str, metric: str, tier: str = '1m', since: float = None, until: float = None) -> Dict[str, float]:
+    # The whole range as one summary, quantiles included
+    total = Rollup_Cell()
+    for cell in read_cells(db_paths, deviceID, taskID, metric, tier, since, until).values():
+        total.merge(cell)
+    return total.summary() if total.count else None
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    from time import perf_counter
+    import tempfile
+    import random
+
+    # A day of 5 s reports from 20 devices, rolled up, then queried without touching a single raw report
+    logs_dir = tempfile.mkdtemp()
+    rollups = Report_Rollups(logs_dir, flush_interval=3600)
+    day_start = time() - 86400
+    day_start -= day_start % 86400
+
+    start = perf_counter()
+    for minute in range(24 * 60):
+        batch = []
+        for device in range(20):
+            for tick in range(12):
+                report = NetTask_Report(f"r{device}", 't1')
+                report.add_measurement('c', random.uniform(0, 100))
+                report.add_measurement('t', {'eth0': random.expovariate(1 / 1500), 'eth1': random.expovariate(1 / 300)})
+                batch.append((day_start + minute * 60 + tick * 5, report))
+        rollups.add_reports(batch)
+        if minute % 60 == 59:
+            rollups.flush()
+    elapsed = perf_counter() - start
+    print(f"{rollups.reports_rolled} reports rolled up in {elapsed:.2f} s ({rollups.reports_rolled / elapsed:.0f}/s)")
+
+    start = perf_counter()
+    hourly = rollups.query('r3', 't1', 't/eth0', tier='1h', since=day_start)
+    day = rollups.summary('r3', 't1', 't/eth0', tier='1h', since=day_start)
+    print(f"{len(hourly)} hourly buckets and the day's summary in {(perf_counter() - start) * 1000:.1f} ms")
+    print({name: round(value, 1) for name, value in day.items()})
+    print(f"rollups.db: {os.path.getsize(rollups.db_path) // 1024} KiB")
+    rollups.close()
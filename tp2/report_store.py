@@ -0,0 +1,303 @@
+from nettask_report import NetTask_Report
+from alertflow_report import AlertFlow_Report
+from utils import print_directory
+
+from typing import List, Dict, Tuple
+from threading import Thread
+from queue import Queue, Empty
+from time import time, monotonic
+from datetime import datetime
+
+import sqlite3
+import json
+import os
+
+SQLITE_FILENAME = "reports.db"
+BATCH_MAX_ROWS = 1000      # rows written per transaction at most
+BATCH_WINDOW = 0.05        # seconds the writer waits for more rows before committing what it has
+SQLITE_BUSY_TIMEOUT = 30   # seconds a connection waits on another one's lock before failing
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Json_Report_Store:
+
+    # The original storage: one JSON file per (device, task) for reports and another for spikes, rewritten on every insert
+
+    def __init__(self, logs_dir: str):
+        self.logs_dir = logs_dir
+
+    def prepare(self, device_to_tasks: Dict[str, List[str]]):
+        os.makedirs(self.logs_dir, exist_ok=True)  # Ensure the base directory exists
+
+        # Iterate through the device-to-tasks mapping
+        for device, task_ids in device_to_tasks.items():
+            # Create a directory for the device
+            device_dir = os.path.join(self.logs_dir, device)
+            os.makedirs(device_dir, exist_ok=True)
+
+            # Create an empty JSON file for each task assigned to the device
+            for task_id in task_ids:
+                task_file_path = os.path.join(device_dir, f"{task_id}.json")
+                spike_file_path = os.path.join(device_dir, f"{task_id}spikes.json")
+                with open(task_file_path, "w") as task_file:
+                    json.dump({}, task_file, indent=4)  # Write an empty JSON object
+                with open(spike_file_path, "w") as spike_file:
+                    json.dump({}, spike_file, indent=4)
+
+        print_directory(self.logs_dir)
+
+    def add_report(self, report: NetTask_Report):
+        self.add_reports([(time(), report)])
+
+    def add_spike(self, report: AlertFlow_Report):
+        self.add_spikes([(time(), report)])
+
+    def add_reports(self, timestamped: List[Tuple[float, NetTask_Report]]):
+        # Every file is read and rewritten once per batch, however many of its entries the batch holds
+        files: Dict[Tuple[str, str], List] = {}
+        for ts, report in timestamped:
+            files.setdefault((report.deviceID, f"{report.taskID}.json"), []).append((ts, report.to_dict()))
+        for (deviceID, filename), entries in files.items():
+            self.append_to_file(deviceID, filename, entries)
+
+    def add_spikes(self, timestamped: List[Tuple[float, AlertFlow_Report]]):
+        files: Dict[Tuple[str, str], List] = {}
+        for ts, report in timestamped:
+            files.setdefault((report.deviceID(), f"{report.taskID()}spikes.json"), []).append((ts, report.to_full_dict()))
+        for (deviceID, filename), entries in files.items():
+            self.append_to_file(deviceID, filename, entries)
+
+    def append_to_file(self, deviceID: str, filename: str, entries: List[Tuple[float, Dict]]):
+        device_dir = os.path.join(self.logs_dir, deviceID)
+        file_path = os.path.join(device_dir, filename)
+
+        # Ensure the device directory exists
+        os.makedirs(device_dir, exist_ok=True)
+
+        # Load existing data from the JSON file if it exists
+        if os.path.exists(file_path):
+            with open(file_path, "r") as file:
+                try:
+                    existing_data: Dict = json.load(file)
+                except json.JSONDecodeError:
+                    existing_data: Dict = {}  # If file is empty or corrupted, initialize as empty
+        else:
+            existing_data: Dict = {}
+
+        for ts, entry in entries:
+            existing_data[str(datetime.fromtimestamp(ts))] = entry
+
+        # Write the updated data back to the file
+        with open(file_path, "w") as file:
+            json.dump(existing_data, file, indent=4)
+
+    def close(self):
+        pass
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class SQLite_Report_Store:
+
+    # Reports and spikes in one SQLite database in WAL mode, indexed on (device, task, timestamp).
+    # Workers only enqueue rows, a single writer thread turns whatever piled up into one transaction,
+    # so the fsync is paid once per batch instead of once per report. Readers never block the writer under WAL.
+
+    tables = ['reports', 'spikes']
+
+    def __init__(self, logs_dir: str, filename: str = SQLITE_FILENAME):
+        os.makedirs(logs_dir, exist_ok=True)
+        self.db_path = os.path.join(logs_dir, filename)
+        self.pending: Queue = Queue()
+
+        # Schema is created before returning, so queries work right away
+        connection = self.connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        for table in self.tables:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "id INTEGER PRIMARY KEY, device_id TEXT NOT NULL, task_id TEXT NOT NULL, ts REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_by_device_task_ts ON {table} (device_id, task_id, ts)")
+        connection.commit()
+        connection.close()
+
+        self.writer_thread = Thread(target=self.write_forever, daemon=True, name="sqlite-writer")
+        self.writer_thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT)
+        connection.execute("PRAGMA synchronous=FULL") # batches make the fsync per commit affordable
+        return connection
+
+    def prepare(self, device_to_tasks: Dict[str, List[str]]):
+        pass # nothing to create per device
+
+    def add_report(self, report: NetTask_Report):
+        self.add_reports([(time(), report)])
+
+    def add_spike(self, report: AlertFlow_Report):
+        self.add_spikes([(time(), report)])
+
+    def add_reports(self, timestamped: List[Tuple[float, NetTask_Report]]):
+        for ts, report in timestamped:
+            self.pending.put(('reports', (report.deviceID, report.taskID, ts, json.dumps(report.to_dict()))))
+
+    def add_spikes(self, timestamped: List[Tuple[float, AlertFlow_Report]]):
+        for ts, report in timestamped:
+            self.pending.put(('spikes', (report.deviceID(), report.taskID(), ts, json.dumps(report.to_full_dict()))))
+
+    def write_forever(self):
+        connection = self.connect()
+        closing = False
+
+        while not closing:
+            first = self.pending.get()
+            if first is None:
+                break
+            batch = [first]
+
+            # Group commit: keep taking rows until the batch is full or the window closes
+            deadline = monotonic() + BATCH_WINDOW
+            while len(batch) < BATCH_MAX_ROWS:
+                try:
+                    row = self.pending.get(timeout=max(0, deadline - monotonic()))
+                except Empty:
+                    break
+                if row is None:
+                    closing = True
+                    break
+                batch.append(row)
+
+            try:
+                with connection: # one transaction for the whole batch
+                    for table in self.tables:
+                        rows = [values for target, values in batch if target == table]
+                        if rows:
+                            connection.executemany(f"INSERT INTO {table} (device_id, task_id, ts, data) VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                print(f"Dropped a batch of {len(batch)} rows: {e}")
+
+            for _ in range(len(batch) + closing):
+                self.pending.task_done()
+
+        connection.close()
+
+    def flush(self):
+        # Blocks until everything enqueued so far is committed
+        self.pending.join()
+
+    def close(self):
+        self.pending.put(None)
+        self.writer_thread.join()
+
+    ###########################################################################################################
+
+    def query(self, table: str, deviceID: str, taskID: str = None, since: float = None, until: float = None) -> List[Tuple[float, Dict]]:
+        conditions, params = ["device_id = ?"], [deviceID]
+        if taskID is not None:
+            conditions.append("task_id = ?"); params.append(taskID)
+        if since is not None:
+            conditions.append("ts >= ?"); params.append(since)
+        if until is not None:
+            conditions.append("ts < ?"); params.append(until)
+
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                f"SELECT ts, data FROM {table} WHERE {' AND '.join(conditions)} ORDER BY ts", params
+            ).fetchall()
+        finally:
+            connection.close()
+        return [(ts, json.loads(data)) for ts, data in rows]
+
+    def reports(self, deviceID: str, taskID: str = None, since: float = None, until: float = None) -> List[Tuple[float, Dict]]:
+        return self.query('reports', deviceID, taskID, since, until)
+
+    def spikes(self, deviceID: str, taskID: str = None, since: float = None, until: float = None) -> List[Tuple[float, Dict]]:
+        return self.query('spikes', deviceID, taskID, since, until)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+storage_backends = {
+    'json': Json_Report_Store,
+    'sqlite': SQLite_Report_Store
+}
+
+def make_store(storage: str, logs_dir: str):
+    return storage_backends[storage](logs_dir)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    import tempfile
+
+    # Ingest rate of the SQLite store, several threads enqueueing like concurrent server workers would
+    store = SQLite_Report_Store(tempfile.mkdtemp())
+    report = NetTask_Report('r1', 't1')
+    report.add_measurement('c', 12.5)
+    report.add_measurement('r', 40.1)
+
+    n_threads, per_thread = 8, 5000
+    start = monotonic()
+    writers = [Thread(target=lambda: [store.add_report(report) for _ in range(per_thread)]) for _ in range(n_threads)]
+    for w in writers: w.start()
+    for w in writers: w.join()
+    store.flush()
+    elapsed = monotonic() - start
+
+    print(f"{n_threads * per_thread} reports committed in {elapsed:.2f} s ({n_threads * per_thread / elapsed:.0f}/s)")
+    print(f"Last hour of r1/t1: {len(store.reports('r1', 't1', since=time() - 3600))} reports")
+    store.close()
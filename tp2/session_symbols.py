@@ -0,0 +1,65 @@
+from nettask_task import NetTask_Task
+
+from typing import Dict, List
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Session_Symbols:
+
+    # What both ends of a session know once the tasks are downloaded, so reports needn't spell it out every time.
+    # The agent's deviceID and its taskIDs go as their index in a table the server sends along with the final task,
+    # interfaces don't go at all: their traffic and summaries are arrays in the order the task lists its interfaces.
+    # Anything the table doesn't cover stays as it was, and the worker expands reports back before they go anywhere else.
+
+    def __init__(self, table: List[str], tasks: Dict[str, NetTask_Task]):
+        self.table = table
+        self.index = {symbol: i for i, symbol in enumerate(table)}
+        self.interfaces = {taskID: list(task.interfaces) for taskID, task in tasks.items() if task.interfaces}
+        self.interface_sets = {taskID: set(interfaces) for taskID, interfaces in self.interfaces.items()}
+
+    @staticmethod
+    def session_table(deviceID: str, tasks: Dict[str, NetTask_Task]) -> List[str]:
+        return [deviceID, *tasks]
+
+    def symbol(self, value):
+        return self.index.get(value, value)
+
+    def name(self, value):
+        return self.table[value] if type(value) is int else value
+
+    def intern(self, fields: List) -> List:
+        # A report's as_fields() with IDs and interfaces left out, a copy: the report may still be printed or resent
+        fields = list(fields)
+        taskID = fields[1]
+        fields[0], fields[1] = self.symbol(fields[0]), self.symbol(taskID)
+
+        interfaces = self.interfaces.get(taskID)
+        if interfaces is not None:
+            for i in (2, 3): # measurements, summaries
+                if len(fields) > i and fields[i] and type(fields[i].get('t')) is dict and fields[i]['t'].keys() <= self.interface_sets[taskID]:
+                    fields[i] = {**fields[i], 't': [fields[i]['t'].get(interface) for interface in interfaces]}
+        return fields
+
+    def expand(self, fields: List) -> List:
+        # Back to what as_fields() gave, in place on what was just unpacked
+        fields[0], fields[1] = self.name(fields[0]), self.name(fields[1])
+
+        interfaces = self.interfaces.get(fields[1], [])
+        for i in (2, 3):
+            if len(fields) > i and fields[i] and type(fields[i].get('t')) is list:
+                fields[i]['t'] = {interface: value for interface, value in zip(interfaces, fields[i]['t']) if value is not None}
+        return fields
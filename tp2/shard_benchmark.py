@@ -0,0 +1,159 @@
+from sharded_server import Sharded_Server
+from testclient import Client
+from testserver import Server
+from socketwrapper import SEND_WINDOW
+from report_store import storage_backends
+from transport_benchmark import sample_payload
+from wire_replay import synthetic_addr
+
+from typing import Dict, List
+from threading import Thread
+from multiprocessing import Queue, get_context
+from time import time, sleep
+
+import tempfile
+import json
+import sys
+import os
+
+# Reports per second a Sharded_Server ingests on loopback with 1, 2, 4... shards. Agents are spread over driver processes,
+# so the driving side isn't held to one core by the GIL, and each keeps a full send_window in flight for the whole run.
+# Sessions get no rate limit here: what's measured is what the shards can take, not what an agent is allowed.
+# Usage: python3 shard_benchmark.py [shard_counts] [agents] [seconds] [json|sqlite]
+
+SHARD_COUNTS = [1, 2, 4]
+BENCHMARK_AGENTS = 64
+BENCHMARK_SECONDS = 10
+BENCHMARK_DRIVERS = 4
+BENCHMARK_SETUP = 10     # seconds the agents get to handshake and download their tasks before the clock starts
+BENCHMARK_TASK = "t1"    # the task from config.json every benchmark agent is given
+BENCHMARK_SESSION_RATE = 1e9 # reports per second a session is allowed, none ever gets near it
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def benchmark_config(agents: int) -> str:
+    # config.json's task, assigned to as many devices as there are agents, so sessions spread over every shard
+    with open("config.json") as file:
+        config = json.load(file)
+    task = next(task for task in config["tasks"] if task["taskID"] == BENCHMARK_TASK)
+    task["devices"] = [f"bench{i}" for i in range(agents)]
+    path = os.path.join(tempfile.mkdtemp(), "config.json")
+    with open(path, "w") as file:
+        json.dump({"tasks": [task]}, file)
+    return path
+
+def drive(server_host: str, indices: List[int], start_at: float, seconds: float, results: Queue):
+    sys.stdout = open(os.devnull, 'w') # agents print every datagram
+    acked = [0] * len(indices)
+
+    def agent(slot: int, index: int):
+        deviceID = f"bench{index}"
+        try:
+            client = Client(server_host, deviceID, port=0, local_addr=synthetic_addr(index), verbose=False)
+            client.handshake()
+            client.send_nettask_control_message()
+            client.listen_for_nettask_tasks()
+            client.connect_alertflow()
+            client.nettask_socket.keep_alive(server_host, client.server_port, client.lose_server) # idle until the clock starts
+        except OSError:
+            return
+
+        payloads = [sample_payload(deviceID)] * SEND_WINDOW
+        sleep(max(0, start_at - time()))
+        while time() < start_at + seconds:
+            try:
+                client.nettask_socket.send_window(server_host, client.server_port, payloads)
+            except OSError:
+                return
+            acked[slot] += len(payloads)
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    agents = [Thread(target=agent, args=(slot, index), daemon=True) for slot, index in enumerate(indices)]
+    for thread in agents: thread.start()
+    for thread in agents: thread.join()
+    results.put(sum(acked))
+
+def run_benchmark(n_shards: int, agents: int, seconds: float, storage: str) -> Dict:
+
+    Server.delete_log_dir()
+    server = Sharded_Server(benchmark_config(agents), n_shards=n_shards, storage=storage, session_report_rate=BENCHMARK_SESSION_RATE)
+    server.start_shards()
+    Thread(target=server.entry_listen, daemon=True).start()
+
+    # Drivers are spawned, not forked: a fork of this process would inherit whatever locks its threads held at the time
+    spawn = get_context('spawn')
+    results = spawn.Queue()
+    start_at = time() + BENCHMARK_SETUP
+    drivers = [
+        spawn.Process(target=drive, args=(server.host, list(range(agents))[i::BENCHMARK_DRIVERS], start_at, seconds, results))
+        for i in range(BENCHMARK_DRIVERS)
+    ]
+    for driver in drivers: driver.start()
+    acked = sum(results.get() for _ in drivers)
+    for driver in drivers: driver.join()
+
+    stats = server.stats()
+    server.close()
+    return {
+        'shards': n_shards,
+        'reports': acked,
+        'reports_per_second': round(acked / seconds, 1),
+        'per_shard': [shard['reaped'] + shard['sessions'] for shard in stats['shards']] # sessions each shard got
+    }
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    shard_counts = [int(n) for n in sys.argv[1].split(",")] if len(sys.argv) >= 2 else SHARD_COUNTS
+    agents = int(sys.argv[2]) if len(sys.argv) >= 3 else BENCHMARK_AGENTS
+    seconds = float(sys.argv[3]) if len(sys.argv) >= 4 else BENCHMARK_SECONDS
+    storage = sys.argv[4] if len(sys.argv) == 5 and sys.argv[4] in storage_backends else 'json'
+
+    console = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # shards print every datagram too
+
+    def print_result(line):
+        console.write(line + "\n")
+        console.flush()
+
+    print_result(f"{agents} agents for {seconds:g} s, {storage} storage, {os.cpu_count()} cores")
+    baseline = None
+    try:
+        for n_shards in shard_counts:
+            result = run_benchmark(n_shards, agents, seconds, storage)
+            baseline = baseline or result['reports_per_second']
+            speedup = f"{result['reports_per_second'] / baseline:.2f}x" if baseline else "-"
+            print_result(f"{n_shards:3} shards: {result['reports_per_second']:10} reports/s ({speedup}), sessions per shard {result['per_shard']}")
+    finally:
+        sys.stdout = console
+        Server.delete_log_dir() # what the shards stored is of no use after the run
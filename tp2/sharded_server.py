@@ -0,0 +1,276 @@
+from testserver import Server, LOGS_BASE_DIR, WORKER_PORT_RANGE, SESSION_REPORT_RATE
+from report_store import storage_backends
+from nettask_message import NetTask_Message
+from datagram import Datagram
+from socketwrapper import SocketWrapper
+from udp_prober import UDP_Echo_Responder
+from throughput_engine import Throughput_Engine_Server
+from utils import NETTASK_SERVER_PORT, get_local_addr, Colours
+
+from typing import List, Dict, Tuple
+from threading import Thread
+from multiprocessing import Process, Queue, Array
+from zlib import crc32
+from time import sleep
+
+import os
+import sys
+
+SHARD_STATS_FIELDS = ['sessions', 'reaped', 'reports', 'spikes', 'queued', 'throttled']
+SHARD_STATS_INTERVAL = 1 # seconds between each shard publishing its counters
+
+
+
+
+
+
+
+
+
+
+
+
+def shard_for(key: str, n_shards: int) -> int:
+    # crc32 instead of hash(): string hashing is salted per process, and every process must agree on the owner
+    return crc32(key.encode()) % n_shards
+
+def shard_logs_dir(index: int) -> str:
+    return os.path.join(LOGS_BASE_DIR, f"shard{index}")
+
+def shard_port_range(index: int, n_shards: int) -> Tuple[int, int]:
+    # Every shard draws worker ports from its own slice, so two processes never pick the same one
+    first, last = WORKER_PORT_RANGE
+    width = (last - first + 1) // n_shards
+    return (first + index*width, first + (index+1)*width - 1)
+
+def session_key(syn: Datagram) -> str:
+    # The agent's SYN carries a bare NetTask message with its deviceID. Older agents send it empty, so we fall back to the address.
+    if syn.payload_size() != 0:
+        try:
+            return str(NetTask_Message.deserialize(syn.payload).author)
+        except Exception: pass
+    return f"{syn.origin_addr}:{syn.origin_port}"
+
+
+
+
+
+
+
+
+
+
+
+
+class Server_Shard(Server):
+
+    def __init__(
+            self, config_filepath, index: int, n_shards: int, stats, reuse_port: bool = False, storage: str = 'json',
+            session_report_rate: float = SESSION_REPORT_RATE
+        ):
+
+        self.index = index
+        self.n_shards = n_shards
+        self.shared_stats = stats
+        self.reuse_port = reuse_port
+
+        super().__init__(
+            config_filepath,
+            logs_dir=shard_logs_dir(index),
+            port_range=shard_port_range(index, n_shards),
+            entry_port=NETTASK_SERVER_PORT if reuse_port else None,
+            reuse_port=reuse_port,
+            session_report_rate=session_report_rate,
+            storage=storage  # each shard writes its own database, so shards never contend on a write lock
+        )
+
+        self.stats_thread = Thread(target=self.publish_stats, daemon=True)
+        self.stats_thread.start()
+
+    ###########################################################################################################
+
+    def local_devices(self) -> List[str]:
+        # With SO_REUSEPORT the kernel picks the shard, so any device may show up here
+        if self.reuse_port:
+            return super().local_devices()
+        return [device for device in self.device_to_tasks if shard_for(device, self.n_shards) == self.index]
+
+    def publish_stats(self):
+        offset = self.index * len(SHARD_STATS_FIELDS)
+        while True:
+            stats = self.stats()
+            for i, field in enumerate(SHARD_STATS_FIELDS):
+                self.shared_stats[offset + i] = stats[field]
+            sleep(SHARD_STATS_INTERVAL)
+
+    def serve(self, syn_queue: Queue = None):
+        if self.reuse_port:
+            self.entry_listen()
+            return
+
+        while True:
+            syn: Datagram = syn_queue.get()
+            if syn is None: break
+            self.new_worker(syn)
+
+    def portprint(self, string):
+        print(f"[Shard {self.index}] {string}")
+
+
+
+def run_shard(config_filepath, index, n_shards, stats, syn_queue, reuse_port, storage, session_report_rate):
+    shard = Server_Shard(config_filepath, index, n_shards, stats, reuse_port, storage, session_report_rate)
+    try:
+        shard.serve(syn_queue)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shard.close()
+
+
+
+
+
+
+
+
+
+
+
+
+class Sharded_Server:
+
+    def __init__(
+            self, config_filepath, n_shards: int = None, reuse_port: bool = False, storage: str = 'json',
+            session_report_rate: float = SESSION_REPORT_RATE
+        ):
+
+        self.config_filepath = config_filepath
+        self.storage = storage
+        self.session_report_rate = session_report_rate
+        self.n_shards = n_shards if n_shards is not None else os.cpu_count()
+        self.reuse_port = reuse_port
+
+        # One row of SHARD_STATS_FIELDS counters per shard, written by the shard and summed here
+        self.shared_stats = Array('q', self.n_shards * len(SHARD_STATS_FIELDS), lock=False)
+        self.syn_queues: List[Queue] = [Queue() for _ in range(self.n_shards)] if not reuse_port else []
+
+        self.host = get_local_addr()
+        self.entry_socket: SocketWrapper = None
+        if not reuse_port:
+            self.entry_socket = SocketWrapper(local_addr=self.host, local_port=NETTASK_SERVER_PORT)
+            print(f"Sharded server front-end listening on {self.host}:{NETTASK_SERVER_PORT} ({self.n_shards} shards)")
+        else:
+            print(f"Sharded server with {self.n_shards} shards sharing {self.host}:{NETTASK_SERVER_PORT} through SO_REUSEPORT")
+
+        self.shards: List[Process] = []
+
+    ###########################################################################################################
+
+    def start_shards(self):
+        for index in range(self.n_shards):
+            shard = Process(
+                target=run_shard,
+                args=(
+                    self.config_filepath, index, self.n_shards, self.shared_stats,
+                    self.syn_queues[index] if not self.reuse_port else None,
+                    self.reuse_port, self.storage, self.session_report_rate
+                ),
+                daemon=True
+            )
+            shard.start()
+            self.shards.append(shard)
+
+    def entry_listen(self):
+
+        if self.reuse_port:
+            # The kernel does the dispatching, the front-end only has to stay alive
+            for shard in self.shards:
+                shard.join()
+            return
+
+        while True:
+            datagram, addr = self.entry_socket.receive()
+            if not datagram:
+                if self.entry_socket.sock.fileno() < 0:
+                    break # closed under us, or this thread would spin on it forever
+                continue
+
+            if datagram.is_syn():
+                index = shard_for(session_key(datagram), self.n_shards)
+                print(f"Received SYN from {addr}, handing it to shard {index}")
+                datagram.payload = bytes(datagram.payload) # memoryview payloads can't be pickled across processes
+                self.syn_queues[index].put(datagram)
+
+            elif datagram.is_fin():
+                self.entry_socket.send_ack(datagram)
+                break
+
+    def close(self):
+        for syn_queue in self.syn_queues:
+            syn_queue.put(None)
+        if self.entry_socket is not None:
+            self.entry_socket.close()
+        for shard in self.shards:
+            shard.join(timeout=1)
+            if shard.is_alive():
+                shard.terminate()
+
+    ###########################################################################################################
+
+    def stats(self) -> Dict:
+        width = len(SHARD_STATS_FIELDS)
+        per_shard = [
+            dict(zip(SHARD_STATS_FIELDS, self.shared_stats[i*width:(i+1)*width]))
+            for i in range(self.n_shards)
+        ]
+        total = {field: sum(shard[field] for shard in per_shard) for field in SHARD_STATS_FIELDS}
+        return {'total': total, 'shards': per_shard}
+
+    def print_stats_periodically(self, interval=10):
+        def printer():
+            while True:
+                sleep(interval)
+                stats = self.stats()
+                total = stats['total']
+                print(Colours.nettask_styling(
+                    f"[Shards] {total['sessions']} sessions, {total['reports']} reports, {total['spikes']} spikes, {total['queued']} queued for storage, {total['throttled']} throttled | "
+                    + " | ".join(f"#{i}: {s['sessions']}s/{s['reports']}r" for i, s in enumerate(stats['shards']))
+                ))
+        Thread(target=printer, daemon=True).start()
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    options = sys.argv[2:]
+    if len(sys.argv) > 4 or any(o != "reuseport" and o not in storage_backends for o in options):
+        print(f"Usage: python3 sharded_server.py [n_shards] [reuseport] [{'|'.join(storage_backends)}]")
+        sys.exit(1)
+
+    n_shards = int(sys.argv[1]) if len(sys.argv) >= 2 else None
+    reuse_port = "reuseport" in options
+    storage = next((o for o in options if o in storage_backends), 'json')
+
+    Server.delete_log_dir()
+
+    server = Sharded_Server("config.json", n_shards=n_shards, reuse_port=reuse_port, storage=storage)
+    server.start_shards()
+    server.print_stats_periodically()
+    probe_responder = UDP_Echo_Responder(local_addr=server.host)
+    throughput_engine = Throughput_Engine_Server(local_addr=server.host)
+    try:
+        server.entry_listen()
+    except KeyboardInterrupt:
+        print("\nShutting down sharded server...")
+    finally:
+        server.close()
@@ -1,65 +1,235 @@
 from random import randint
-from socket import socket, AF_INET, SOCK_DGRAM, timeout
-from datagram import Datagram, Flags
-from time import sleep
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEPORT, SHUT_RDWR, timeout
+from datagram import Datagram, SYN, ACK, FIN, HBT, PSH
+from wire_capture import Capture_Writer, UDP, INBOUND, OUTBOUND
+from threading import Lock, RLock, Thread
+from time import sleep, monotonic
+from collections import deque
+from typing import Callable, Dict, List
 
 SOCK_TIMEOUT = 5
 SOCK_MAX_RETRIES = 3
+SOCK_GIVE_UP = SOCK_MAX_RETRIES * SOCK_TIMEOUT + 2**SOCK_MAX_RETRIES # longest a peer keeps retransmitting before it gives up
+RECV_BUFFER_SIZE = 65535 # largest possible UDP datagram, recvfrom(1024) used to truncate bigger reports
+RECV_POOL_PREALLOCATED = 4
+HEARTBEAT_INTERVAL = 1   # seconds without hearing from the peer before an idle side sends a heartbeat
+HEARTBEAT_MISSES = 5     # intervals without hearing from the peer before it's declared dead
+ACK_DELAY = 0.02         # how long a receiver holds an ack, hoping it covers the next datagrams too or rides on data of ours
+ACK_EVERY = 8            # in-order datagrams after which the ack goes out no matter what
+SEND_WINDOW = 16         # datagrams send_window puts in flight before waiting for their ack
+SACK_MAX_RANGES = 4      # ranges an ack carries at most, the oldest holes matter most
+REORDER_TOLERANCE = 3    # datagrams that must arrive past a hole before it's taken as lost rather than reordered
+ZERO_WINDOW_PROBE = 0.1  # seconds between heartbeats asking a peer whose window is shut whether it reopened
+
+class Buffer_Pool:
+
+    # Receive buffers are borrowed for the duration of a single recvfrom_into+decompress and given back right after,
+    # so a handful of them serves every socket in the process no matter how many packets go through.
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE, preallocated=RECV_POOL_PREALLOCATED):
+        self.buffer_size = buffer_size
+        self.free = [bytearray(buffer_size) for _ in range(preallocated)]
+        self.lock = Lock()
+
+    def acquire(self) -> bytearray:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        with self.lock:
+            self.free.append(buffer)
+
+recv_buffer_pool = Buffer_Pool()
 
 class SocketWrapper:
 
-    def __init__(self, local_addr, local_port=None, starting_seqnr=None, starting_acknr=0):
+    def __init__(self, local_addr, local_port=None, starting_seqnr=None, starting_acknr=0, reuse_port=False, verbose=True, recorder: Capture_Writer = None, timeout=SOCK_TIMEOUT):
         self.local_addr = local_addr
+        self.timeout = timeout  # how long send_and_wait_ack waits for each ack before retransmitting
         self.local_port = local_port
+        self.verbose = verbose
+        self.recorder = recorder  # every datagram sent and received goes to the capture file too
         self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.sock.bind((local_addr, local_port))
+        if reuse_port:
+            # Lets several server processes share the entry port, the kernel spreads incoming flows between them
+            self.sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        self.sock.bind((local_addr, local_port or 0))
+        self.local_port = self.sock.getsockname()[1] # the kernel picks one if we didn't
         self.seqnr = starting_seqnr if starting_seqnr != None else randint(1000,8000)
-        self.acknr = starting_acknr
+        self.acknr = starting_acknr  # next seqnr expected from the peer, everything before it was received
+
+        # Receiver side: what arrived past a hole, acks owed to the peer and data read while waiting for an ack
+        self.sack: List[List[int]] = []
+        self.acks_pending = 0
+        self.ack_due: float = None
+        self.ack_peer = None
+        self.inbox = deque()
+        self.ack_listener: Callable[[float], None] = None # told how long each datagram waited for its ack, if set
+        self.unacked: List[List[float]] = []              # [seq_end, received at] of data not acked yet, for ack_listener
+
+        # Flow control: what the peer last advertised (None if it doesn't), and how we work out our own window
+        self.peer_window: int = None
+        self.window_provider: Callable[[], int] = None
+
+        self.lock = RLock()  # send_ack may nest a send_and_wait_ack
+        self.last_heard = monotonic()
+        self.heartbeat_thread: Thread = None
 
     #################################################################################################
 
-    def send(self, dest_addr, dest_port, flags: Flags, payload=None, acknr=None):
-        
+    def send(self, dest_addr, dest_port, flags: int, payload=None, acknr=None, seqnr=None, age=None):
+
+        # Without an explicit acknr, an ack is cumulative and carries whatever we owed the peer, so the delayed ack is off
+        cumulative = acknr is None and flags & ACK
         datagram = Datagram(
             origin_addr=self.local_addr,
             origin_port=self.local_port,
             dest_addr=dest_addr,
             dest_port=dest_port,
             flags=flags,
-            seqnr=self.seqnr,
+            seqnr=seqnr if seqnr is not None else self.seqnr,
             acknr=acknr if acknr is not None else self.acknr,
             payload=payload,
+            sack=self.sack[:SACK_MAX_RANGES] if cumulative and self.sack else None,
+            window=self.window_provider() if self.window_provider is not None and flags & ACK else None,
+            age=age
         )
-        self.sock.sendto(datagram.serialize(), (dest_addr, dest_port))
+        data = datagram.serialize()
+        self.sock.sendto(data, (dest_addr, dest_port))
+        if cumulative:
+            self.acks_pending, self.ack_due = 0, None
+            if self.ack_listener is not None:
+                self.report_acked(datagram.acknr)
+        if self.recorder is not None:
+            self.recorder.record(UDP, OUTBOUND, (self.local_addr, self.local_port), (dest_addr, dest_port), data)
         self.sockprint(f"Sent {datagram}")
         return datagram
 
-    def send_and_wait_ack(self, dest_addr, dest_port, flags, payload=b'', acknr=None) -> Datagram:
+    def send_and_wait_ack(self, dest_addr, dest_port, flags, payload=b'', acknr=None, push=True) -> Datagram:
+
+        # push=False when the peer is about to answer with data anyway, so it can hold its ack and send it along
+        if payload and push:
+            flags |= PSH
 
-        for i in range(SOCK_MAX_RETRIES):
+        # Held for the whole exchange so a heartbeat never reads the ack we are waiting for
+        with self.lock:
 
-            # We pass a specific acknr in a synack situation. Every other case uses the self-stored acknr.
-            sent_datagram = self.send(dest_addr, dest_port, flags, payload, acknr=self.acknr if acknr is None else acknr)
-            response, _ = self.receive()
+            for i in range(SOCK_MAX_RETRIES):
+
+                # We pass a specific acknr in a synack situation. Every other case acks cumulatively.
+                sent_datagram = self.send(dest_addr, dest_port, flags, payload, acknr=acknr)
+                deadline = monotonic() + self.timeout # a lost ack used to block here forever
+
+                while deadline > monotonic():
+                    try:
+                        response = self.read(deadline - monotonic())
+                    except TimeoutError:
+                        break
+                    if response is None:
+                        raise ConnectionAbortedError("Socket closed while waiting for an ACK.")
+                    # Anything else is a stale or duplicated ack, or data the peer sent meanwhile that read() took care of
+                    if response.is_ack() and response.acknr == sent_datagram.seq_end():
+                        self.seqnr = sent_datagram.seq_end()
+                        return response
 
-            if response and response.flags.ack and response.acknr == (sent_datagram.seqnr+sent_datagram.payload_size()+1):
-                #self.sockprint("ACK received")
-                self.seqnr += sent_datagram.payload_size()+1
-                return response
-            else:
-                self.acknr -= response.seqnr+response.payload_size()+1
                 self.sockprint("ACK not received, resending...")
                 sleep(2**i) # exponentially sleep more between retransmissions
         
-        if i == SOCK_MAX_RETRIES:
             raise TimeoutError("Maximum retransmission attempts reached.")
 
+    def send_window(self, dest_addr, dest_port, payloads: List[bytes]):
+
+        # Up to SEND_WINDOW datagrams go out back to back and a single cumulative ack covers them. Only what the acks
+        # (and their SACK ranges) say is missing gets retransmitted. The last one is pushed so the peer acks the lot at once.
+        if not payloads:
+            self.flush_acks()
+            return
+
+        handed_at = monotonic() # each datagram says how long its payload waited here, behind the window or lost
+        with self.lock:
+            start = 0
+            while start < len(payloads):
+                window = payloads[start:start + self.send_allowance(dest_addr, dest_port)]
+                start += len(window)
+                in_flight: Dict[int, Datagram] = {}
+                for idx, payload in enumerate(window):
+                    datagram = self.send(dest_addr, dest_port, ACK | PSH if idx == len(window) - 1 else ACK, payload, age=monotonic() - handed_at)
+                    datagram.handed_at = handed_at
+                    self.seqnr = datagram.seq_end()
+                    in_flight[datagram.seqnr] = datagram
+                self.wait_window_acked(in_flight)
+
+    def send_allowance(self, dest_addr, dest_port) -> int:
+        # Datagrams the peer lets us have in flight. While its window is shut we wait, and heartbeats fetch
+        # fresh window updates since its acks won't come unprompted.
+        while self.peer_window == 0:
+            if self.sock.fileno() < 0:
+                raise ConnectionAbortedError("Socket closed while the peer's window was shut.")
+            sleep(ZERO_WINDOW_PROBE)
+            self.heartbeat(dest_addr, dest_port, wait=self.timeout)
+        return SEND_WINDOW if self.peer_window is None else min(SEND_WINDOW, self.peer_window)
+
+    def wait_window_acked(self, in_flight: Dict[int, Datagram]):
+        retries = 0
+        acked_seqnrs: List[int] = []
+        fast_retransmitted = set()
+        deadline = monotonic() + self.timeout
+        # Small windows can't have that many past a hole, they settle for all but one (early retransmit)
+        tolerance = max(1, min(REORDER_TOLERANCE, len(in_flight) - 1))
+
+        while in_flight:
+            try:
+                response = self.read(deadline - monotonic())
+            except TimeoutError:
+                retries += 1
+                if retries == SOCK_MAX_RETRIES:
+                    raise TimeoutError("Maximum retransmission attempts reached.")
+                self.sockprint(f"{len(in_flight)} datagrams not acked, resending...")
+                for datagram in in_flight.values():
+                    self.resend(datagram)
+                deadline = monotonic() + self.timeout * 2**retries # exponentially longer waits, instead of sleeping
+                continue
+
+            if response is None:
+                raise ConnectionAbortedError("Socket closed while waiting for an ACK.")
+            if not response.is_ack() or response.flags & (SYN | FIN):
+                continue
+
+            acked = [seqnr for seqnr, datagram in in_flight.items() if self.acknowledges(response, datagram)]
+            for seqnr in acked:
+                del in_flight[seqnr]
+            acked_seqnrs += acked
+            if acked:
+                retries = 0
+                deadline = monotonic() + self.timeout
+
+            # Enough made it past a hole that what's in it was most likely lost rather than late
+            if response.sack:
+                for seqnr, datagram in in_flight.items():
+                    past = sum(1 for acked_seqnr in acked_seqnrs if acked_seqnr > seqnr)
+                    if past >= tolerance and seqnr not in fast_retransmitted:
+                        fast_retransmitted.add(seqnr)
+                        self.resend(datagram)
+
+    def resend(self, datagram: Datagram):
+        age = monotonic() - datagram.handed_at if datagram.handed_at is not None else None
+        self.send(datagram.dest_addr, datagram.dest_port, datagram.flags | PSH, datagram.payload, seqnr=datagram.seqnr, age=age)
+
+    def acknowledges(self, ack: Datagram, datagram: Datagram) -> bool:
+        end = datagram.seq_end()
+        return end <= ack.acknr or any(start <= datagram.seqnr and end <= stop for start, stop in ack.sack or [])
+
     def send_ack(self, received: Datagram):
         
-        def newflags(flags: Flags) -> Flags:
-            if flags == Flags(True, False, False): return Flags(True, True, False)   # if syn return synack
-            elif flags == Flags(False, False, True): return Flags(False, True, True) # if fin return finack
-            else: return Flags(False, True, False)                                   # if anything else, return a normal ack
+        def newflags(received: Datagram) -> int:
+            if received.is_syn(): return SYN | ACK    # if syn return synack
+            elif received.is_fin(): return FIN | ACK  # if fin return finack
+            else: return ACK                          # if anything else, return a normal ack
+
+        if received.is_syn():
+            self.accept(received) # a worker socket never read the SYN itself, the entry socket did
 
         send_method = (
             self.send_and_wait_ack 
@@ -67,27 +237,163 @@ class SocketWrapper:
             else self.send
         )
 
+        # SYN and FIN are acked on their own, data cumulatively along with everything before it
         send_method(
-            dest_addr=received.origin.addr,
-            dest_port=received.origin.port,
-            flags=newflags(received.flags),
+            dest_addr=received.origin_addr,
+            dest_port=received.origin_port,
+            flags=newflags(received),
             payload=b"",
-            acknr=received.seqnr + received.payload_size()+1,
+            acknr=received.seq_end() if received.is_syn() or received.is_fin() else None,
         )
 
     #################################################################################################
 
+    def accept(self, datagram: Datagram) -> bool:
+
+        # Receiver bookkeeping, returns whether the datagram is new. Data is acked like TCP does it: an in-order
+        # datagram is acked ACK_DELAY later (or along with our next datagram), unless it's pushed or ACK_EVERY are owed.
+        # Duplicates and datagrams past a hole are acked right away, so the sender learns what's missing.
+        end = datagram.seq_end()
+        if datagram.flags & (SYN | FIN):
+            self.acknr, self.sack = end, [] # SYN (re)starts the sequence and nothing follows a FIN
+            return True
+        if datagram.payload_size() == 0:
+            return False # a bare ack takes no sequence space
+
+        self.ack_peer = (datagram.origin_addr, datagram.origin_port)
+
+        if datagram.seqnr == self.acknr:
+            self.wait_for_ack(end)
+            self.acknr = end
+            while self.sack and self.sack[0][0] <= self.acknr:
+                self.acknr = max(self.acknr, self.sack.pop(0)[1])
+            self.acks_pending += 1
+            if datagram.is_push() or self.acks_pending >= ACK_EVERY:
+                self.ack_now()
+            elif self.ack_due is None:
+                self.ack_due = monotonic() + ACK_DELAY
+            return True
+
+        new = end > self.acknr and not any(start <= datagram.seqnr and end <= stop for start, stop in self.sack)
+        if new:
+            self.wait_for_ack(end)
+            self.sack.append([datagram.seqnr, end])
+            self.sack.sort()
+            merged = []
+            for start, stop in self.sack:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], stop)
+                else:
+                    merged.append([start, stop])
+            self.sack = merged
+        self.ack_now()
+        return new
+
+    def wait_for_ack(self, end: int):
+        if self.ack_listener is not None:
+            self.unacked.append([end, monotonic()])
+
+    def report_acked(self, acknr: int):
+        now = monotonic()
+        for end, received_at in self.unacked:
+            if end <= acknr:
+                self.ack_listener(now - received_at)
+        self.unacked = [entry for entry in self.unacked if entry[0] > acknr]
+
+    def ack_now(self):
+        if self.ack_peer is not None:
+            self.send(*self.ack_peer, ACK)
+
+    def flush_acks(self):
+        if self.acks_pending:
+            self.ack_now()
+
+    def read(self, timeout=None) -> Datagram:
+        # One datagram off the socket with the receiver bookkeeping done, new data also lands in the inbox.
+        # Raises TimeoutError, returns None once the socket is closed.
+        try:
+            self.sock.settimeout(timeout if timeout is None else max(timeout, 0.001))
+            datagram, _ = self.recv_skipping_heartbeats()
+        except TimeoutError:
+            raise
+        except OSError:
+            return None
+        finally:
+            try:
+                self.sock.settimeout(None)
+            except OSError:
+                pass
+
+        if datagram is None:
+            return None
+        self.sockprint(f"Recv {datagram}")
+        if self.accept(datagram) and datagram.payload_size() and not datagram.flags & (SYN | FIN):
+            self.inbox.append(datagram)
+        return datagram
+
+    def receive_data(self, with_timeout=False) -> tuple[Datagram, str]:
+
+        # Next new data datagram, or a SYN/FIN. Duplicates never come out of here, and the delayed ack is sent
+        # while waiting if it comes due.
+        deadline = monotonic() + self.timeout if with_timeout else None
+
+        while not self.inbox:
+            if self.ack_due is not None and monotonic() >= self.ack_due:
+                self.ack_now()
+            wake = min((t for t in (deadline, self.ack_due) if t is not None), default=None)
+            try:
+                datagram = self.read(None if wake is None else wake - monotonic())
+            except TimeoutError:
+                if deadline is not None and monotonic() >= deadline:
+                    self.sockprint("Recv timeout")
+                    return None, None
+                continue
+            if datagram is None:
+                return None, None
+            if datagram.flags & (SYN | FIN):
+                return datagram, (datagram.origin_addr, datagram.origin_port)
+
+        datagram = self.inbox.popleft()
+        return datagram, (datagram.origin_addr, datagram.origin_port)
+
+    #################################################################################################
+
+    def recv_datagram(self) -> tuple[Datagram, str]:
+        buffer = recv_buffer_pool.acquire()
+        try:
+            nbytes, addr = self.sock.recvfrom_into(buffer)
+            if nbytes == 0:
+                return None, None # woken up by close()
+            if self.recorder is not None:
+                self.recorder.record(UDP, INBOUND, addr, (self.local_addr, self.local_port), memoryview(buffer)[:nbytes])
+            # Decompressing reads straight from the pooled buffer, after that nothing refers to it anymore
+            datagram = Datagram.deserialize(memoryview(buffer)[:nbytes])
+        finally:
+            recv_buffer_pool.release(buffer)
+        self.last_heard = monotonic()
+        if datagram.window is not None:
+            self.peer_window = datagram.window
+        return datagram, addr
+
+    def recv_skipping_heartbeats(self) -> tuple[Datagram, str]:
+        while True:
+            datagram, addr = self.recv_datagram()
+            if datagram is None or not self.answer_heartbeat(datagram):
+                return datagram, addr
+
     def receive(self, with_timeout=False) -> tuple[Datagram, str]:
         
         if with_timeout:
-            self.sock.settimeout(SOCK_TIMEOUT)
+            self.sock.settimeout(self.timeout)
 
         try:
-            data, addr = self.sock.recvfrom(1024)
+            datagram, addr = self.recv_skipping_heartbeats()
+            if datagram is None:
+                return None, None
             #sleep(1)
-            datagram = Datagram.deserialize(data)
             self.sockprint(f"Recv {datagram}")
-            self.acknr = datagram.seqnr+datagram.payload_size()+1
+            if datagram.payload_size() or datagram.flags & (SYN | FIN):
+                self.acknr = datagram.seq_end() # a bare ack takes no sequence space
 
             self.sock.settimeout(None)
             return datagram, addr
@@ -97,17 +403,22 @@ class SocketWrapper:
             self.sock.settimeout(None)
             return None, None
 
+        except OSError:
+            return None, None # socket closed under us
+
     def receive_and_ack(self, with_timeout=False) -> tuple[Datagram, str]:
         
         if with_timeout:
-            self.sock.settimeout(SOCK_TIMEOUT)
+            self.sock.settimeout(self.timeout)
 
         try:
-            data, addr = self.sock.recvfrom(1024)
+            datagram, addr = self.recv_skipping_heartbeats()
+            if datagram is None:
+                return None, None
             #sleep(1)
-            datagram = Datagram.deserialize(data)
             self.sockprint(f"Recv {datagram}")
-            self.acknr = datagram.seqnr+datagram.payload_size()+1
+            if datagram.payload_size() or datagram.flags & (SYN | FIN):
+                self.acknr = datagram.seq_end()
 
             self.sock.settimeout(None)
             self.send_ack(datagram)
@@ -118,15 +429,79 @@ class SocketWrapper:
             self.sock.settimeout(None)
             return None, None
 
+        except OSError:
+            return None, None # socket closed under us
+
+    #################################################################################################
+
+    def answer_heartbeat(self, datagram: Datagram) -> bool:
+        # Heartbeats are handled right here and don't move seqnr/acknr, the caller just skips them
+        if not datagram.is_heartbeat():
+            return False
+        if not datagram.is_ack():
+            self.send(datagram.origin_addr, datagram.origin_port, HBT | ACK, acknr=datagram.seqnr)
+        return True
+
+    def heartbeat(self, dest_addr, dest_port, wait) -> bool:
+        # A socket busy in an exchange isn't idle, so a heartbeat would be redundant
+        if not self.lock.acquire(blocking=False):
+            return True
+
+        try:
+            self.send(dest_addr, dest_port, HBT)
+            deadline = monotonic() + wait
+            while deadline > monotonic():
+                self.sock.settimeout(deadline - monotonic())
+                datagram, _ = self.recv_datagram()
+                if datagram is None:
+                    return False
+                if datagram.is_heartbeat() and datagram.is_ack():
+                    return True
+                self.answer_heartbeat(datagram) # anything else arriving while idle is stale
+            return False
+        except OSError: # includes the timeout
+            return False
+        finally:
+            try:
+                self.sock.settimeout(None)
+            except OSError:
+                pass
+            self.lock.release()
+
+    def keep_alive(self, dest_addr, dest_port, on_dead, interval=HEARTBEAT_INTERVAL, misses=HEARTBEAT_MISSES):
+        # Heartbeats the peer whenever nothing was heard from it for an interval, and calls on_dead once
+        # it has been silent for misses intervals. Anything received counts, not only heartbeat answers.
+        def beat_forever():
+            while self.sock.fileno() >= 0:
+                sleep(interval)
+                if monotonic() - self.last_heard >= interval:
+                    self.heartbeat(dest_addr, dest_port, wait=interval)
+                if monotonic() - self.last_heard > interval * misses:
+                    self.sockprint(f"No sign of {dest_addr}:{dest_port} for {interval * misses} s, giving up on it.")
+                    on_dead()
+                    return
+
+        self.last_heard = monotonic()
+        self.heartbeat_thread = Thread(target=beat_forever, daemon=True, name=f"heartbeat-{self.local_port}")
+        self.heartbeat_thread.start()
+
     #################################################################################################
 
     def close(self):
+        # shutdown wakes up any thread blocked receiving on this socket, close alone doesn't
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
 
     #################################################################################################
 
     def sockprint(self, string, deviceID=None):
 
+        if not self.verbose:
+            return
+
         # deviceID is an argument that's only useful when using sockprint from a Server_Worker instance.
         port = f"{self.local_port}"
         if deviceID is not None:
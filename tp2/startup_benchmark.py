@@ -0,0 +1,104 @@
+from typing import Dict, List, Tuple
+from statistics import median
+from time import monotonic
+
+import subprocess
+import sys
+import os
+
+# Agent cold start: what importing testclient costs (from python -X importtime) and, given a running server,
+# how long a fresh agent process takes from launch to its first acknowledged report.
+# Usage: python3 startup_benchmark.py [server_host deviceID]
+
+IMPORT_RUNS = 5
+TOP_MODULES = 10
+FIRST_REPORT_TIMEOUT = 120 # seconds, a first report takes at least one report period of the agent's tasks
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    # Lines look like "import time:   self [us] | cumulative | imported package", the first one is the header
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split('|')
+        if not fields[0].strip().isdigit():
+            continue
+        modules.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return modules
+
+def import_profile(module: str = "testclient", runs: int = IMPORT_RUNS) -> Tuple[float, List[Tuple[str, int, int]]]:
+    totals = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=here, capture_output=True, text=True
+        )
+        modules = parse_importtime(result.stderr)
+        totals.append(sum(self_us for _, self_us, _ in modules))
+
+    # Only the last run's breakdown, the first one may still have been reading from disk
+    return median(totals) / 1000, modules
+
+def time_to_first_report(server_host: str, deviceID: str, timeout: float = FIRST_REPORT_TIMEOUT) -> str:
+    agent = subprocess.Popen(
+        [sys.executable, "-u", "testclient.py", server_host, deviceID],
+        cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    deadline = monotonic() + timeout
+    try:
+        for line in agent.stdout:
+            if "Startup:" in line:
+                return line[line.index("Startup:"):].strip().removesuffix("\033[0m")
+            if monotonic() > deadline:
+                break
+        return "No report acknowledged in time."
+    finally:
+        agent.kill()
+        agent.wait()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in {1, 3}:
+        print("Usage: python3 startup_benchmark.py [server_host deviceID]")
+        sys.exit(1)
+
+    total_ms, modules = import_profile()
+    print(f"import testclient: {total_ms:.1f} ms (median of {IMPORT_RUNS} runs)\n")
+    print(f"{'Module':40} {'self ms':>8} {'cumul ms':>9}")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda m: m[1], reverse=True)[:TOP_MODULES]:
+        print(f"{name:40} {self_us/1000:8.1f} {cumulative_us/1000:9.1f}")
+
+    if len(sys.argv) == 3:
+        print(f"\n{time_to_first_report(sys.argv[1], sys.argv[2])}")
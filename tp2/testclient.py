@@ -1,42 +1,68 @@
-from typing import Dict
+from time import perf_counter, monotonic
+AGENT_STARTED = perf_counter() # taken before any other import, so startup milestones include import time
 
-from socketwrapper import SocketWrapper
-from datagram import Flags, Datagram
+from typing import Dict, TYPE_CHECKING
+
+from socketwrapper import SocketWrapper, HEARTBEAT_INTERVAL, SOCK_GIVE_UP, SEND_WINDOW
+from datagram import Datagram, SYN, ACK, FIN
 from utils import get_local_addr, Colours, NETTASK_SERVER_PORT
 
 from nettask_message import NetTask_Message
 from nettask_report import NetTask_Report
 from nettask_task import NetTask_Task
-from nettask_task_runner import NetTask_Task_Runner
+from session_symbols import Session_Symbols
+from udp_prober import UDP_Echo_Responder
+from throughput_engine import Throughput_Engine_Server, Iperf_Endpoint
 
 from alertflow_report import AlertFlow_Report
+from alert_tracker import Alert_Tracker
+from profiling import Profiler
 
 from socket import socket, AF_INET, SOCK_STREAM
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
 
 import sys
 
+# The task runners pull in psutil and the probe executor asyncio, they're imported once there are tasks to run
+if TYPE_CHECKING:
+    from nettask_task_runner import NetTask_Task_Runner
+    from nettask_probe_executor import NetTask_Probe_Executor
+IMPORTS_DONE = perf_counter()
+
 class Client:
-    def __init__(self, server_host, deviceID, port):
+    def __init__(self, server_host, deviceID, port, native_probes=False, heartbeat_interval=HEARTBEAT_INTERVAL, local_addr=None, verbose=True, server_port=NETTASK_SERVER_PORT):
         
         ###### NetTask-Related #######################
         self.server_host = server_host
-        self.server_port = NETTASK_SERVER_PORT
-        self.nettask_socket = SocketWrapper(local_addr=get_local_addr(server_host), local_port=port)
+        self.server_port = server_port
+        self.local_addr = local_addr or get_local_addr(server_host) # replays pass made-up loopback addresses here
+        self.nettask_socket = SocketWrapper(local_addr=self.local_addr, local_port=port, verbose=verbose)
         self.nettask_report_queue: Queue[NetTask_Report] = Queue()
+        self.heartbeat_interval = heartbeat_interval
+        self.server_alive = True
         
         ###### AlertFlow-Related #####################
         self.alertflow_socket = socket(AF_INET, SOCK_STREAM)
-        self.alertflow_socket.bind((get_local_addr(server_host), port))
+        self.alertflow_socket.bind((self.local_addr, self.nettask_socket.local_port)) # the server expects both on one port
         self.alertflow_report_queue: Queue[AlertFlow_Report] = Queue()
+        self.alert_tracker = Alert_Tracker(deviceID) # spikes go out as alert transitions, not once per period
 
         ###### Tasks/Reports #########################
         self.deviceID = deviceID
         self.reports_to_send = None
 
         self.tasks: Dict[str, NetTask_Task] = {} # taskID -> task
-        self.task_runners: Dict[str, NetTask_Task_Runner] = {} # taskID -> taskrunner thread
+        self.symbols: Session_Symbols = None     # set if the server sent a symbol table with the tasks
+        self.task_runners: Dict[str, 'NetTask_Task_Runner'] = {} # taskID -> taskrunner thread
+        self.probe_executor: 'NetTask_Probe_Executor' = None # ping/iperf for every task, created with the first runner
+        self.native_probes = native_probes
+
+        ###### Profiling #############################
+        self.profiler = Profiler(f"agent-{deviceID}", components=self.runners_cpu)
+
+        ###### Startup ###############################
+        self.startup: Dict[str, float] = {'imports': IMPORTS_DONE - AGENT_STARTED} # milestone -> seconds since the process started
 
     # Threaded Report Sending ###################################################################
 
@@ -47,6 +73,7 @@ class Client:
             try:
                 while True:
                     report: AlertFlow_Report = self.alertflow_report_queue.get()
+                    report.close_trace()
                     print(report)
                     self.alertflow_socket.sendall(report.serialize())
             except KeyboardInterrupt:
@@ -55,45 +82,92 @@ class Client:
         af_thread = Thread(target=alertflow_sender_thread, daemon=True)
         af_thread.start()
 
+        # Between reports the socket is idle, heartbeats let both ends notice if the other one disappears
+        self.nettask_socket.keep_alive(self.server_host, self.server_port, self.lose_server, interval=self.heartbeat_interval)
+
         try:
-            while True:
-                report: NetTask_Report = self.nettask_report_queue.get()
-                print(report)
-                ntmessage: NetTask_Message = NetTask_Message(author=self.deviceID, tag='r', payload=report.serialize())
-                self.nettask_socket.send_and_wait_ack(
-                    dest_addr=self.server_host,
-                    dest_port=self.server_port,
-                    flags=Flags(False, True, False),
-                    payload=ntmessage.serialize()
-                )
+            while self.server_alive:
+                try:
+                    reports = [self.nettask_report_queue.get(timeout=self.heartbeat_interval)]
+                except Empty:
+                    continue
+                # Tasks sharing a period report at the same time, whatever piled up goes out as one window
+                while len(reports) < SEND_WINDOW and not self.nettask_report_queue.empty():
+                    reports.append(self.nettask_report_queue.get_nowait())
+
+                payloads = []
+                author = self.symbols.symbol(self.deviceID) if self.symbols is not None else self.deviceID
+                for report in reports:
+                    print(report)
+                    report.close_trace()
+                    ntmessage: NetTask_Message = NetTask_Message(author=author, tag='r', payload=report.serialize(self.symbols))
+                    payloads.append(ntmessage.serialize())
+                self.nettask_socket.send_window(self.server_host, self.server_port, payloads)
+                if 'first_report' not in self.startup:
+                    self.mark_startup('first_report')
+                    print(Colours.nettask_styling(self.startup_summary()))
+        except OSError:
+            if self.server_alive: raise
+            print(f"Server lost, {self.nettask_report_queue.qsize()} reports left unsent.")
         except KeyboardInterrupt:
             pass                        
 
+    def lose_server(self):
+        # Closing the sockets unblocks whatever exchange was waiting on the dead server
+        self.server_alive = False
+        self.alertflow_socket.close()
+        self.nettask_socket.close()
+
     def instantiate_task_runners(self):
 
+        from nettask_task_runner import NetTask_Task_Runner
+        from nettask_probe_executor import NetTask_Probe_Executor
+
+        if self.probe_executor is None and any(NetTask_Probe_Executor.wants_probes(t) for t in self.tasks.values()):
+            self.probe_executor = NetTask_Probe_Executor(target_host=self.server_host, native_probes=self.native_probes)
+
         for tID, t in self.tasks.items():
             new_runner = NetTask_Task_Runner(
                 deviceID=self.deviceID,
                 task=t,
-                report_enqueuing_method=self.enqueue_report
+                report_enqueuing_method=self.enqueue_report,
+                probe_executor=self.probe_executor
             )
             self.task_runners[tID] = new_runner
 
+        self.mark_startup('runners')
+
     def enqueue_report(self, nt_report, af_report=None):        
+        nt_report.stamp('enqueued')
         self.nettask_report_queue.put(nt_report)
-        if af_report is not None:
-            self.alertflow_report_queue.put(af_report)
+        for alert in self.alert_tracker.update(nt_report.taskID, af_report):
+            alert.stamp('enqueued')
+            self.alertflow_report_queue.put(alert)
+
+    def runners_cpu(self) -> Dict[str, float]:
+        return {f"task-{taskID}": runner.cpu.seconds() for taskID, runner in self.task_runners.items()}
+
+    # Startup Metrics ###########################################################################
+
+    def mark_startup(self, milestone: str):
+        self.startup[milestone] = perf_counter() - AGENT_STARTED
+
+    def startup_summary(self) -> str:
+        return "Startup: " + ", ".join(f"{milestone} {seconds*1000:.0f} ms" for milestone, seconds in self.startup.items())
 
     # Initial Communication #####################################################################
 
     def handshake(self):
+        # The SYN carries a bare NetTask message with our deviceID so a sharded server can route the session on it
         synack_received: Datagram = self.nettask_socket.send_and_wait_ack(
-            dest_addr=self.server_host, dest_port=self.server_port, flags=Flags(syn=True, ack=False, fin=False)
+            dest_addr=self.server_host, dest_port=self.server_port, flags=SYN,
+            payload=NetTask_Message(author=self.deviceID, tag='c').serialize()
         )
         # The synack is received from a port other than 9000, thus we update the new port of communication
-        self.server_port = synack_received.origin.port
+        self.server_port = synack_received.origin_port
         print(f"New server port: {self.server_port}")
         self.nettask_socket.send_ack(synack_received)
+        self.mark_startup('handshake')
 
     def send_nettask_control_message(self):
 
@@ -101,22 +175,28 @@ class Client:
         payload = msg.serialize()
 
         print(f"Sending empty NetTask message as payload of size: {len(payload)} B")
+        # Not pushed: the server answers with the tasks, the first one carries the ack
         self.nettask_socket.send_and_wait_ack(
-            self.server_host, self.server_port, Flags(syn=False, ack=True, fin=False),
-            payload=payload
+            self.server_host, self.server_port, ACK,
+            payload=payload, push=False
         )
 
     def listen_for_nettask_tasks(self):
         
         def collect_task(ntmessage: NetTask_Message) -> str:
-            task = NetTask_Task.deserialize(ntmessage.payload)
+            task = ntmessage.task()
             self.tasks[task.taskID] = task
             return task.taskID
         
         print("Ready to receive tasks.")
-
-        while True:
-            datagram, _ = self.nettask_socket.receive()
+        final_received = False
+        table = None
+
+        # Tasks come as one window and may arrive out of order, the final one only ends it once no hole is left before it
+        while not final_received or self.nettask_socket.sack:
+            datagram, _ = self.nettask_socket.receive_data(with_timeout=True)
+            if not datagram and monotonic() - self.nettask_socket.last_heard > SOCK_GIVE_UP:
+                raise TimeoutError("The server stopped sending tasks.") # its worker gave up on a lost task
             if not datagram or datagram.payload_size()==0: continue
             
             ntmessage = NetTask_Message.deserialize(datagram.payload)
@@ -124,22 +204,31 @@ class Client:
 
             contains_task, is_final_task = ntmessage.contains_task()
             if contains_task:
-                self.nettask_socket.send_ack(datagram)
                 taskID = collect_task(ntmessage)
                 print(f"A task was collected: {self.tasks[taskID]}")
 
                 if is_final_task:
                     print("Received the final task.")
-                    break
+                    final_received = True
+                    table = ntmessage.symbols
+
+        self.nettask_socket.flush_acks() # no more datagrams coming for a delayed ack to wait for
+        if table is not None:
+            self.symbols = Session_Symbols(table, self.tasks) # once every task is in, the final one may have come first
+        self.mark_startup('tasks')
 
     def connect_alertflow(self):
         print("Attempting connection to AlertFlow socket.")
         self.alertflow_socket.connect((self.server_host, self.server_port))
 
     def close(self):
-        self.nettask_socket.send_and_wait_ack(
-            self.server_host, self.server_port, Flags(syn=False, ack=False, fin=True)
+        if not self.server_alive:
+            return # nobody left to say goodbye to
+        finack = self.nettask_socket.send_and_wait_ack(
+            self.server_host, self.server_port, FIN
         )
+        self.nettask_socket.send_ack(finack) # lets the worker stop waiting and be reaped right away
+        self.alertflow_socket.close()
         self.nettask_socket.close()
 
 
@@ -182,15 +271,25 @@ class Client:
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 3:
-        print("Usage: python3 testclient.py <server_host> <deviceID> <port>")
+    if len(sys.argv) not in {3, 4}:
+        print("Usage: python3 testclient.py <server_host> <deviceID> [native]")
         sys.exit(1)
     
     # Extract command-line arguments
     server_host = sys.argv[1]
     deviceID = sys.argv[2]
+    native_probes = len(sys.argv) == 4 and sys.argv[3] == "native"
     
-    client = Client(server_host, deviceID, port=2000)
+    client = Client(server_host, deviceID, port=2000, native_probes=native_probes)
+    client.profiler.install_signals() # kill -USR1 for a profiling window, -USR2 for the CPU time of every task
+
+    # Peer agents whose tasks name us as probe_target need someone answering on this side
+    try:
+        probe_responder = UDP_Echo_Responder(local_addr=get_local_addr(server_host))
+        throughput_engine = Throughput_Engine_Server(local_addr=get_local_addr(server_host))
+    except OSError:
+        print("Probe ports already taken here (server on this same host?), won't answer peer probes.")
+    iperf_endpoint = Iperf_Endpoint(local_addr=get_local_addr(server_host))
     
     client.handshake()
     print("Handshake done!")
@@ -206,4 +305,5 @@ if __name__ == "__main__":
     client.send_enqueued_reports()
     
     client.close()
+    iperf_endpoint.close()
 
@@ -2,22 +2,44 @@ from nettask_task import NetTask_Task
 from nettask_message import NetTask_Message
 from nettask_report import NetTask_Report
 
-from alertflow_report import AlertFlow_Report
-
-from socketwrapper import SocketWrapper
-from datagram import Datagram, Flags
-from utils import NETTASK_SERVER_PORT, get_local_addr, randint_excluding, print_directory
+from alertflow_report import AlertFlow_Report, AlertFlow_Stream
+
+from socketwrapper import SocketWrapper, HEARTBEAT_INTERVAL, HEARTBEAT_MISSES, SEND_WINDOW
+from udp_prober import UDP_Echo_Responder
+from throughput_engine import Throughput_Engine_Server, Iperf_Endpoint
+from datagram import Datagram
+from report_store import make_store, storage_backends
+from ingest_pipeline import Ingest_Pipeline
+from session_symbols import Session_Symbols
+from report_rollups import Report_Rollups, ROLLUP_RETENTION
+from latency_tracing import Latency_Histograms
+from wire_capture import Capture_Writer, TCP, INBOUND
+from profiling import Profiler, Thread_CPU_Meter
+from utils import NETTASK_SERVER_PORT, get_local_addr, randint_excluding, Token_Bucket
 
 from typing import List, Set, Tuple, Dict
-from threading import Thread
-from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread, Lock
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR, SOL_SOCKET, SO_REUSEADDR
+from errno import EADDRINUSE
+from time import monotonic, sleep, perf_counter
+from copy import copy
+from math import isfinite
 
 import json
 import os
 import shutil
-from datetime import datetime
+import sys
 
 LOGS_BASE_DIR = "logs"
+WORKER_PORT_RANGE = (49152, 65535)
+SESSION_IDLE_TIMEOUT = HEARTBEAT_INTERVAL * HEARTBEAT_MISSES  # agents heartbeat when idle, so silence this long means they're gone
+REAPER_INTERVAL = HEARTBEAT_INTERVAL
+WORKER_JOIN_TIMEOUT = 2
+ALERTFLOW_RECV_SIZE = 64 * 1024
+SESSION_REPORT_RATE = 50              # reports per second a session is allowed in the long run
+SESSION_REPORT_BURST = 2 * SEND_WINDOW  # reports a session may send at once after being quiet
+RELAY_REPORT_RATE = 5000              # reports per second of a relay's session, for all of its site's agents together
+SESSION_THROTTLE_MAX = HEARTBEAT_INTERVAL # longest a receive thread sleeps off a session's debt, heartbeats go unanswered meanwhile
 
 
 
@@ -31,60 +53,103 @@ LOGS_BASE_DIR = "logs"
 
 
 class Server_Worker:
-    def __init__(self, port: int, syn: Datagram, fetch_tasks_method):
+    def __init__(
+            self, port: int, syn: Datagram, fetch_tasks_method, ingest: Ingest_Pipeline, recorder: Capture_Writer = None,
+            session_rate_method = None, latency: Latency_Histograms = None
+        ):
         
         
-        self.nettask_socket = SocketWrapper(local_addr=get_local_addr(), local_port=port)
-        self.agent_addr = syn.origin.addr
-        self.agent_port = syn.origin.port
+        self.port = port
+        self.recorder = recorder
+        self.nettask_socket = SocketWrapper(local_addr=get_local_addr(), local_port=port, recorder=recorder)
+        self.agent_addr = syn.origin_addr
+        self.agent_port = syn.origin_port
         
         self.agent_deviceID: str = None
         self.tasks: Dict[str, NetTask_Task] = None
+        self.symbols: Session_Symbols = None # what the agent's reports leave out, once its tasks are known
         self.fetch_tasks = fetch_tasks_method
+        self.session_rate = session_rate_method or (lambda deviceID: SESSION_REPORT_RATE)
+        self.ingest = ingest  # reports are stored by its writer threads, never by ours
+        self.latency = latency
+
+        self.reports_received: int = 0
+        self.spikes_received: int = 0
+        self.reports_throttled: int = 0
+
+        # The agent is told how much it may send in every ack, and paced if it sends more anyway
+        self.bucket = Token_Bucket(SESSION_REPORT_RATE, SESSION_REPORT_BURST)
+        self.nettask_socket.window_provider = self.receive_window
+        if latency is not None:
+            self.nettask_socket.ack_listener = lambda seconds: latency.record('report', 'ack', self.agent_deviceID or '?', seconds)
+
+        self.last_seen: float = monotonic()
+        self.finished: bool = False # agent sent FIN or closed its AlertFlow connection
+        self.cpu = Thread_CPU_Meter() # both of this session's threads
         
         
         self.alertflow_socket = socket(AF_INET, SOCK_STREAM)
-        self.alertflow_socket.bind((get_local_addr(), port))
-        self.alertflow_thread = Thread(target=self.listen_for_spikes, daemon=True)
+        # The port's last session may still have its connection in TIME_WAIT
+        self.alertflow_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        try:
+            self.alertflow_socket.bind((get_local_addr(), port))
+        except OSError:
+            self.alertflow_socket.close()
+            self.nettask_socket.close()
+            raise
+        # Listening right away: the agent connects as soon as it acks the last task, which may happen before start_alertflow runs
+        self.alertflow_socket.listen(1)
+        self.alertflow_thread = Thread(target=self.cpu.wrap(self.listen_for_spikes), daemon=True, name=f"alertflow-{port}")
         self.alertflow_peer_socket: socket = None
 
-        self.worker_thread = Thread(target=self.begin, args=(syn,), daemon=True)
-        self.worker_thread.start()
-
         self.worker_is_alive = True
 
+        self.worker_thread = Thread(target=self.cpu.wrap(self.begin), args=(syn,), daemon=True, name=f"worker-{port}")
+        self.worker_thread.start()
+
     ###########################################################################################################
 
     def listen_for_nettask_control_message(self) -> str:
-        while True:
+        while self.worker_is_alive:
             self.portprint("Blockingly listening for an empty message.")
-            datagram, _ = self.nettask_socket.receive()
+            datagram, _ = self.nettask_socket.receive_data()
             if not datagram or datagram.payload_size()==0:
                 continue
+            self.touch()
                      
             ntmessage = NetTask_Message.deserialize(datagram.payload)
             self.portprint(f"Got a message! {ntmessage}")
             if ntmessage is not None and ntmessage.contains_only_header():
-                self.nettask_socket.send_ack(datagram)
-                return str(ntmessage.author)
+                return str(ntmessage.author) # acked by the first task, which goes out right after
             else:
                 self.portprint("Received something other than a bare message. Ignored.")
 
     def send_tasks(self):
-        def send_single_task(task: NetTask_Task, is_last=False):
-            ntmessage = NetTask_Message(author=self.agent_addr, tag='f' if is_last else 't', payload=task.serialize())
-            self.send_data(ntmessage.serialize())
+        # The final task brings the session's symbol table, from then on the agent's reports are interned against it
+        table = Session_Symbols.session_table(self.agent_deviceID, self.tasks)
+        self.symbols = Session_Symbols(table, self.tasks)
+
+        def task_payload(task: NetTask_Task, is_last=False) -> bytes:
+            ntmessage = NetTask_Message(
+                author=self.agent_addr, tag='f' if is_last else 't', payload=task.serialize(), symbols=table if is_last else None
+            )
+            return ntmessage.serialize()
 
+        # All of them in one window, the agent acks them together
         tasks = list(self.tasks.values())
-        for idx, task in enumerate(tasks):
-            send_single_task(task, is_last=(idx == len(tasks) - 1))
+        self.nettask_socket.send_window(
+            self.agent_addr, self.agent_port,
+            [task_payload(task, is_last=(idx == len(tasks) - 1)) for idx, task in enumerate(tasks)]
+        )
 
     def start_alertflow(self):
         
-        while True:
+        while self.worker_is_alive:
             self.portprint(f"Awaiting AlertFlow connection from {self.agent_addr}:{self.agent_port}")
-            self.alertflow_socket.listen(1)
-            peer_socket, peer_name = self.alertflow_socket.accept()
+            try:
+                peer_socket, peer_name = self.alertflow_socket.accept()
+            except OSError:
+                return # reaped while waiting
             if peer_name[0] == self.agent_addr and peer_name[1] == self.agent_port:
                 self.portprint("AlertFlow connection achieved!")
                 self.alertflow_peer_socket = peer_socket
@@ -93,85 +158,120 @@ class Server_Worker:
                 self.portprint(f"Incorrectly received connection attempt from {peer_name[0]}:{peer_name[1]}.")
                 peer_socket.close()
 
-        self.alertflow_thread.start()
+        if self.alertflow_peer_socket is not None:
+            self.alertflow_thread.start()
 
     def listen_for_reports(self):
-        while True:
+        while self.worker_is_alive:
             self.portprint("Blockingly listening for a report.")
-            datagram, _ = self.nettask_socket.receive()
-            if not datagram or datagram.payload_size()==0:
+            datagram, _ = self.nettask_socket.receive_data() # acks go out by themselves, cumulatively
+            if not datagram:
+                continue
+            received_at = perf_counter()
+            self.touch()
+
+            if datagram.is_fin():
+                self.portprint("Agent is closing the session.")
+                self.finished = True
+                try:
+                    self.nettask_socket.send_ack(datagram)
+                except Exception: pass # the agent is leaving anyway, the reaper cleans up either way
+                return
+
+            if datagram.payload_size()==0:
                 continue
                         
             ntmessage = NetTask_Message.deserialize(datagram.payload)
             self.portprint(f"Got a message! {ntmessage}")
-            if ntmessage is not None and ntmessage.contains_report():
-                self.nettask_socket.send_ack(datagram)
-                self.add_report_to_logfile(NetTask_Report.deserialize(ntmessage.payload))
+            if ntmessage is not None and (ntmessage.contains_report(self.symbols) or ntmessage.contains_report_batch()):
+                # A relay's batch costs a token per report in it, or relays would get around the session's rate
+                wait = self.bucket.take(len(ntmessage.report_batch()) if ntmessage.tag == 'b' else 1)
+                if wait > 0:
+                    # Over its rate despite the window: only this session slows down, ingest and the others don't.
+                    # A big batch's debt outlasts the sleep, the window stays shut until it's paid off.
+                    self.reports_throttled += 1
+                    sleep(min(wait, SESSION_THROTTLE_MAX))
+                    self.touch()
+                if ntmessage.tag == 'b':
+                    # Relayed reports keep the time the relay received them, and only their agent's part of the trace
+                    for timestamp, report in ntmessage.report_batch():
+                        self.reports_received += 1
+                        self.add_report_to_logfile(report, received_at, timestamp, self.trace('report', report.deviceID, report.trace))
+                else:
+                    self.reports_received += 1
+                    report = ntmessage.report()
+                    age = self.trace('report', report.deviceID, report.trace)
+                    if self.latency is not None and datagram.age is not None:
+                        self.latency.record('report', 'transport', report.deviceID, datagram.age)
+                        age += datagram.age
+                    self.add_report_to_logfile(report, received_at, age=age)
             else:
                 self.portprint("Received something other than a report. Ignored.")
 
     def listen_for_spikes(self):
+        stream = AlertFlow_Stream() # keeps the start of a report whose end hasn't arrived yet
         while self.worker_is_alive:
             self.portprint("(ALERTFLOW) Blockingly listening for a spike report.")
-            report: AlertFlow_Report = AlertFlow_Report.deserialize(self.alertflow_peer_socket.recv(1024))
-            self.add_spike_to_spikefile(report)
+            try:
+                data = self.alertflow_peer_socket.recv(ALERTFLOW_RECV_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                self.portprint("(ALERTFLOW) Agent closed the connection.")
+                self.finished = True
+                return
+
+            received_at = perf_counter()
+            if self.recorder is not None:
+                self.recorder.record(TCP, INBOUND, (self.agent_addr, self.agent_port), self.alertflow_socket.getsockname(), data)
+            self.touch()
+
+            for report in stream.feed(data):
+                self.spikes_received += 1
+                self.add_spike_to_spikefile(report, received_at, self.trace('alert', report.deviceID(), report.trace))
+
+    def receive_window(self) -> int:
+        # Reports the agent may have in flight: what ingest has room for, and no more than the session's tokens.
+        # The ack goes out before the report it covers is charged, same for any still waiting in the inbox.
+        credit = self.ingest.credit(self.agent_deviceID or '', SEND_WINDOW)
+        uncharged = len(self.nettask_socket.inbox) + 1
+        return max(0, min(credit, int(self.bucket.available()) - uncharged))
+
+    def touch(self):
+        self.last_seen = monotonic()
+
+    def idle_time(self) -> float:
+        # Heartbeats are answered inside the socket wrapper, so its last_heard covers them
+        return monotonic() - max(self.last_seen, self.nettask_socket.last_heard)
+
+    def shutdown(self):
+        # Unblocks every thread of this worker by closing the sockets they wait on, then waits for them to exit
+        self.worker_is_alive = False
+
+        self.nettask_socket.close()
+        for sock in [self.alertflow_peer_socket, self.alertflow_socket]:
+            if sock is None: continue
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+        for thread in [self.worker_thread, self.alertflow_thread]:
+            if thread.is_alive():
+                thread.join(timeout=WORKER_JOIN_TIMEOUT)
 
-    def send_data(self, payload):
-        self.nettask_socket.send_and_wait_ack(
-            self.agent_addr, self.agent_port, Flags(syn=False, ack=True, fin=False), payload=payload
-        )
-    
     ########################################################################################################### 
 
-    def add_report_to_logfile(self, report: NetTask_Report):
-
-        print(report)
-        device_dir = os.path.join(LOGS_BASE_DIR, report.deviceID)
-        task_file_path = os.path.join(device_dir, f"{report.taskID}.json")
-
-        # Ensure the device directory exists
-        os.makedirs(device_dir, exist_ok=True)
-
-        # Load existing data from the JSON file if it exists
-        if os.path.exists(task_file_path):
-            with open(task_file_path, "r") as task_file:
-                try:
-                    existing_data = json.load(task_file)
-                except json.JSONDecodeError:
-                    existing_data = {} 
-        else:
-            existing_data = {}
-
-        existing_data[str(datetime.now())] = report.to_dict()
-
-        with open(task_file_path, "w") as task_file:
-            json.dump(existing_data, task_file, indent=4)    
-
-    def add_spike_to_spikefile(self, report: AlertFlow_Report):
-        
-        print(report)
-        device_dir = os.path.join(LOGS_BASE_DIR, report.deviceID())
-        spike_file_path = os.path.join(device_dir, f"{report.taskID()}spikes.json")
-
-        # Ensure the device directory exists
-        os.makedirs(device_dir, exist_ok=True)
-
-        # Load existing data from the JSON file if it exists
-        if os.path.exists(spike_file_path):
-            with open(spike_file_path, "r") as spike_file:
-                try:
-                    existing_data: Dict = json.load(spike_file)
-                except json.JSONDecodeError:
-                    existing_data: Dict = {}  # If file is empty or corrupted, initialize as empty list
-        else:
-            existing_data: Dict = {}
+    def add_report_to_logfile(self, report: NetTask_Report, received_at: float, timestamp: float = None, age: float = 0.0):
+        self.ingest.submit_report(report, received_at, timestamp, age)
 
-        # Append the new report's dictionary representation to the data
-        existing_data[str(datetime.now())] = report.to_full_dict()
+    def add_spike_to_spikefile(self, report: AlertFlow_Report, received_at: float, age: float = 0.0):
+        self.ingest.submit_spike(report, received_at, age)
 
-        # Write the updated data back to the file
-        with open(spike_file_path, "w") as spike_file:
-            json.dump(existing_data, spike_file, indent=4)
+    def trace(self, kind: str, deviceID: str, trace) -> float:
+        # Records the agent's stages, returns the seconds they add up to
+        return self.latency.record_trace(kind, deviceID, trace) if self.latency is not None else 0.0
 
     ###########################################################################################################
 
@@ -181,6 +281,14 @@ class Server_Worker:
     ###########################################################################################################
 
     def begin(self, syn):
+        try:
+            self.run_session(syn)
+        except OSError as e:
+            # The agent stopped acking, or we were reaped mid-exchange and the socket is gone. The reaper takes it from here
+            self.portprint(f"Session aborted: {e}")
+            self.finished = True
+
+    def run_session(self, syn):
         self.portprint(f"A server worker is born.")
 
         # send synack and receive ack back
@@ -189,7 +297,14 @@ class Server_Worker:
         
         # obtain agent's deviceID
         self.agent_deviceID = self.listen_for_nettask_control_message()
+        if self.agent_deviceID is None:
+            return # reaped before identifying itself
         self.portprint(f"Obtained the agent's deviceID: {self.agent_deviceID}. Will be sending its tasks up next.")
+
+        # Relays speak for a whole site: their session gets its own rate, and a second of it as burst for their batches
+        rate = self.session_rate(self.agent_deviceID)
+        if rate != self.bucket.rate:
+            self.bucket = Token_Bucket(rate, max(SESSION_REPORT_BURST, rate))
         
         # obtain deviceID's corresponding tasks
         self.tasks = self.fetch_tasks(self.agent_deviceID)
@@ -219,30 +334,77 @@ class Server_Worker:
 
 class Server:
 
-    def __init__(self, config_filepath):
-
+    def __init__(
+            self,
+            config_filepath,
+            logs_dir: str = LOGS_BASE_DIR,
+            port_range: Tuple[int, int] = WORKER_PORT_RANGE,
+            entry_port: int = NETTASK_SERVER_PORT,
+            reuse_port: bool = False,
+            session_timeout: float = SESSION_IDLE_TIMEOUT,
+            session_report_rate: float = SESSION_REPORT_RATE,
+            storage: str = 'json',
+            capture_path: str = None,
+            store = None,
+            rollup_retention: Dict[str, float] = ROLLUP_RETENTION,
+            detect_anomalies: bool = False
+        ):
+
+        self.logs_dir = logs_dir
+        self.port_range = port_range
+        self.session_timeout = session_timeout
+        self.session_report_rate = session_report_rate
 
         self.tasks: Dict[str, NetTask_Task] = {}
         self.device_to_tasks: Dict[str, List[str]] = {}  # tasks assigned to each device
         self.task_to_devices: Dict[str, List[str]] = {}  # devices assigned to each task
-
+        self.relay_report_rates: Dict[str, float] = {}   # relayID -> reports per second its session is allowed
+
+        self.store = store if store is not None else make_store(storage, logs_dir) # relays bring their own
+        self.recorder = Capture_Writer(capture_path) if capture_path is not None else None
+        # Relays only pass reports on, the server they report to keeps the rollups (rollup_retention=None for none)
+        self.rollups = Report_Rollups(logs_dir, retention=rollup_retention) if store is None and rollup_retention is not None else None
+        self.detector = None
+        if detect_anomalies:
+            from anomaly_detector import Anomaly_Detector # pulls in NumPy, only servers that detect need it
+            # Outliers it finds are stored like the spikes agents send
+            self.detector = Anomaly_Detector(lambda report: self.ingest.submit_spike(report, perf_counter()))
+        self.latency = Latency_Histograms() # where each report's and alert's time went, per device
+        self.ingest = Ingest_Pipeline(self.store, rollups=self.rollups, detector=self.detector, latency=self.latency)
         self.load_config(config_filepath)
         self.create_logfiles()
 
         self.host = get_local_addr()
-        self.nettask_port = NETTASK_SERVER_PORT
-        self.entry_socket = SocketWrapper(local_addr=self.host, local_port=self.nettask_port)
-        print(f"Server listening on {self.host}:{self.nettask_port}")        
+        self.nettask_port = entry_port
+        self.entry_socket: SocketWrapper = None
+
+        # Without an entry port, SYNs are handed over by someone else (see sharded_server.py)
+        if self.nettask_port is not None:
+            self.entry_socket = SocketWrapper(local_addr=self.host, local_port=self.nettask_port, reuse_port=reuse_port, recorder=self.recorder)
+            print(f"Server listening on {self.host}:{self.nettask_port}")        
 
         self.used_ports: set = {NETTASK_SERVER_PORT}
-        self.current_connections: dict = {}
+        self.current_connections: Dict[Tuple[str, int], Server_Worker] = {}  # keyed by the agent's (addr, port)
+        self.connections_lock = Lock()  # the reaper thread and entry_listen both touch the two above
+        self.sessions_reaped: int = 0
+        self.reports_reaped: int = 0  # totals of reaped workers, so stats() keeps counting them
+        self.throttled_reaped: int = 0
+        self.spikes_reaped: int = 0
+
+        self.reaper_thread = Thread(target=self.reap_forever, daemon=True, name="session-reaper")
+        self.reaper_thread.start()
+
+        self.profiler = Profiler('server', components=self.sessions_cpu)
 
     ###########################################################################################################
 
     def entry_listen(self):
         while True:
             datagram, addr = self.entry_socket.receive()
-            if not datagram: continue
+            if not datagram:
+                if self.entry_socket.sock.fileno() < 0:
+                    break # closed under us, or this thread would spin on it forever
+                continue
     
             if datagram.is_syn():
                 print(f"Received SYN from {addr}")
@@ -253,32 +415,126 @@ class Server:
                 self.entry_socket.send_ack(datagram)
                 break
 
+            elif len(datagram.payload)>0 and addr[0] in {self.host, '127.0.0.1'} and self.profile_request(datagram):
+                pass
+
             elif len(datagram.payload)>0:
-                self.portprint(f"Received message: {datagram.payload.decode()} from {addr}. This port isn't for data!")      
+                self.portprint(f"Received a {datagram.payload_size()} B message from {addr}. This port isn't for data!")      
+
+    def profile_request(self, datagram: Datagram) -> bool:
+        # Someone on this same host asking for a profiling window (python3 profiling.py <host> [seconds])
+        try:
+            seconds = NetTask_Message.deserialize(datagram.payload).profile_seconds()
+        except Exception:
+            return False
+        # Anything but a finite number of seconds would blow up in the profiler, on the thread accepting every session
+        if type(seconds) not in (int, float) or not isfinite(seconds):
+            return False
+        if not self.profiler.start(seconds):
+            self.portprint("Already profiling.")
+        return True
 
     def close(self):
-        self.entry_socket.close()
-        print("Server entry_socket closed.")
+        if self.entry_socket is not None:
+            self.entry_socket.close()
+            print("Server entry_socket closed.")
+
+        with self.connections_lock:
+            workers = list(self.current_connections.values())
+            self.current_connections.clear()
+        for worker in workers:
+            worker.shutdown()
+        if self.detector is not None:
+            self.detector.close()
+        self.ingest.close()  # drains what was already acked before the store goes away
+        self.store.close()
+        if self.rollups is not None:
+            self.rollups.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        print(self.latency.format())
 
     ###########################################################################################################
 
     def fetch_tasks(self, deviceID) -> Dict[str, NetTask_Task]:
-        taskIDs_for_this_device = self.device_to_tasks[deviceID]
+        taskIDs_for_this_device = self.device_to_tasks.get(deviceID, []) # relays have none
         return {
-            k: v
+            k: self.resolve_probe_target(v)
             for k, v in self.tasks.items()
             if k in taskIDs_for_this_device
         }
 
+    def resolve_probe_target(self, task: NetTask_Task) -> NetTask_Task:
+        # A probe_target naming a device becomes the address its session comes from, in a copy sent to this agent only.
+        # One that isn't connected leaves the server as the target, anything else is a host the agent resolves itself
+        if task.probe_target not in self.device_to_tasks:
+            return task
+        with self.connections_lock:
+            addr = next((worker.agent_addr for worker in self.current_connections.values() if worker.agent_deviceID == task.probe_target), None)
+        if addr is None:
+            self.portprint(f"Probe target {task.probe_target} of task {task.taskID} isn't connected, its probes go to the server.")
+        resolved = copy(task)
+        resolved.probe_target = addr
+        return resolved
+
     def new_worker(self, syn: Datagram):
     
         self.portprint(f"Entering new_worker for the following syn: {syn}")
-        new_worker_port = randint_excluding(49152,65535,self.used_ports)
+        new_worker_port = randint_excluding(*self.port_range, self.used_ports)
         
-        worker = Server_Worker(port=new_worker_port, syn=syn, fetch_tasks_method=self.fetch_tasks)
+        key = (syn.origin_addr, syn.origin_port)
+        with self.connections_lock:
+            # An agent reconnecting from the same address and port abandoned its previous session
+            previous = self.current_connections.pop(key, None)
+            self.used_ports.add(new_worker_port)
+        if previous is not None:
+            self.reap(previous)
 
-        self.used_ports.add(new_worker_port)
-        self.current_connections[syn.origin.addr] = worker
+        while True:
+            try:
+                worker = Server_Worker(
+                    port=new_worker_port, syn=syn, fetch_tasks_method=self.fetch_tasks, ingest=self.ingest, recorder=self.recorder,
+                    session_rate_method=self.session_rate, latency=self.latency
+                )
+                break
+            except OSError as e:
+                if e.errno != EADDRINUSE:
+                    raise
+                # Taken by something other than our sessions (another program, a lingering socket): any other port will do
+                with self.connections_lock:
+                    self.used_ports.discard(new_worker_port)
+                    new_worker_port = randint_excluding(*self.port_range, self.used_ports | {new_worker_port})
+                    self.used_ports.add(new_worker_port)
+        with self.connections_lock:
+            self.current_connections[key] = worker
+
+    def reap(self, worker: Server_Worker):
+        worker.shutdown()
+        with self.connections_lock:
+            self.used_ports.discard(worker.port)
+            self.sessions_reaped += 1
+            self.reports_reaped += worker.reports_received
+            self.throttled_reaped += worker.reports_throttled
+            self.spikes_reaped += worker.spikes_received
+
+    def reap_forever(self):
+        # Workers whose agent said goodbye, or went quiet for too long, give back their threads, sockets and port
+        while True:
+            sleep(REAPER_INTERVAL)
+
+            with self.connections_lock:
+                expired = [
+                    key for key, worker in self.current_connections.items()
+                    if worker.finished or worker.idle_time() > self.session_timeout
+                ]
+                workers = [self.current_connections.pop(key) for key in expired]
+
+            for key, worker in zip(expired, workers):
+                self.reap(worker)
+                self.portprint(f"Reaped the session of {worker.agent_deviceID or key[0]} (port {worker.port}).")
+
+            if workers:
+                self.portprint(f"Sessions: {len(self.current_connections)} live, {self.sessions_reaped} reaped.")
 
     ###########################################################################################################
 
@@ -306,26 +562,19 @@ class Server:
                     self.task_to_devices[taskID] = []  # Initialize the list if not exists
                 self.task_to_devices[taskID].append(device)
 
-    def create_logfiles(self):
-        os.makedirs(LOGS_BASE_DIR, exist_ok=True)  # Ensure the base directory exists
-
-        # Iterate through the device-to-tasks mapping
-        for device, task_ids in self.device_to_tasks.items():
-            # Create a directory for the device
-            device_dir = os.path.join(LOGS_BASE_DIR, device)
-            os.makedirs(device_dir, exist_ok=True)
+        # "relays": {relayID: reports per second, or null for RELAY_REPORT_RATE}
+        for relayID, rate in config_data.get("relays", {}).items():
+            self.relay_report_rates[relayID] = rate or RELAY_REPORT_RATE
 
-            # Create an empty JSON file for each task assigned to the device
-            for task_id in task_ids:
-                task_file_path = os.path.join(device_dir, f"{task_id}.json")
-                spike_file_path = os.path.join(device_dir, f"{task_id}spikes.json")
-                with open(task_file_path, "w") as task_file:
-                    json.dump({}, task_file, indent=4)  # Write an empty JSON object
-                with open(spike_file_path, "w") as spike_file:
-                    json.dump({}, spike_file, indent=4)    
+    def session_rate(self, deviceID: str) -> float:
+        # Anything not configured as a relay is a single agent, however it sends its reports
+        return self.relay_report_rates.get(deviceID, self.session_report_rate)
 
+    def local_devices(self) -> List[str]:
+        return list(self.device_to_tasks.keys())
 
-        print_directory(LOGS_BASE_DIR)
+    def create_logfiles(self):
+        self.store.prepare({device: self.device_to_tasks[device] for device in self.local_devices()})
 
     def delete_log_dir():   
         if os.path.exists(LOGS_BASE_DIR):  # Check if the directory exists
@@ -334,7 +583,30 @@ class Server:
     ###########################################################################################################
 
     def portprint(self, string):
-        self.entry_socket.sockprint(string)
+        if self.entry_socket is not None:
+            self.entry_socket.sockprint(string)
+        else:
+            print(string)
+
+    def sessions_cpu(self) -> Dict[str, float]:
+        with self.connections_lock:
+            workers = list(self.current_connections.values())
+        return {f"worker-{worker.port} {worker.agent_deviceID}": worker.cpu.seconds() for worker in workers}
+
+    def stats(self) -> Dict[str, int]:
+        with self.connections_lock:
+            workers = list(self.current_connections.values())
+        return {
+            'sessions': len(workers),
+            'reaped': self.sessions_reaped,
+            'reports': self.reports_reaped + sum(worker.reports_received for worker in workers),
+            'spikes': self.spikes_reaped + sum(worker.spikes_received for worker in workers),
+            'throttled': self.throttled_reaped + sum(worker.reports_throttled for worker in workers),
+            'queued': self.ingest.depth(),
+            'flagged': self.detector.flagged if self.detector is not None else 0,
+            'ingest': self.ingest.stats()['stages'],
+            'latency': self.latency.snapshot()
+        }
 
     
 
@@ -350,15 +622,28 @@ class Server:
 
 
 if __name__ == "__main__":
+
+    options = sys.argv[1:]
+    if len(options) > 3 or any(o not in storage_backends and o != "detect" and not o.startswith("capture=") for o in options):
+        print(f"Usage: python3 testserver.py [{'|'.join(storage_backends)}] [capture=<file>] [detect]")
+        sys.exit(1)
+
+    storage = next((o for o in options if o in storage_backends), 'json')
+    capture_path = next((o.split('=', 1)[1] for o in options if o.startswith("capture=")), None)
     
     Server.delete_log_dir()
 
     config_filepath = "config.json"
-    server = Server(config_filepath)
+    server = Server(config_filepath, storage=storage, capture_path=capture_path, detect_anomalies="detect" in options)
+    server.profiler.install_signals() # kill -USR1 for a profiling window, -USR2 for the CPU time of every session
+    probe_responder = UDP_Echo_Responder(local_addr=server.host) # target of the agents' native latency/jitter/loss probes
+    throughput_engine = Throughput_Engine_Server(local_addr=server.host) # other end of the agents' native throughput tests
+    iperf_endpoint = Iperf_Endpoint(local_addr=server.host) # other end of the agents' iperf probes
     try:
         server.entry_listen()
     except KeyboardInterrupt:
         print("\nShutting down server...")
     finally:
+        iperf_endpoint.close()
         server.close()
 
@@ -0,0 +1,424 @@
+from typing import Dict, Tuple
+from utils import NETTASK_THROUGHPUT_PORT, get_local_addr
+
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM, timeout
+from threading import Thread, Event
+from struct import Struct
+from time import perf_counter, sleep
+from shutil import which
+
+import subprocess
+
+from msgpack import packb, unpackb
+
+import shlex
+
+UDP_PACKET_SIZE = 1400          # stays under a typical 1500 B MTU
+TCP_CHUNK_SIZE = 64 * 1024
+TCP_CHUNKS_PER_SEND = 16        # chunks handed to a single sendmsg call
+UDP_BURST = 32                  # packets sent back to back before checking the pacing clock
+PACING_TICK = 0.001             # longest sleep while waiting for the pacing clock to catch up
+RECEIVER_POLL = 0.2             # how often an idle receiver checks whether the test is over
+RECEIVER_DRAIN = 0.5            # how long a receiver keeps listening after the sender reports it's done
+
+DEFAULT_UDP_BITRATE = 1_000_000 # same defaults as iperf3: 1 Mbit/s for UDP, unlimited for TCP
+
+SEQUENCE = Struct('!Q')         # every UDP packet starts with its sequence number
+FRAME_LENGTH = Struct('!I')     # control messages are length-prefixed msgpack maps
+
+bitrate_suffixes = {'K': 1e3, 'M': 1e6, 'G': 1e9}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def parse_iperf_options(options: str) -> Tuple[str, int]:
+    # Tasks describe their test with iperf options, we honour the ones that make sense here: -u and -b
+    argv = shlex.split(options or '')
+    protocol = 'udp' if '-u' in argv else 'tcp'
+    bitrate = DEFAULT_UDP_BITRATE if protocol == 'udp' else 0
+
+    if '-b' in argv and argv.index('-b') + 1 < len(argv):
+        value = argv[argv.index('-b') + 1]
+        multiplier = bitrate_suffixes.get(value[-1].upper(), 1)
+        bitrate = int(float(value.rstrip('kKmMgG')) * multiplier)
+
+    return protocol, bitrate
+
+def send_frame(sock: socket, message: Dict):
+    packed = packb(message, use_bin_type=True)
+    sock.sendall(FRAME_LENGTH.pack(len(packed)) + packed)
+
+def recv_frame(sock: socket) -> Dict:
+
+    def recv_exactly(nbytes):
+        buffer = bytearray(nbytes)
+        view = memoryview(buffer)
+        received = 0
+        while received < nbytes:
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("Throughput control connection closed.")
+            received += n
+        return buffer
+
+    length = FRAME_LENGTH.unpack(recv_exactly(FRAME_LENGTH.size))[0]
+    return unpackb(recv_exactly(length), raw=False)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Throughput_Sender:
+
+    # Paces traffic at a target bitrate out of one preallocated buffer. UDP packets only get their sequence number
+    # rewritten in place, TCP hands many views of the same buffer to each sendmsg, so nothing is allocated per packet.
+
+    def __init__(self, protocol: str, dest: Tuple[str, int], bitrate: int, duration: float):
+        self.protocol = protocol
+        self.dest = dest
+        self.bitrate = bitrate
+        self.duration = duration
+
+        self.buffer = bytearray(UDP_PACKET_SIZE if protocol == 'udp' else TCP_CHUNK_SIZE)
+        self.chunks = [memoryview(self.buffer)] * TCP_CHUNKS_PER_SEND
+        self.sock = socket(AF_INET, SOCK_DGRAM if protocol == 'udp' else SOCK_STREAM)
+        self.sock.connect(dest)
+
+    def run(self) -> Dict[str, float]:
+
+        send_burst = self.send_udp_burst if self.protocol == 'udp' else self.send_tcp_burst
+
+        sent_bytes = 0
+        packets = 0
+        start = perf_counter()
+
+        while True:
+            elapsed = perf_counter() - start
+            if elapsed >= self.duration:
+                break
+
+            # Ahead of schedule: wait for the pacing clock instead of sending
+            if self.bitrate and sent_bytes * 8 >= self.bitrate * elapsed:
+                sleep(min(PACING_TICK, sent_bytes * 8 / self.bitrate - elapsed))
+                continue
+
+            sent, count = send_burst(packets)
+            sent_bytes += sent
+            packets += count
+
+        elapsed = perf_counter() - start
+        self.sock.close()
+        return {'bytes': sent_bytes, 'packets': packets, 'seconds': elapsed}
+
+    def send_udp_burst(self, seq: int) -> Tuple[int, int]:
+        sent = 0
+        for i in range(UDP_BURST):
+            SEQUENCE.pack_into(self.buffer, 0, seq + i)
+            try:
+                sent += self.sock.send(self.buffer)
+            except (BlockingIOError, OSError):
+                # ENOBUFS: the kernel queue is full, let it drain
+                sleep(PACING_TICK)
+                return sent, i
+        return sent, UDP_BURST
+
+    def send_tcp_burst(self, seq: int) -> Tuple[int, int]:
+        # One syscall for the whole burst, every chunk is a view of the same buffer
+        sent = self.sock.sendmsg(self.chunks)
+        return sent, TCP_CHUNKS_PER_SEND
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Throughput_Receiver:
+
+    # Counts what arrives on an ephemeral port until told the sender is done. For UDP it also tracks
+    # the highest sequence number seen, so lost and out-of-order packets can be told apart.
+
+    def __init__(self, protocol: str, local_addr: str):
+        self.protocol = protocol
+        self.done = Event()
+        self.bytes = 0
+        self.packets = 0
+        self.out_of_order = 0
+        self.highest_seq = -1
+        self.first_arrival = None
+        self.last_arrival = None
+
+        self.buffer = bytearray(65535 if protocol == 'udp' else TCP_CHUNK_SIZE)
+        self.sock = socket(AF_INET, SOCK_DGRAM if protocol == 'udp' else SOCK_STREAM)
+        self.sock.bind((local_addr, 0))
+        self.port = self.sock.getsockname()[1]
+        if protocol == 'tcp':
+            self.sock.listen(1)
+
+        self.thread = Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+
+        sock = self.sock
+        if self.protocol == 'tcp':
+            self.sock.settimeout(RECEIVER_POLL)
+            while True:
+                try:
+                    sock, _ = self.sock.accept()
+                    break
+                except timeout:
+                    if self.done.is_set():
+                        return # the sender never showed up
+                except OSError:
+                    return
+
+        sock.settimeout(RECEIVER_POLL)
+        buffer = self.buffer
+
+        while True:
+            try:
+                nbytes = sock.recv_into(buffer)
+            except timeout:
+                if self.done.is_set():
+                    break
+                continue
+            except OSError:
+                break
+
+            if nbytes == 0: # TCP sender closed
+                break
+
+            now = perf_counter()
+            if self.first_arrival is None:
+                self.first_arrival = now
+            self.last_arrival = now
+            self.bytes += nbytes
+            self.packets += 1
+
+            if self.protocol == 'udp':
+                seq = SEQUENCE.unpack_from(buffer)[0]
+                if seq > self.highest_seq:
+                    self.highest_seq = seq
+                else:
+                    self.out_of_order += 1
+
+        if sock is not self.sock:
+            sock.close()
+
+    def finish(self, packets_sent: int) -> Dict[str, float]:
+
+        # Give late packets a moment, then stop the receiving thread on its next poll
+        sleep(RECEIVER_DRAIN)
+        self.done.set()
+        self.thread.join()
+        self.sock.close()
+
+        seconds = (self.last_arrival - self.first_arrival) if self.packets > 1 else 0
+        results = {
+            'bytes': self.bytes,
+            'seconds': seconds,
+            'mbps': round(self.bytes * 8 / seconds / 1e6, 2) if seconds else 0.0,
+            'out_of_order': self.out_of_order
+        }
+        if self.protocol == 'udp':
+            lost = max(0, packets_sent - self.packets)
+            results['lost'] = lost
+            results['loss_percent'] = round(100 * lost / packets_sent, 2) if packets_sent else 0.0
+        return results
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Throughput_Engine_Server:
+
+    # Listens for control connections. Each one describes a test: who sends (the agent or us), protocol,
+    # bitrate and duration. The receiving side opens the data port and the final results travel back on the control connection.
+
+    def __init__(self, local_addr=None, local_port=NETTASK_THROUGHPUT_PORT):
+        self.local_addr = local_addr or get_local_addr()
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.bind((self.local_addr, local_port))
+        self.sock.listen()
+        self.thread = Thread(target=self.accept_forever, daemon=True)
+        self.thread.start()
+
+    def accept_forever(self):
+        while True:
+            try:
+                control, _ = self.sock.accept()
+            except OSError:
+                break
+            Thread(target=self.handle, args=(control,), daemon=True).start()
+
+    def handle(self, control: socket):
+        try:
+            request = recv_frame(control)
+
+            if request['agent_sends']:
+                receiver = Throughput_Receiver(request['protocol'], self.local_addr)
+                send_frame(control, {'port': receiver.port})
+                sender_stats = recv_frame(control)
+                send_frame(control, receiver.finish(sender_stats['packets']))
+            else:
+                agent_host = control.getpeername()[0]
+                sender = Throughput_Sender(request['protocol'], (agent_host, request['port']), request['bitrate'], request['duration'])
+                send_frame(control, sender.run())
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            control.close()
+
+    def close(self):
+        self.sock.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Iperf_Endpoint:
+
+    # iperf3 -s for the agents' iperf probes, which are always the client (reversed for iperf_as_server tasks).
+    # iperf3 is optional here as it is on the agents: without it only native throughput tests get an answer.
+
+    def __init__(self, local_addr=None):
+        self.process = None
+        if which('iperf3') is None:
+            print("iperf3 not found, agents' iperf probes against this host will fail")
+            return
+        self.process = subprocess.Popen(['iperf3', '-s', '-B', local_addr or get_local_addr()],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Throughput_Client:
+
+    # The agent's end of a test. iperf_as_server tasks receive traffic from the engine server, every other task sends to it.
+
+    def __init__(self, server_host, server_port=NETTASK_THROUGHPUT_PORT):
+        self.server = (server_host, server_port)
+
+    def run(self, agent_sends: bool, protocol: str, bitrate: int, duration: float) -> Dict[str, float]:
+
+        control = socket(AF_INET, SOCK_STREAM)
+        control.connect(self.server)
+
+        try:
+            if agent_sends:
+                send_frame(control, {'agent_sends': True, 'protocol': protocol})
+                port = recv_frame(control)['port']
+                sender = Throughput_Sender(protocol, (self.server[0], port), bitrate, duration)
+                send_frame(control, sender.run())
+                return recv_frame(control)
+            else:
+                receiver = Throughput_Receiver(protocol, control.getsockname()[0])
+                send_frame(control, {
+                    'agent_sends': False, 'protocol': protocol, 'bitrate': bitrate,
+                    'duration': duration, 'port': receiver.port
+                })
+                sender_stats = recv_frame(control)
+                return receiver.finish(sender_stats['packets'])
+        finally:
+            control.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    engine = Throughput_Engine_Server(local_addr="127.0.0.1")
+    client = Throughput_Client("127.0.0.1")
+
+    for agent_sends, protocol, bitrate in [
+        (True, 'udp', 500_000_000),
+        (False, 'udp', 100_000_000),
+        (True, 'tcp', 0),
+        (False, 'tcp', 0),
+    ]:
+        print(f"{'agent->server' if agent_sends else 'server->agent'} {protocol} @ {bitrate or 'unlimited'}: ", end='')
+        print(client.run(agent_sends, protocol, bitrate, duration=2))
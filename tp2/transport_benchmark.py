@@ -0,0 +1,154 @@
+from impairment_proxy import Impairment, Impairment_Proxy
+from testclient import Client
+from testserver import Server
+from nettask_message import NetTask_Message
+from nettask_report import NetTask_Report
+from nettask_sampler import percentile
+
+from typing import Dict, List
+from threading import Thread
+from time import perf_counter
+
+import tempfile
+import sys
+import os
+
+# Goodput, delivery latency and packets per report of the NetTask transport through an impaired link, for every scenario
+# and retransmission timeout. Reports go out in send_window batches of the given size (1 is stop-and-wait).
+# Runs its own server in-process, each scenario gets a fresh proxy and agent.
+# Usage: python3 transport_benchmark.py [reports_per_scenario] [window]
+
+REPORTS_PER_SCENARIO = 20
+RETRANSMISSION_TIMEOUTS = [0.2, 1.0] # seconds, SocketWrapper.timeout of the agent
+
+scenarios: Dict[str, Impairment] = {
+    'clean': Impairment(),
+    'delay 20 ms': Impairment(delay=0.02, jitter=0.005),
+    'loss 5%': Impairment(loss=0.05),
+    'loss 20%': Impairment(loss=0.2),
+    'duplicate 10%': Impairment(duplicate=0.1),
+    'reorder 10%': Impairment(reorder=0.1, delay=0.002),
+    '1 Mbit/s': Impairment(bandwidth=1_000_000),
+}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def sample_payload(deviceID: str) -> bytes:
+    report = NetTask_Report(deviceID, 't1')
+    report.add_measurement('c', 12.5)
+    report.add_measurement('r', 40.1)
+    report.add_measurement('t', {'eth0': 1500.0})
+    return NetTask_Message(author=deviceID, tag='r', payload=report.serialize()).serialize()
+
+def link_packets(proxy: Impairment_Proxy) -> int:
+    stats = proxy.stats()
+    return stats['upstream']['forwarded'] + stats['downstream']['forwarded']
+
+def run_scenario(server_host: str, impairment: Impairment, timeout: float, reports: int, window=1, deviceID='r1') -> Dict:
+
+    proxy = Impairment_Proxy(server_host, upstream=impairment, downstream=impairment)
+    client = Client('127.0.0.1', deviceID, port=0, local_addr='127.0.0.1', verbose=False, server_port=proxy.port)
+    client.nettask_socket.timeout = timeout
+    results = {'delivered': 0, 'failed': 0}
+
+    try:
+        start = perf_counter()
+        client.handshake()
+        client.send_nettask_control_message()
+        client.listen_for_nettask_tasks()
+        client.connect_alertflow()
+        results['setup_s'] = round(perf_counter() - start, 2)
+    except (TimeoutError, ConnectionAbortedError, OSError):
+        results['setup_s'] = None
+        proxy.close()
+        return results
+
+    payload = sample_payload(deviceID)
+    latencies: List[float] = []
+    packets_before = link_packets(proxy)
+    start = perf_counter()
+
+    for sent in range(0, reports, window):
+        batch = min(window, reports - sent)
+        sent_at = perf_counter()
+        try:
+            client.nettask_socket.send_window('127.0.0.1', client.server_port, [payload] * batch)
+            latencies += [perf_counter() - sent_at] * batch # a report is delivered once its window is acked
+        except TimeoutError:
+            results['failed'] += batch
+
+    elapsed = perf_counter() - start
+    results['delivered'] = len(latencies)
+    results['goodput_kbps'] = round(len(latencies) * len(payload) * 8 / elapsed / 1000, 1)
+    results['avg_ms'] = round(1000 * sum(latencies) / len(latencies), 1) if latencies else None
+    results['p95_ms'] = round(1000 * percentile(latencies, 0.95), 1) if latencies else None
+    results['link'] = proxy.stats()
+    results['packets_per_report'] = round((link_packets(proxy) - packets_before) / len(latencies), 2) if latencies else None
+
+    try:
+        client.close()
+    except (TimeoutError, ConnectionAbortedError, OSError):
+        pass # the goodbye got lost too, the server reaps the session
+    proxy.close()
+    return results
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    reports = int(sys.argv[1]) if len(sys.argv) >= 2 else REPORTS_PER_SCENARIO
+    window = int(sys.argv[2]) if len(sys.argv) == 3 else 1
+
+    console = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # the server and the agent print every datagram
+
+    server = Server("config.json", logs_dir=tempfile.mkdtemp())
+    Thread(target=server.entry_listen, daemon=True).start()
+
+    def show(line):
+        console.write(line + "\n")
+        console.flush()
+
+    show(f"{'Scenario':16} {'RTO s':>6} {'setup s':>8} {'ok/sent':>8} {'kbit/s':>8} {'avg ms':>8} {'p95 ms':>8} {'pkt/rep':>8}  drops up/down")
+    try:
+        for name, impairment in scenarios.items():
+            for timeout in RETRANSMISSION_TIMEOUTS:
+                r = run_scenario(server.host, impairment, timeout, reports, window)
+                if r['setup_s'] is None:
+                    show(f"{name:16} {timeout:6} {'failed':>8}")
+                    continue
+                link = r['link']
+                show(
+                    f"{name:16} {timeout:6} {r['setup_s']:8} {r['delivered']:>4}/{reports:<3} {r['goodput_kbps']:8} "
+                    f"{str(r['avg_ms']):>8} {str(r['p95_ms']):>8} {str(r['packets_per_report']):>8}  "
+                    f"{link['upstream']['dropped']}/{link['downstream']['dropped']}"
+                )
+    finally:
+        server.close()
+        sys.stdout = console
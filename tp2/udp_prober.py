@@ -0,0 +1,166 @@
+from typing import Dict, List
+from socketwrapper import SocketWrapper
+from datagram import Datagram, ACK
+from utils import NETTASK_PROBE_PORT, get_local_addr
+
+from threading import Thread
+from struct import Struct
+from time import perf_counter_ns, perf_counter
+from socket import timeout
+
+PROBE_COUNT = 10           # probes per train
+PROBE_INTERVAL = 0.02      # seconds between probes of a train
+PROBE_LINGER = 1           # seconds to wait for late echoes after the last probe
+
+# Probe payloads are only the sender's clock, the echo hands it back untouched
+PROBE_TIMESTAMP = Struct('!Q')
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class UDP_Echo_Responder:
+
+    # Answers every probe with an ack carrying the same payload, so the prober can time it with its own clock
+
+    def __init__(self, local_addr=None, local_port=NETTASK_PROBE_PORT):
+        self.socket = SocketWrapper(local_addr=local_addr or get_local_addr(), local_port=local_port, verbose=False)
+        self.thread = Thread(target=self.echo_forever, daemon=True)
+        self.thread.start()
+
+    def echo_forever(self):
+        while True:
+            try:
+                probe, _ = self.socket.recv_datagram()
+            except OSError:
+                break # socket closed
+            except Exception:
+                continue # not one of ours
+
+            self.socket.send(
+                probe.origin_addr, probe.origin_port, ACK,
+                payload=probe.payload, acknr=probe.seqnr + probe.payload_size() + 1
+            )
+
+    def close(self):
+        self.socket.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class UDP_Prober:
+
+    # Sends timestamped probe trains to an echo responder and measures RTT, jitter and loss in-process.
+    # Probes are ordinary Datagrams numbered like any other send, so echoes are matched through their acknr.
+
+    def __init__(self, target_host, target_port=NETTASK_PROBE_PORT):
+        self.target_host = target_host
+        self.target_port = target_port
+        self.socket = SocketWrapper(local_addr=get_local_addr(target_host), local_port=0, verbose=False)
+
+    def measure(self, count=PROBE_COUNT, interval=PROBE_INTERVAL, linger=PROBE_LINGER) -> Dict[str, float]:
+
+        outstanding: Dict[int, int] = {} # expected acknr -> index of the probe
+        rtts: List[float] = []           # in ms, in arrival order
+        answered = set()
+
+        def collect_until(deadline):
+            while True:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    return
+                self.socket.sock.settimeout(remaining)
+                try:
+                    echo, _ = self.socket.recv_datagram()
+                except timeout:
+                    return
+                except Exception:
+                    continue
+
+                index = outstanding.get(echo.acknr)
+                if index is None or index in answered:
+                    continue # stale echo from a previous train or a duplicate
+                answered.add(index)
+                sent_ns = PROBE_TIMESTAMP.unpack_from(echo.payload)[0]
+                rtts.append((perf_counter_ns() - sent_ns) / 1e6)
+
+        for index in range(count):
+            payload = PROBE_TIMESTAMP.pack(perf_counter_ns())
+            sent = self.socket.send(self.target_host, self.target_port, 0, payload=payload)
+            self.socket.seqnr += sent.payload_size() + 1
+            outstanding[sent.seqnr + sent.payload_size() + 1] = index
+            collect_until(perf_counter() + interval)
+
+        if len(answered) < count:
+            collect_until(perf_counter() + linger)
+        self.socket.sock.settimeout(None)
+
+        return self.summarize(rtts, count)
+
+    @staticmethod
+    def summarize(rtts: List[float], sent: int) -> Dict[str, float]:
+
+        results = {'p': round(100 * (sent - len(rtts)) / sent, 2)}
+        if not rtts:
+            return results
+
+        # Interarrival jitter as in RFC 3550 (section 6.4.1), with RTT differences standing in for transit time differences
+        jitter = 0.0
+        for previous, current in zip(rtts, rtts[1:]):
+            jitter += (abs(current - previous) - jitter) / 16
+
+        results['l'] = round(sum(rtts) / len(rtts), 3)
+        results['j'] = round(jitter, 3)
+        return results
+
+    def close(self):
+        self.socket.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    responder = UDP_Echo_Responder(local_addr="127.0.0.1", local_port=NETTASK_PROBE_PORT)
+    prober = UDP_Prober("127.0.0.1")
+
+    for _ in range(3):
+        print(prober.measure())
+
+    prober.close()
+    responder.close()
@@ -1,9 +1,11 @@
-from time import time, sleep
-from directory_tree import DisplayTree
+from time import time, sleep, monotonic
+from threading import Lock
 from random import randint
 from socket import socket, AF_INET, SOCK_DGRAM
 
 NETTASK_SERVER_PORT = 9000
+NETTASK_PROBE_PORT = 9001
+NETTASK_THROUGHPUT_PORT = 9002
 
 def timewindow(func, duration, *args, **kwargs):
     start_time = time()                 # Record the start time
@@ -18,9 +20,54 @@ def timewindow(func, duration, *args, **kwargs):
 
     return result
 
+def stage_trace(stamps: dict) -> list:
+    # Microseconds from 'measured' to 'enqueued' and from there to now, for a report's stamps (None if it wasn't stamped)
+    if 'measured' not in stamps or 'enqueued' not in stamps:
+        return None
+    now = monotonic()
+    return [round((stamps['enqueued'] - stamps['measured']) * 1e6), round((now - stamps['enqueued']) * 1e6)]
+
 def print_directory(directory: str):
+    from directory_tree import DisplayTree # only the server prints trees, agents shouldn't pay for importing it
     DisplayTree(directory) # ex: "./myfolder" prints the tree starting with myfolder as root
 
+class Token_Bucket:
+
+    # rate tokens per second, saved up to burst. Taking one when there's none says how long to wait for it.
+
+    def __init__(self, rate: float, burst: float, clock=monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.level = burst
+        self.clock = clock
+        self.updated = clock()
+        self.lock = Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.level = min(self.burst, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        with self.lock:
+            self.refill()
+            return self.level
+
+    def take(self, count: int = 1) -> float:
+        with self.lock:
+            self.refill()
+            self.level -= count
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def try_take(self) -> bool:
+        # Takes one only if there's one, for callers that hold back instead of waiting
+        with self.lock:
+            self.refill()
+            if self.level < 1:
+                return False
+            self.level -= 1
+            return True
+
 class Colours:
     """ ANSI color codes """
     BLACK = "\033[0;30m"
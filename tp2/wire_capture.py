@@ -0,0 +1,131 @@
+from typing import Iterator, Tuple
+from collections import namedtuple
+from threading import Lock
+from struct import Struct
+from socket import inet_aton, inet_ntoa
+from time import time, monotonic
+
+# Capture files: a magic line, then one record per datagram or TCP read, back to back:
+#   [timestamp !d][kind !B][direction !B][src ip 4s][src port !H][dst ip 4s][dst port !H][length !I][bytes]
+# The bytes are exactly what went on (or came off) the wire, so they're still compressed and cost nothing to re-encode.
+
+CAPTURE_MAGIC = b'NTCAP1\n'
+RECORD_HEADER = Struct('!dBB4sH4sHI')
+CAPTURE_BUFFER_SIZE = 1 << 20
+CAPTURE_FLUSH_INTERVAL = 1 # seconds between flushes while recording, bounds what a killed process loses
+
+UDP, TCP = 0, 1
+INBOUND, OUTBOUND = 0, 1
+
+Capture_Record = namedtuple('Capture_Record', ['timestamp', 'kind', 'direction', 'src', 'dst', 'data'])
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Capture_Writer:
+
+    # Shared by every socket of a process, recording is one struct pack and a buffered write under a lock
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        self.file.write(CAPTURE_MAGIC)
+        self.lock = Lock()
+        self.records = 0
+        self.last_flush = monotonic()
+
+    def record(self, kind: int, direction: int, src: Tuple[str, int], dst: Tuple[str, int], data):
+        header = RECORD_HEADER.pack(time(), kind, direction, inet_aton(src[0]), src[1], inet_aton(dst[0]), dst[1], len(data))
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(header)
+            self.file.write(data)
+            self.records += 1
+            if monotonic() - self.last_flush > CAPTURE_FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def read_capture(path: str) -> Iterator[Capture_Record]:
+    with open(path, 'rb') as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file.")
+
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return # end of file, or a record cut short by a crash
+            timestamp, kind, direction, src_ip, src_port, dst_ip, dst_port, length = RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield Capture_Record(timestamp, kind, direction, (inet_ntoa(src_ip), src_port), (inet_ntoa(dst_ip), dst_port), data)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    if len(sys.argv) != 2:
+        print("Usage: python3 wire_capture.py <capture_file>")
+        sys.exit(1)
+
+    # Per-direction summary of a capture
+    counts = {}
+    first = last = None
+    for record in read_capture(sys.argv[1]):
+        key = (('UDP', 'TCP')[record.kind], ('in', 'out')[record.direction])
+        packets, nbytes = counts.get(key, (0, 0))
+        counts[key] = (packets + 1, nbytes + len(record.data))
+        first = first if first is not None else record.timestamp
+        last = record.timestamp
+
+    for (kind, direction), (packets, nbytes) in sorted(counts.items()):
+        print(f"{kind} {direction:3} {packets:8} records {nbytes:10} B")
+    if first is not None:
+        print(f"Spanning {last - first:.1f} s")
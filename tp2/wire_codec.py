@@ -0,0 +1,38 @@
+from msgpack import Packer, Unpacker, unpackb
+from threading import local
+from typing import List
+
+ALERTFLOW_STREAM_BUFFER = 1024 * 1024 # bytes an AlertFlow connection may have buffered without completing a report
+
+# Everything on the wire is msgpack, and every layer encodes its fields as an array in a fixed order instead of a map
+# with string keys. Optional fields go last and are left out when they and everything after them are None, so the
+# common datagram or report carries no placeholders at all. Decoders still take the maps older agents sent (and captures
+# hold), told apart by type, see the legacy_* functions of each class.
+
+# A Packer keeps its buffer and options between calls, packb builds both every time. They aren't thread safe, so one per thread.
+packers = local()
+
+def pack(obj) -> bytes:
+    try:
+        packer = packers.packer
+    except AttributeError:
+        packer = packers.packer = Packer(use_bin_type=True, strict_types=True)
+    return packer.pack(obj)
+
+# Decoding a whole buffer has nothing to keep between calls, unpackb without options is already the fast path
+unpack = unpackb
+
+def stream_unpacker() -> Unpacker:
+    # For messages that follow each other on a TCP connection: fed whatever recv returns, yields the complete ones
+    return Unpacker(max_buffer_size=ALERTFLOW_STREAM_BUFFER)
+
+def trimmed(fields: List) -> List:
+    # Drops the trailing None fields
+    end = len(fields)
+    while end and fields[end - 1] is None:
+        end -= 1
+    return fields if end == len(fields) else fields[:end]
+
+def padded(fields: List, count: int) -> List:
+    # Back to count fields, the ones left out being None
+    return fields if len(fields) >= count else fields + [None] * (count - len(fields))
@@ -0,0 +1,229 @@
+from wire_capture import read_capture, UDP, TCP, INBOUND
+from datagram import Datagram, ACK
+from nettask_message import NetTask_Message
+from testclient import Client
+from testserver import Server
+
+from typing import Dict, List, Tuple
+from threading import Thread, Lock
+from time import perf_counter, sleep
+
+import tempfile
+import sys
+import os
+
+# Replays what agents sent in a server-side capture (testserver.py capture=<file>) against a server, so ingest can be
+# benchmarked with real traffic. Each captured session becomes a synthetic agent with its own loopback address, which
+# redoes the handshake and task exchange and then resends the captured reports and spikes byte for byte, paced like the
+# original (1x), N times faster, or back to back (max). Without a server_host, a server is started in this process.
+# Usage: python3 wire_replay.py <capture_file> [speed|max] [clones] [server_host]
+
+DEFAULT_SPEED = 1.0
+DEFAULT_CLONES = 1
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Replay_Session:
+
+    # Everything one agent sent during a captured session that isn't protocol chatter, in order
+
+    def __init__(self, source: Tuple[str, int], deviceID: str):
+        self.source = source
+        self.deviceID = deviceID
+        self.events: List[Tuple[float, int, bytes]] = [] # (timestamp, UDP report or TCP spike, bytes to resend)
+        self.seen_seqnrs = set()
+
+def load_sessions(path: str) -> List[Replay_Session]:
+    sessions: List[Replay_Session] = []
+    current: Dict[Tuple[str, int], Replay_Session] = {} # source -> its latest session
+
+    for record in read_capture(path):
+        if record.direction != INBOUND:
+            continue
+
+        if record.kind == TCP:
+            session = current.get(record.src)
+            if session is not None:
+                session.events.append((record.timestamp, TCP, record.data))
+            continue
+
+        try:
+            datagram = Datagram.deserialize(record.data)
+        except Exception:
+            continue # not ours
+
+        if datagram.is_syn():
+            hello = NetTask_Message.deserialize(datagram.payload) if datagram.payload_size() > 0 else None
+            if hello is not None:
+                current[record.src] = Replay_Session(record.src, str(hello.author))
+                sessions.append(current[record.src])
+            continue
+
+        session = current.get(record.src)
+        if session is None or datagram.is_heartbeat() or datagram.payload_size() == 0:
+            continue
+        if datagram.seqnr in session.seen_seqnrs:
+            continue # retransmission, the server only stored it once
+        session.seen_seqnrs.add(datagram.seqnr)
+
+        # Reports may be interned against their session's symbols, which the replayed session negotiates all over again
+        # from the same tasks, so they're resent as they are without decoding them here
+        message = NetTask_Message.deserialize(datagram.payload)
+        if message is not None and message.tag == 'r':
+            session.events.append((record.timestamp, UDP, bytes(datagram.payload)))
+
+    return [session for session in sessions if session.events]
+
+def synthetic_addr(index: int) -> str:
+    # The whole 127/8 is loopback on Linux, so every replayed agent can have an address of its own
+    return f"127.{1 + index // 62500}.{(index // 250) % 250}.{1 + index % 250}"
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+class Replayer:
+
+    def __init__(self, sessions: List[Replay_Session], server_host: str, speed: float = DEFAULT_SPEED, clones: int = DEFAULT_CLONES):
+        self.sessions = sessions
+        self.server_host = server_host
+        self.speed = speed # 0 means as fast as the server acks
+        self.clones = clones
+
+        self.lock = Lock()
+        self.reports_acked = 0
+        self.spikes_sent = 0
+        self.ack_wait = 0.0
+        self.failed_agents = 0
+
+    def replay_session(self, session: Replay_Session, local_addr: str):
+
+        try:
+            client = Client(self.server_host, session.deviceID, port=0, local_addr=local_addr, verbose=False)
+            client.handshake()
+            client.send_nettask_control_message()
+            client.listen_for_nettask_tasks()
+            client.connect_alertflow()
+            client.nettask_socket.keep_alive(self.server_host, client.server_port, client.lose_server)
+
+            start = perf_counter()
+            first_timestamp = session.events[0][0]
+
+            for timestamp, kind, payload in session.events:
+                if self.speed:
+                    remaining = start + (timestamp - first_timestamp) / self.speed - perf_counter()
+                    if remaining > 0:
+                        sleep(remaining)
+
+                if kind == UDP:
+                    sent_at = perf_counter()
+                    client.nettask_socket.send_and_wait_ack(self.server_host, client.server_port, ACK, payload=payload)
+                    with self.lock:
+                        self.reports_acked += 1
+                        self.ack_wait += perf_counter() - sent_at
+                else:
+                    client.alertflow_socket.sendall(payload)
+                    with self.lock:
+                        self.spikes_sent += 1
+
+            client.close()
+
+        except OSError:
+            with self.lock:
+                self.failed_agents += 1
+
+    def run(self) -> Dict[str, float]:
+        agents = [
+            Thread(target=self.replay_session, args=(session, synthetic_addr(i * len(self.sessions) + j)), daemon=True)
+            for i in range(self.clones)
+            for j, session in enumerate(self.sessions)
+        ]
+
+        start = perf_counter()
+        for agent in agents: agent.start()
+        for agent in agents: agent.join()
+        elapsed = perf_counter() - start
+
+        return {
+            'agents': len(agents),
+            'failed_agents': self.failed_agents,
+            'reports': self.reports_acked,
+            'spikes': self.spikes_sent,
+            'seconds': round(elapsed, 2),
+            'reports_per_second': round(self.reports_acked / elapsed, 1) if elapsed else 0.0,
+            'avg_ack_ms': round(1000 * self.ack_wait / self.reports_acked, 3) if self.reports_acked else 0.0
+        }
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in {2, 3, 4, 5}:
+        print("Usage: python3 wire_replay.py <capture_file> [speed|max] [clones] [server_host]")
+        sys.exit(1)
+
+    sessions = load_sessions(sys.argv[1])
+    speed = DEFAULT_SPEED
+    if len(sys.argv) >= 3:
+        speed = 0 if sys.argv[2] == "max" else float(sys.argv[2])
+    clones = int(sys.argv[3]) if len(sys.argv) >= 4 else DEFAULT_CLONES
+
+    server = None
+    if len(sys.argv) == 5:
+        server_host = sys.argv[4]
+    else:
+        server = Server("config.json", logs_dir=tempfile.mkdtemp())
+        Thread(target=server.entry_listen, daemon=True).start()
+        server_host = server.host
+
+    print(f"Replaying {len(sessions)} sessions x {clones} at {'max' if not speed else f'{speed:g}x'} speed against {server_host}")
+
+    # Agents and the server print every step, which would drown the results and slow everything down
+    console = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = Replayer(sessions, server_host, speed, clones).run()
+        if server is not None:
+            server.ingest.flush()
+            results['server'] = server.stats()
+    finally:
+        sys.stdout = console
+
+    print(results)